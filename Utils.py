@@ -7,41 +7,94 @@
 # license agreement from NVIDIA CORPORATION is strictly prohibited.
 
 
-import os, sys, time,torch,pickle,trimesh,itertools,pdb,zipfile,datetime,imageio,gzip,logging,joblib,importlib,uuid,signal,multiprocessing,psutil,subprocess,tarfile,scipy,argparse
+import os, sys, time,torch,pickle,trimesh,itertools,zipfile,datetime,gzip,logging,importlib,uuid,signal,multiprocessing,subprocess,tarfile,scipy,argparse
 from pytorch3d.transforms import so3_log_map,so3_exp_map,se3_exp_map,se3_log_map,matrix_to_axis_angle,matrix_to_euler_angles,euler_angles_to_matrix, rotation_6d_to_matrix
-from pytorch3d.renderer import FoVPerspectiveCameras, PerspectiveCameras, look_at_view_transform, look_at_rotation, RasterizationSettings, MeshRenderer, MeshRasterizer, BlendParams, SoftSilhouetteShader, HardPhongShader, PointLights, TexturesVertex
-from pytorch3d.renderer.mesh.rasterize_meshes import barycentric_coordinates
-from pytorch3d.renderer.mesh.shader import SoftDepthShader, HardFlatShader
-from pytorch3d.renderer.mesh.textures import Textures
-from pytorch3d.structures import Meshes
-from scipy.interpolate import griddata
-import nvdiffrast.torch as dr
 import torch.nn.functional as F
-import torchvision
 import torch.nn as nn
 from functools import partial
-import pandas as pd
-import open3d as o3d
 from uuid import uuid4
 import cv2
-from PIL import Image
 import numpy as np
-from collections import defaultdict
+from collections import defaultdict,deque
 import multiprocessing as mp
-import matplotlib.pyplot as plt
-import math,glob,re,copy
+import math,glob,re,copy,threading
 from transformations import *
-from scipy.spatial import cKDTree
 from collections import OrderedDict
-import ruamel.yaml
-yaml = ruamel.yaml.YAML()
+from contextlib import contextmanager,nullcontext
+from torch_rasterizer import TorchRasterizeContext
+
+
+class LazyModule:
+  '''Stands in for a module (or any object built by factory) and imports it on first attribute access,
+  so heavy optional dependencies are only paid for by the processes that use them
+  '''
+  def __init__(self, name, factory=None):
+    self.__dict__['_name'] = name
+    self.__dict__['_factory'] = factory if factory is not None else (lambda: importlib.import_module(name))
+    self.__dict__['_obj'] = None
+
+  def _load(self):
+    if self.__dict__['_obj'] is None:
+      self.__dict__['_obj'] = self.__dict__['_factory']()
+    return self.__dict__['_obj']
+
+  def __getattr__(self, k):
+    return getattr(self._load(), k)
+
+  def __setattr__(self, k, v):
+    setattr(self._load(), k, v)
+
+  def __dir__(self):
+    return dir(self._load())
+
+  def __repr__(self):
+    return f'LazyModule({self._name})'
+
+
+def lazy_callable(module_name, name):
+  '''Function or class of module_name, imported on the first call
+  '''
+  def call(*args, **kwargs):
+    return getattr(importlib.import_module(module_name), name)(*args, **kwargs)
+  call.__name__ = name
+  return call
+
+
+pdb = LazyModule('pdb')
+imageio = LazyModule('imageio')
+joblib = LazyModule('joblib')
+psutil = LazyModule('psutil')
+dr = LazyModule('nvdiffrast.torch')
+torchvision = LazyModule('torchvision')
+pd = LazyModule('pandas')
+o3d = LazyModule('open3d')
+plt = LazyModule('matplotlib.pyplot')
+Image = LazyModule('PIL.Image')
+kornia = LazyModule('kornia')
+yaml = LazyModule('ruamel.yaml', factory=lambda: importlib.import_module('ruamel.yaml').YAML())
+griddata = lazy_callable('scipy.interpolate', 'griddata')
+cKDTree = lazy_callable('scipy.spatial', 'cKDTree')
+FoVPerspectiveCameras = lazy_callable('pytorch3d.renderer', 'FoVPerspectiveCameras')
+PerspectiveCameras = lazy_callable('pytorch3d.renderer', 'PerspectiveCameras')
+look_at_view_transform = lazy_callable('pytorch3d.renderer', 'look_at_view_transform')
+look_at_rotation = lazy_callable('pytorch3d.renderer', 'look_at_rotation')
+RasterizationSettings = lazy_callable('pytorch3d.renderer', 'RasterizationSettings')
+MeshRenderer = lazy_callable('pytorch3d.renderer', 'MeshRenderer')
+MeshRasterizer = lazy_callable('pytorch3d.renderer', 'MeshRasterizer')
+BlendParams = lazy_callable('pytorch3d.renderer', 'BlendParams')
+SoftSilhouetteShader = lazy_callable('pytorch3d.renderer', 'SoftSilhouetteShader')
+HardPhongShader = lazy_callable('pytorch3d.renderer', 'HardPhongShader')
+PointLights = lazy_callable('pytorch3d.renderer', 'PointLights')
+TexturesVertex = lazy_callable('pytorch3d.renderer', 'TexturesVertex')
+barycentric_coordinates = lazy_callable('pytorch3d.renderer.mesh.rasterize_meshes', 'barycentric_coordinates')
+SoftDepthShader = lazy_callable('pytorch3d.renderer.mesh.shader', 'SoftDepthShader')
+HardFlatShader = lazy_callable('pytorch3d.renderer.mesh.shader', 'HardFlatShader')
+Textures = lazy_callable('pytorch3d.renderer.mesh.textures', 'Textures')
+Meshes = lazy_callable('pytorch3d.structures', 'Meshes')
+
 code_dir = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(code_dir)
 # sys.path.append(f"{code_dir}/mycpp/build")
-try:
-  import kornia
-except:
-  kornia = None
 try:
   import mycpp.build.mycpp as mycpp
 except:
@@ -51,12 +104,167 @@ try:
 except:
   common = None
 try:
-  import warp as wp
-  wp.init()
+  import warp as wp   # Initialized on the first kernel launch, see get_warp_device
 except:
   wp = None
 enable_timer = 0
 
+def get_default_device():
+  '''cuda when available, otherwise cpu
+  '''
+  return torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+
+
+def empty_device_cache(device):
+  vertex_buffers.clear()
+  device_constants.clear()
+  if torch.device(device).type=='cuda':
+    torch.cuda.empty_cache()
+
+
+class BufferPool(threading.local):
+  '''Scratch tensors reused across calls on the same thread, regrown when a call needs more
+  '''
+  def __init__(self):
+    self.buffers = {}
+
+
+  def get(self, name, shape, device, dtype=torch.float):
+    numel = int(np.prod(shape))
+    buf = self.buffers.get(name)
+    if buf is None or buf.device!=torch.device(device) or buf.dtype!=dtype or buf.numel()<numel:
+      buf = self.buffers[name] = None   # Old one freed before the larger one is allocated
+      buf = self.buffers[name] = torch.empty(numel, device=device, dtype=dtype)
+    return buf[:numel].view(*shape)
+
+
+  def clear(self):
+    self.buffers.clear()
+
+
+vertex_buffers = BufferPool()   # Vertex stage outputs of nvdiffrast_render, reused by the chunked calls of a batch
+
+
+class DeviceConstants:
+  '''Small host constants (np arrays, lists, numbers) copied to each device once and reused. A copy from pageable host memory
+  blocks until the device stream reaches it, so code running per render, chunk or predict takes its constants from here.
+  The returned tensors are shared, never modify them in place
+  '''
+  def __init__(self, max_size=256):
+    self.tensors = OrderedDict()
+    self.max_size = max_size
+    self.lock = threading.Lock()
+
+
+  def get(self, value, device, dtype=torch.float):
+    if isinstance(value, torch.Tensor):
+      return value.to(device=device, dtype=dtype)
+    value = np.ascontiguousarray(value)
+    key = (value.tobytes(), value.shape, value.dtype.str, str(torch.device(device)), dtype)
+    with self.lock:
+      tensor = self.tensors.get(key)
+      if tensor is not None:
+        self.tensors.move_to_end(key)
+        return tensor
+    tensor = torch.as_tensor(value, device=device, dtype=dtype)
+    if tensor.device.type=='cuda':
+      torch.cuda.current_stream(tensor.device).synchronize()   # Once per constant, the cached tensor is then safe to read from any stream
+    with self.lock:
+      self.tensors[key] = tensor
+      while len(self.tensors)>self.max_size:
+        self.tensors.popitem(last=False)
+    return tensor
+
+
+  def clear(self):
+    with self.lock:
+      self.tensors.clear()
+
+
+device_constants = DeviceConstants()   # Camera intrinsics, projections, crop boxes and normalizers of the render and predict paths
+
+
+class MemoryBudget:
+  '''Sizes the chunks of hypotheses that are cropped, rendered and inferred together, so a chunk fits a device memory budget.
+  The peak of a chunk is modeled as a fixed cost per call plus a cost per hypothesis. Both start from an estimate and are refit
+  from the latest chunks actually run, as the slope and offset across their sizes, so the fixed overhead of small calls
+  (e.g. the single pose refine of track_one) is not charged to the hypotheses of the large ones
+  '''
+  def __init__(self, budget_bytes=None, budget_fraction=0.5, bytes_per_item=None, max_chunk=1024, n_samples=32, min_items=16):
+    '''
+    @budget_bytes: fixed budget, default is budget_fraction of the memory available on the device when a chunk is sized
+    @bytes_per_item: initial estimate, until measured. None means max_chunk
+    @max_chunk: upper bound of the chunk size
+    @n_samples: number of latest chunks the costs are fit on, older ones age out
+    @min_items: while all the kept chunks have the same size, chunks smaller than this are too dominated by the fixed cost to be used
+    '''
+    self.budget_bytes = budget_bytes
+    self.budget_fraction = budget_fraction
+    self.bytes_per_item = bytes_per_item
+    self.measured_bytes_per_item = None
+    self.fixed_bytes = 0
+    self.samples = deque(maxlen=n_samples)
+    self.min_items = min_items
+    self.max_chunk = max_chunk
+
+
+  def get_budget(self, device):
+    if self.budget_bytes is not None:
+      return self.budget_bytes
+    device = torch.device(device)
+    if device.type=='cuda':
+      free, _ = torch.cuda.mem_get_info(device)
+      available = free+torch.cuda.memory_reserved(device)-torch.cuda.memory_allocated(device)
+    else:
+      available = psutil.virtual_memory().available
+    return available*self.budget_fraction
+
+
+  def chunk_size(self, device, multiple=1):
+    '''@multiple: the chunk is a multiple of this, e.g. a group of poses that must be inferred together. At least one multiple is returned even over budget
+    '''
+    per_item = self.measured_bytes_per_item if self.measured_bytes_per_item is not None else self.bytes_per_item
+    n = self.max_chunk if per_item is None else int(max(self.get_budget(device)-self.fixed_bytes, 0)//max(per_item, 1))
+    n = min(n, self.max_chunk)
+    return max(n//multiple, 1)*multiple
+
+
+  def fit(self):
+    '''Refit the fixed and per hypothesis costs on the kept chunks, keeps the previous fit when they do not tell them apart
+    '''
+    samples = np.asarray(self.samples, dtype=float)
+    n_items, peaks = samples[:,0], samples[:,1]
+    if len(np.unique(n_items))>=2:
+      slope = np.polyfit(n_items, peaks, 1)[0]
+      if slope>0:
+        self.measured_bytes_per_item = float(slope)
+        self.fixed_bytes = max(float((peaks-slope*n_items).max()), 0)   # Upper envelope, every kept chunk fits
+        return
+    large = n_items>=self.min_items
+    if large.any():
+      self.measured_bytes_per_item = float((peaks[large]/n_items[large]).max())
+      self.fixed_bytes = 0
+
+
+  @contextmanager
+  def measure(self, device, n_items):
+    '''Record the peak memory of the enclosed work on n_items hypotheses, only on cuda
+    '''
+    device = torch.device(device)
+    if device.type!='cuda' or n_items==0:
+      yield
+      return
+    from instrumentation import peak_memory   # Shares the device peak counter with the spans of every thread
+    base = torch.cuda.memory_allocated(device)
+    scope = peak_memory.start(device)
+    try:
+      yield
+    finally:
+      peak = peak_memory.stop(scope)
+    self.samples.append((n_items, peak-base))
+    self.fit()
+
+
 def NestDict():
   return defaultdict(NestDict)
 
@@ -96,12 +304,100 @@ def set_logging_format(level=logging.INFO):
   FORMAT = '[%(funcName)s()] %(message)s'
   logging.basicConfig(level=level, format=FORMAT)
 
-set_logging_format()
 
 
 
 
-def make_mesh_tensors(mesh, device='cuda', max_tex_size=None):
+def decimate_mesh(mesh, n_faces):
+  '''Quadric decimation
+  @return: decimated trimesh, and for each of its vertices the nearest original vertex to carry vertex colors over
+  '''
+  simple = mesh.simplify_quadric_decimation(face_count=int(n_faces))
+  simple = trimesh.Trimesh(vertices=simple.vertices, faces=simple.faces, process=False)
+  _, nearest = cKDTree(mesh.vertices).query(simple.vertices)
+  return simple, nearest
+
+
+def surface_error(mesh, simple, n_sample=20000, percentile=99):
+  '''Two sided distance between the original surface and the decimated one, exact closest point distances of points sampled on each to the other
+  @return: meters, the larger of both directions
+  '''
+  errors = []
+  for src,dst in [(mesh, simple), (simple, mesh)]:
+    pts = trimesh.sample.sample_surface(src, n_sample, seed=0)[0] if len(src.faces)>0 else src.vertices
+    _, dists, _ = trimesh.proximity.closest_point(dst, pts)
+    errors.append(float(np.percentile(dists, percentile)))
+  return max(errors)
+
+
+def make_lod_tensors(mesh, mesh_tensors, lod_min_faces, lod_ratio=0.25):
+  '''LOD pyramid for hypothesis rendering, stored flat in mesh_tensors as lod{i}/pos, lod{i}/faces, ... (i>=1, level 0 is the mesh itself)
+  plus lod_errors (n_levels,) the geometric error of each level in meters, see select_lod_level.
+  Textured meshes only get level 0: decimation does not keep UV seams, copying uvs from the nearest original vertex would smear the texture across them
+  '''
+  device = mesh_tensors['pos'].device
+  errors = [0.0]
+  if 'tex' in mesh_tensors:
+    logging.info("WARN: textured mesh, no LOD pyramid is built and hypotheses are rendered from the full mesh. LOD needs a vertex colored mesh")
+    mesh_tensors['lod_errors'] = torch.tensor(errors, device=device, dtype=torch.float)
+    return mesh_tensors
+  n_faces = len(mesh.faces)*lod_ratio
+  while n_faces>=lod_min_faces:
+    try:
+      simple, nearest = decimate_mesh(mesh, n_faces)
+    except Exception as e:
+      logging.info(f"WARN: quadric decimation failed, {e}")
+      break
+    level = len(errors)
+    prefix = f'lod{level}/'
+    nearest = torch.as_tensor(nearest, device=device, dtype=torch.long)
+    mesh_tensors[prefix+'pos'] = torch.tensor(simple.vertices, device=device, dtype=torch.float)
+    mesh_tensors[prefix+'faces'] = torch.tensor(simple.faces, device=device, dtype=torch.int)
+    mesh_tensors[prefix+'vnormals'] = torch.tensor(simple.vertex_normals, device=device, dtype=torch.float)
+    mesh_tensors[prefix+'vertex_color'] = mesh_tensors['vertex_color'][nearest]
+    errors.append(max(surface_error(mesh, simple), errors[-1]))   # Monotone so select_lod_level can count levels
+    logging.info(f"lod {level}: {len(simple.faces)} faces, error {errors[-1]*1000:.3f}mm")
+    if len(simple.faces)*lod_ratio>=n_faces:
+      break
+    n_faces = len(simple.faces)*lod_ratio
+  mesh_tensors['lod_errors'] = torch.tensor(errors, device=device, dtype=torch.float)
+  return mesh_tensors
+
+
+def get_lod_tensors(mesh_tensors, level):
+  '''@return: mesh tensors of one LOD level in the layout of make_mesh_tensors, without the pyramid
+  '''
+  if level==0:
+    return {k: v for k,v in mesh_tensors.items() if '/' not in k and k!='lod_errors'}
+  prefix = f'lod{level}/'
+  return {k[len(prefix):]: v for k,v in mesh_tensors.items() if k.startswith(prefix)}
+
+
+def crop_px_per_meter(output_size, crop_ratio, mesh_diameter, min_depth_ratio=1):
+  '''Output pixels per meter of box_3d crops (compute_crop_window_tf_batch) at the closest point of the object.
+  A crop spans crop_ratio*mesh_diameter at the object center whatever K and the depth, the closest point is magnified by z/(z-mesh_diameter/2),
+  bounded by taking the object center at least min_depth_ratio diameters away. Nothing here depends on the poses, so it is known before rendering
+  '''
+  z = min_depth_ratio*mesh_diameter
+  return max(output_size)/(crop_ratio*mesh_diameter)*z/(z-mesh_diameter/2)
+
+
+def select_lod_level(lod_errors, px_per_meter, tol_px=0.5):
+  '''Coarsest level whose geometric error projects to at most tol_px output pixels. Host only, never waits on the device
+  @lod_errors: host array, the lod_errors of make_lod_tensors. None when the mesh has no pyramid
+  @px_per_meter: at the closest point of the object, e.g. crop_px_per_meter
+  '''
+  if lod_errors is None or len(lod_errors)<=1:
+    return 0
+  return int((np.asarray(lod_errors)*px_per_meter<=tol_px).sum())-1
+
+
+def make_mesh_tensors(mesh, device=None, max_tex_size=None, lod_min_faces=None, lod_ratio=0.25):
+  '''
+  @lod_min_faces: build a LOD pyramid (see make_lod_tensors) whose levels keep lod_ratio of the faces of the previous one and at least this many. None renders the full mesh only
+  '''
+  if device is None:
+    device = get_default_device()
   mesh_tensors = {}
   if isinstance(mesh.visual, trimesh.visual.texture.TextureVisuals):
     img = np.array(mesh.visual.material.image.convert('RGB'))
@@ -127,10 +423,79 @@ def make_mesh_tensors(mesh, device='cuda', max_tex_size=None):
     'faces': torch.tensor(mesh.faces, device=device, dtype=torch.int),
     'vnormals': torch.tensor(mesh.vertex_normals, device=device, dtype=torch.float),
   })
+  if lod_min_faces is not None:
+    make_lod_tensors(mesh, mesh_tensors, lod_min_faces=lod_min_faces, lod_ratio=lod_ratio)
   return mesh_tensors
 
 
-def nvdiffrast_render(K=None, H=None, W=None, ob_in_cams=None, glctx=None, context='cuda', get_normal=False, mesh_tensors=None, mesh=None, projection_mat=None, bbox2d=None, output_size=None, use_light=False, light_color=None, light_dir=np.array([0,0,1]), light_pos=np.array([0,0,0]), w_ambient=0.8, w_diffuse=0.5, extra={}):
+def make_raster_context(device, context='cuda'):
+  '''nvdiffrast on cuda, the torch software rasterizer otherwise or when context is torch
+  '''
+  device = torch.device(device)
+  if context=='torch' or device.type!='cuda':
+    return TorchRasterizeContext(device)
+  if context=='gl':
+    return dr.RasterizeGLContext()
+  if context=='cuda':
+    return dr.RasterizeCudaContext(device)
+  raise NotImplementedError
+
+
+def get_raster_ops(glctx):
+  '''Render backend of a context: contexts bringing their own rasterize/interpolate/texture (see torch_rasterizer.py) use them, nvdiffrast's otherwise
+  @return: rasterize(pos, tri, resolution), interpolate(attr, rast, tri), texture(tex, uv, filter_mode)
+  '''
+  if hasattr(glctx, 'rasterize'):
+    return glctx.rasterize, glctx.interpolate, glctx.texture
+  rasterize = lambda pos, tri, resolution: dr.rasterize(glctx, pos, tri, resolution=resolution)
+  return rasterize, dr.interpolate, dr.texture
+
+
+def transform_vertices_batch(pos, mats, buffers=None, name='gemm'):
+  '''Vertices through per pose affine/projective transforms as one GEMM over all poses, instead of a broadcast (B,V,4,4)@(V,4,1) matmul
+  @pos: (V,3)
+  @mats: (B,R,4) rows of the transforms, the output has R channels
+  @buffers: BufferPool holding the GEMM output, None allocates
+  @return: (B,V,R) view, not contiguous
+  '''
+  B,R = mats.shape[:2]
+  V = len(pos)
+  out = buffers.get(name, (B*R,V), device=pos.device) if buffers is not None else None
+  out = torch.addmm(mats[...,3].reshape(B*R,1), mats[...,:3].reshape(B*R,3), pos.T, out=out)
+  return out.reshape(B,R,V).transpose(1,2)
+
+
+def vertex_stage(pos, vnormals, ob_in_cams, mtx, get_normal=True, get_pts_cam=True, buffers=vertex_buffers):
+  '''Camera frame points, clip coordinates and camera frame normals of every pose.
+  Points and clip coordinates share one GEMM with the camera and clip transforms stacked, normals take a second one
+  @mtx: (B,4,4) or (1,4,4) object to clip space
+  @buffers: BufferPool the outputs are written to, None allocates
+  @return: pts_cam (B,V,3) or None, pos_clip (B,V,4), vnormals_cam (B,V,3) or None, contiguous as nvdiffrast wants
+  '''
+  B = len(ob_in_cams)
+  V = len(pos)
+  alloc = buffers.get if buffers is not None else (lambda name, shape, device: torch.empty(shape, device=device))
+  pts_cam = None
+  if get_pts_cam:
+    mats = torch.cat([ob_in_cams[:,:3].float(), mtx.expand(B,4,4)], dim=1)   #(B,7,4)
+    out = transform_vertices_batch(pos, mats, buffers=buffers)
+    pts_cam = alloc('pts_cam', (B,V,3), device=pos.device).copy_(out[...,:3])
+    out = out[...,3:]
+  else:
+    out = transform_vertices_batch(pos, mtx.expand(B,4,4), buffers=buffers)
+  pos_clip = alloc('pos_clip', (B,V,4), device=pos.device).copy_(out)
+  vnormals_cam = None
+  if get_normal:
+    rot = F.pad(ob_in_cams[:,:3,:3].float(), (0,1))   # No translation for directions
+    out = transform_vertices_batch(vnormals, rot, buffers=buffers)
+    vnormals_cam = alloc('vnormals_cam', (B,V,3), device=pos.device).copy_(out)
+  return pts_cam, pos_clip, vnormals_cam
+
+
+RENDER_MODES = ['color', 'geometry', 'silhouette']
+
+
+def nvdiffrast_render(K=None, H=None, W=None, ob_in_cams=None, glctx=None, context='cuda', get_normal=False, mesh_tensors=None, mesh=None, projection_mat=None, bbox2d=None, output_size=None, use_light=False, light_color=None, light_dir=np.array([0,0,1]), light_pos=np.array([0,0,0]), w_ambient=0.8, w_diffuse=0.5, extra={}, lod_level=0, mode='color'):
   '''Just plain rendering, not support any gradient
   @K: (3,3) np array
   @ob_in_cams: (N,4,4) torch tensor, openCV camera
@@ -139,86 +504,122 @@ def nvdiffrast_render(K=None, H=None, W=None, ob_in_cams=None, glctx=None, conte
   @bbox2d: (N,4) (umin,vmin,umax,vmax) if only roi need to render.
   @light_dir: in cam space
   @light_pos: in cam space
+  @glctx: nvdiffrast context, or TorchRasterizeContext to render without nvdiffrast (any device)
+  @context: kind of context made when glctx is None, cuda/gl/torch. Poses off cuda always use the torch rasterizer
+  @lod_level: level of the LOD pyramid in mesh_tensors to render, chosen by the caller once per batch with select_lod_level. 0 is the full mesh
+  @mode: color renders everything. geometry skips colors, textures and lighting, color is None. silhouette only rasterizes, color and depth are None.
+         Every mode sets extra['mask'] (N,H,W) bool, geometry and color also extra['xyz_map']
   '''
+  if mode not in RENDER_MODES:
+    raise RuntimeError(f'unknown render mode {mode}, expected one of {RENDER_MODES}')
+  device = ob_in_cams.device
   if glctx is None:
-    if context == 'gl':
-      glctx = dr.RasterizeGLContext()
-    elif context=='cuda':
-      glctx = dr.RasterizeCudaContext()
-    else:
-      raise NotImplementedError
+    glctx = make_raster_context(device, context=context)
     logging.info("created context")
+  if device.type!='cuda' and not isinstance(glctx, TorchRasterizeContext):
+    raise RuntimeError(f'nvdiffrast rasterizes on cuda only, got poses on {device}')
+  rasterize, interpolate, texture = get_raster_ops(glctx)
 
   if mesh_tensors is None:
-    mesh_tensors = make_mesh_tensors(mesh)
-  pos = mesh_tensors['pos']
-  vnormals = mesh_tensors['vnormals']
-  pos_idx = mesh_tensors['faces']
-  has_tex = 'tex' in mesh_tensors
+    mesh_tensors = make_mesh_tensors(mesh, device=device)
 
-  ob_in_glcams = torch.tensor(glcam_in_cvcam, device='cuda', dtype=torch.float)[None]@ob_in_cams
+  ob_in_glcams = device_constants.get(glcam_in_cvcam, device)[None]@ob_in_cams
   if projection_mat is None:
     projection_mat = projection_matrix_from_intrinsics(K, height=H, width=W, znear=0.001, zfar=100)
-  projection_mat = torch.as_tensor(projection_mat.reshape(-1,4,4), device='cuda', dtype=torch.float)
+  projection_mat = device_constants.get(projection_mat, device).reshape(-1,4,4)
   mtx = projection_mat@ob_in_glcams
 
   if output_size is None:
     output_size = np.asarray([H,W])
 
-  pts_cam = transform_pts(pos, ob_in_cams)
-  pos_homo = to_homo_torch(pos)
-  pos_clip = (mtx[:,None]@pos_homo[None,...,None])[...,0]
+  if lod_level>0:
+    mesh_tensors = get_lod_tensors(mesh_tensors, lod_level)
+  pos = mesh_tensors['pos']
+  vnormals = mesh_tensors['vnormals']
+  pos_idx = mesh_tensors['faces']
+  has_tex = 'tex' in mesh_tensors
+
   if bbox2d is not None:
     l = bbox2d[:,0]
     t = H-bbox2d[:,1]
     r = bbox2d[:,2]
     b = H-bbox2d[:,3]
-    tf = torch.eye(4, dtype=torch.float, device='cuda').reshape(1,4,4).expand(len(ob_in_cams),4,4).contiguous()
+    tf = torch.eye(4, dtype=torch.float, device=device).reshape(1,4,4).expand(len(ob_in_cams),4,4).contiguous()
     tf[:,0,0] = W/(r-l)
     tf[:,1,1] = H/(t-b)
     tf[:,3,0] = (W-r-l)/(r-l)
     tf[:,3,1] = (H-t-b)/(t-b)
-    pos_clip = pos_clip@tf
-  rast_out, _ = dr.rasterize(glctx, pos_clip, pos_idx, resolution=np.asarray(output_size))
-  xyz_map, _ = dr.interpolate(pts_cam, rast_out, pos_idx)
-  depth = xyz_map[...,2]
-  if has_tex:
-    texc, _ = dr.interpolate(mesh_tensors['uv'], rast_out, mesh_tensors['uv_idx'])
-    color = dr.texture(mesh_tensors['tex'], texc, filter_mode='linear')
-  else:
-    color, _ = dr.interpolate(mesh_tensors['vertex_color'], rast_out, pos_idx)
-
+    mtx = tf.transpose(1,2)@mtx   # Roi folded into the clip transform, pos_clip@tf for row vectors
+  if mode!='color':
+    use_light = False
+  if mode=='silhouette':
+    get_normal = False
   if use_light:
     get_normal = True
+  pts_cam, pos_clip, vnormals_cam = vertex_stage(pos, vnormals, ob_in_cams, mtx, get_normal=get_normal, get_pts_cam=mode!='silhouette')
+  rast_out, _ = rasterize(pos_clip, pos_idx, resolution=np.asarray(output_size))
+  extra['mask'] = torch.flip(rast_out[...,3]>0, dims=[1])
+  if mode=='silhouette':
+    return None, None, None
+
+  xyz_map, _ = interpolate(pts_cam, rast_out, pos_idx)
+  depth = xyz_map[...,2]
+  extra['xyz_map'] = torch.flip(xyz_map, dims=[1])
+  depth = torch.flip(depth, dims=[1])
+
   if get_normal:
-    vnormals_cam = transform_dirs(vnormals, ob_in_cams)
-    normal_map, _ = dr.interpolate(vnormals_cam, rast_out, pos_idx)
+    normal_map, _ = interpolate(vnormals_cam, rast_out, pos_idx)
     normal_map = F.normalize(normal_map, dim=-1)
     normal_map = torch.flip(normal_map, dims=[1])
   else:
     normal_map = None
+  if mode=='geometry':
+    return None, depth, normal_map
+
+  if has_tex:
+    texc, _ = interpolate(mesh_tensors['uv'], rast_out, mesh_tensors['uv_idx'])
+    color = texture(mesh_tensors['tex'], texc, filter_mode='linear')
+  else:
+    color, _ = interpolate(mesh_tensors['vertex_color'], rast_out, pos_idx)
 
   if use_light:
     if light_dir is not None:
-      light_dir_neg = -torch.as_tensor(light_dir, dtype=torch.float, device='cuda')
+      light_dir_neg = -device_constants.get(light_dir, device)
     else:
-      light_dir_neg = torch.as_tensor(light_pos, dtype=torch.float, device='cuda').reshape(1,1,3) - pts_cam
+      light_dir_neg = device_constants.get(light_pos, device).reshape(1,1,3) - pts_cam
     diffuse_intensity = (F.normalize(vnormals_cam, dim=-1) * F.normalize(light_dir_neg, dim=-1)).sum(dim=-1).clip(0, 1)[...,None]
-    diffuse_intensity_map, _ = dr.interpolate(diffuse_intensity, rast_out, pos_idx)  # (N_pose, H, W, 1)
+    diffuse_intensity_map, _ = interpolate(diffuse_intensity, rast_out, pos_idx)  # (N_pose, H, W, 1)
     if light_color is None:
       light_color = color
     else:
-      light_color = torch.as_tensor(light_color, device='cuda', dtype=torch.float)
+      light_color = device_constants.get(light_color, device)
     color = color*w_ambient + diffuse_intensity_map*light_color*w_diffuse
 
   color = color.clip(0,1)
   color = color * torch.clamp(rast_out[..., -1:], 0, 1) # Mask out background using alpha
   color = torch.flip(color, dims=[1])   # Flip Y coordinates
-  depth = torch.flip(depth, dims=[1])
-  extra['xyz_map'] = torch.flip(xyz_map, dims=[1])
   return color, depth, normal_map
 
 
+def render_geometry(ob_in_cams, mesh_tensors, glctx=None, get_normal=False, **kwargs):
+  '''Depth, xyz and mask only, for consumers that never look at colors, e.g. geometric pre-filters or ICP style verification.
+  Takes the other args of nvdiffrast_render
+  @return: depth (N,H,W), xyz_map (N,H,W,3), mask (N,H,W) bool, normal_map (N,H,W,3) or None
+  '''
+  extra = kwargs.pop('extra', {})
+  _, depth, normal_map = nvdiffrast_render(ob_in_cams=ob_in_cams, mesh_tensors=mesh_tensors, glctx=glctx, get_normal=get_normal, extra=extra, mode='geometry', **kwargs)
+  return depth, extra['xyz_map'], extra['mask'], normal_map
+
+
+def render_silhouette(ob_in_cams, mesh_tensors, glctx=None, **kwargs):
+  '''Object masks only, nothing is interpolated. Takes the other args of nvdiffrast_render
+  @return: (N,H,W) bool
+  '''
+  extra = kwargs.pop('extra', {})
+  nvdiffrast_render(ob_in_cams=ob_in_cams, mesh_tensors=mesh_tensors, glctx=glctx, extra=extra, mode='silhouette', **kwargs)
+  return extra['mask']
+
+
 def set_seed(random_seed):
   import torch,random
   np.random.seed(random_seed)
@@ -342,13 +743,33 @@ if wp is not None:
     if sum_weight>0 and num_valid>0:
       out[h,w] = sum/sum_weight
 
-  def bilateral_filter_depth(depth, radius=2, zfar=100, sigmaD=2, sigmaR=100000, device='cuda'):
-    if isinstance(depth, np.ndarray):
-      depth_wp = wp.array(depth, dtype=float, device=device)
-    else:
-      depth_wp = wp.from_torch(depth)
-    out_wp = wp.zeros(depth.shape, dtype=float, device=device)
-    wp.launch(kernel=bilateral_filter_depth_kernel, device=device, dim=[depth.shape[0], depth.shape[1]], inputs=[depth_wp, out_wp, radius, zfar, sigmaD, sigmaR])
+  def get_warp_device(depth, device):
+    '''Run the kernel where the depth lives, np inputs go to the default device
+    '''
+    wp.init()   # No-op once initialized
+    if device is None:
+      device = depth.device if torch.is_tensor(depth) else get_default_device()
+    return str(torch.device(device))
+
+
+  def warp_stream(device):
+    '''Warp work on the current torch stream of the device, so it stays ordered with the torch ops around it whatever stream they run on
+    '''
+    device = torch.device(device)
+    if device.type!='cuda':
+      return nullcontext()
+    return wp.ScopedStream(wp.stream_from_torch(torch.cuda.current_stream(device)))
+
+
+  def bilateral_filter_depth(depth, radius=2, zfar=100, sigmaD=2, sigmaR=100000, device=None):
+    device = get_warp_device(depth, device)
+    with warp_stream(device):
+      if isinstance(depth, np.ndarray):
+        depth_wp = wp.array(depth, dtype=float, device=device)
+      else:
+        depth_wp = wp.from_torch(depth)
+      out_wp = wp.zeros(depth.shape, dtype=float, device=device)
+      wp.launch(kernel=bilateral_filter_depth_kernel, device=device, dim=[depth.shape[0], depth.shape[1]], inputs=[depth_wp, out_wp, radius, zfar, sigmaD, sigmaR])
     depth_out = wp.to_torch(out_wp)
 
     if isinstance(depth, np.ndarray):
@@ -384,10 +805,12 @@ if wp is not None:
       out[h,w] = d_ori
 
 
-  def erode_depth(depth, radius=2, depth_diff_thres=0.001, ratio_thres=0.8, zfar=100, device='cuda'):
-    depth_wp = wp.from_torch(torch.as_tensor(depth, dtype=torch.float, device=device))
-    out_wp = wp.zeros(depth.shape, dtype=float, device=device)
-    wp.launch(kernel=erode_depth_kernel, device=device, dim=[depth.shape[0], depth.shape[1]], inputs=[depth_wp, out_wp, radius, depth_diff_thres, ratio_thres, zfar],)
+  def erode_depth(depth, radius=2, depth_diff_thres=0.001, ratio_thres=0.8, zfar=100, device=None):
+    device = get_warp_device(depth, device)
+    with warp_stream(device):
+      depth_wp = wp.from_torch(torch.as_tensor(depth, dtype=torch.float, device=device))
+      out_wp = wp.zeros(depth.shape, dtype=float, device=device)
+      wp.launch(kernel=erode_depth_kernel, device=device, dim=[depth.shape[0], depth.shape[1]], inputs=[depth_wp, out_wp, radius, depth_diff_thres, ratio_thres, zfar],)
     depth_out = wp.to_torch(out_wp)
 
     if isinstance(depth, np.ndarray):
@@ -425,9 +848,9 @@ def depth2xyzmap_batch(depths, Ks, zfar):
   bs = depths.shape[0]
   invalid_mask = (depths<0.001) | (depths>zfar)
   H,W = depths.shape[-2:]
-  vs,us = torch.meshgrid(torch.arange(0,H),torch.arange(0,W), indexing='ij')
-  vs = vs.reshape(-1).float().cuda()[None].expand(bs,-1)
-  us = us.reshape(-1).float().cuda()[None].expand(bs,-1)
+  vs,us = torch.meshgrid(torch.arange(0,H,device=depths.device),torch.arange(0,W,device=depths.device), indexing='ij')
+  vs = vs.reshape(-1).float()[None].expand(bs,-1)
+  us = us.reshape(-1).float()[None].expand(bs,-1)
   zs = depths.reshape(bs,-1)
   Ks = Ks[:,None].expand(bs,zs.shape[-1],3,3)
   xs = (us-Ks[...,0,2])*zs/Ks[...,0,0]  #(B,N)
@@ -578,6 +1001,7 @@ def compute_crop_window_tf_batch(pts=None, H=None, W=None, poses=None, K=None, c
   '''Project the points and find the cropping transform
   @pts: (N,3)
   @poses: (B,4,4) tensor
+  @K: (3,3) or per pose (B,3,3)
   @min_box: min_box/min_circle
   @scale: scale to apply to the tightly enclosing roi
   '''
@@ -588,27 +1012,26 @@ def compute_crop_window_tf_batch(pts=None, H=None, W=None, poses=None, K=None, c
     top = top.round()
     bottom = bottom.round()
 
-    tf = torch.eye(3)[None].expand(B,-1,-1).contiguous()
+    tf = torch.eye(3, device=poses.device)[None].expand(B,-1,-1).contiguous()
     tf[:,0,2] = -left
     tf[:,1,2] = -top
-    new_tf = torch.eye(3)[None].expand(B,-1,-1).contiguous()
+    new_tf = torch.eye(3, device=poses.device)[None].expand(B,-1,-1).contiguous()
     new_tf[:,0,0] = out_size[0]/(right-left)
     new_tf[:,1,1] = out_size[1]/(bottom-top)
     tf = new_tf@tf
     return tf
 
   B = len(poses)
-  torch.set_default_tensor_type('torch.cuda.FloatTensor')
   if method=='box_3d':
     radius = mesh_diameter*crop_ratio/2
-    offsets = torch.tensor([0,0,0,
-                        radius,0,0,
-                        -radius,0,0,
-                        0,radius,0,
-                        0,-radius,0]).reshape(-1,3)
+    axes = torch.eye(3, dtype=torch.float, device=poses.device)[:2]*radius   # Made on the device, no host to device copy per call
+    offsets = torch.cat([torch.zeros((1,3), dtype=torch.float, device=poses.device), axes, -axes], dim=0)
     pts = poses[:,:3,3].reshape(-1,1,3)+offsets.reshape(1,-1,3)
-    K = torch.as_tensor(K)
-    projected = (K@pts.reshape(-1,3).T).T
+    K = device_constants.get(K, pts.device)
+    if K.ndim==3:   # Per pose intrinsics (B,3,3)
+      projected = (K[:,None]@pts[...,None])[...,0].reshape(-1,3)
+    else:
+      projected = (K@pts.reshape(-1,3).T).T
     uvs = projected[:,:2]/projected[:,2:3]
     uvs = uvs.reshape(B, -1, 2)
     center = uvs[:,0]  #(B,2)
@@ -627,6 +1050,23 @@ def compute_crop_window_tf_batch(pts=None, H=None, W=None, poses=None, K=None, c
 
 
 
+def warp_perspective_frames(imgs, tf_to_crops, dsize, mode='bilinear', frame_ids=None):
+  '''Warp full frames into per pose crops without materializing a full frame per pose
+  @imgs: (C,H,W) tensor, or (F,C,H,W) when frame_ids is given
+  @tf_to_crops: (B,3,3)
+  @frame_ids: (B,) index into imgs of each pose
+  '''
+  B = len(tf_to_crops)
+  if frame_ids is None:
+    return kornia.geometry.transform.warp_perspective(imgs[None].expand(B,-1,-1,-1), tf_to_crops, dsize=dsize, mode=mode, align_corners=False)
+  out = torch.zeros((B, imgs.shape[1], dsize[0], dsize[1]), dtype=imgs.dtype, device=imgs.device)
+  for f in torch.unique(frame_ids).tolist():
+    ids = torch.where(frame_ids==f)[0]
+    out[ids] = kornia.geometry.transform.warp_perspective(imgs[f][None].expand(len(ids),-1,-1,-1), tf_to_crops[ids], dsize=dsize, mode=mode, align_corners=False)
+  return out
+
+
+
 def cv_draw_text(img,text,uv_top_left,color=(255, 255, 255),fontScale=0.5,thickness=1,fontFace=cv2.FONT_HERSHEY_SIMPLEX,outline_color=None,line_spacing=1.5):
   H,W = img.shape[:2]
   uv_top_left = np.array(uv_top_left, dtype=float)
@@ -802,6 +1242,24 @@ def projection_matrix_from_intrinsics(K, height, width, znear, zfar, window_coor
   return proj
 
 
+def projection_matrix_from_intrinsics_batch(Ks, height, width, znear, zfar):
+  '''Torch version of projection_matrix_from_intrinsics with window_coords='y_down', stays on the device of Ks
+  @Ks: (B,3,3) tensor
+  @return: (B,4,4) tensor
+  '''
+  depth = float(zfar - znear)
+  proj = torch.zeros((len(Ks),4,4), dtype=torch.float, device=Ks.device)
+  proj[:,0,0] = 2*Ks[:,0,0]/width
+  proj[:,0,1] = -2*Ks[:,0,1]/width
+  proj[:,0,2] = (-2*Ks[:,0,2]+width)/width
+  proj[:,1,1] = 2*Ks[:,1,1]/height
+  proj[:,1,2] = (2*Ks[:,1,2]-height)/height
+  proj[:,2,2] = -(zfar+znear)/depth
+  proj[:,2,3] = -2*(zfar*znear)/depth
+  proj[:,3,2] = -1
+  return proj
+
+
 
 def symmetry_tfs_from_info(info, rot_angle_discrete=5):
   symmetry_tfs = [np.eye(4)]
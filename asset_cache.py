@@ -0,0 +1,208 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+import os,hashlib,logging,uuid,shutil,tempfile
+import numpy as np
+import torch
+import trimesh
+
+code_dir = os.path.dirname(os.path.realpath(__file__))
+
+ASSET_CACHE_VERSION = 3   # 2: no LOD pyramid for textured meshes, 3: exact two sided LOD errors
+DEFAULT_CACHE_DIR = os.getenv('FOUNDATIONPOSE_CACHE_DIR', f'{code_dir}/cache')
+
+
+def hash_arrays(*arrays, extra=None):
+  '''Content hash of a list of arrays (dtype, shape and bytes) plus any extra params
+  '''
+  h = hashlib.sha1()
+  for arr in arrays:
+    if arr is None:
+      h.update(b'none')
+      continue
+    arr = np.ascontiguousarray(arr)
+    h.update(str(arr.dtype).encode())
+    h.update(str(arr.shape).encode())
+    h.update(arr.tobytes())
+  if extra is not None:
+    h.update(repr(extra).encode())
+  return h.hexdigest()
+
+
+def mesh_texture_array(mesh):
+  '''@return: (H,W,3) uint8 texture image or None if the mesh is not textured
+  '''
+  if isinstance(mesh.visual, trimesh.visual.texture.TextureVisuals) and mesh.visual.material.image is not None:
+    return np.array(mesh.visual.material.image.convert('RGB'))[...,:3]
+  return None
+
+
+def mesh_tensors_to_arrays(mesh_tensors):
+  '''Pack the output of make_mesh_tensors to host arrays, texture is kept in uint8
+  '''
+  arrays = {}
+  for k in mesh_tensors:
+    if not torch.is_tensor(mesh_tensors[k]):
+      continue
+    v = mesh_tensors[k].data.cpu()
+    if k=='tex':
+      v = (v*255).round().clip(0,255).to(torch.uint8)
+    arrays[k] = v.numpy()
+  return arrays
+
+
+def arrays_to_mesh_tensors(arrays, device='cuda'):
+  mesh_tensors = {}
+  for k in arrays:
+    v = torch.as_tensor(arrays[k], device=device)
+    if k=='tex':
+      v = v.float()/255.0
+    mesh_tensors[k] = v
+  return mesh_tensors
+
+
+class ObjectAssetCache:
+  '''Persistent cache of everything FoundationPose.reset_object derives from a mesh.
+  Entries are uncompressed npz files named by the content hash of the mesh and the voxelization params,
+  so a hit only costs reading a few arrays from disk.
+  '''
+  def __init__(self, cache_dir=None, enabled=True):
+    '''
+    @cache_dir: default is $FOUNDATIONPOSE_CACHE_DIR/object_assets, or cache/object_assets in the repo
+    @enabled: False never reads or writes assets, exported meshes then go to a content addressed dir under the system temp dir
+    '''
+    if cache_dir is None:
+      cache_dir = f'{DEFAULT_CACHE_DIR}/object_assets'
+    self.cache_dir = cache_dir
+    self.enabled = enabled
+    if self.enabled:
+      try:
+        os.makedirs(self.cache_dir, exist_ok=True)
+      except OSError as e:
+        logging.info(f"WARN: cannot create asset cache dir {self.cache_dir}, {e}. Asset cache disabled")
+        self.enabled = False
+
+
+  def make_key(self, mesh, model_normals=None, **params):
+    tex = mesh_texture_array(mesh)
+    uv = None
+    vertex_colors = None
+    if tex is not None:
+      uv = mesh.visual.uv
+    elif isinstance(mesh.visual, trimesh.visual.color.ColorVisuals) and mesh.visual.kind=='vertex':
+      vertex_colors = mesh.visual.vertex_colors
+    extra = dict(version=ASSET_CACHE_VERSION, **params)
+    return hash_arrays(mesh.vertices, mesh.faces, model_normals, uv, tex, vertex_colors, extra=sorted(extra.items()))
+
+
+  def get_file(self, key):
+    return f'{self.cache_dir}/{key}.npz'
+
+
+  def get_mesh_file(self, key):
+    if not self.enabled:
+      return f'{tempfile.gettempdir()}/foundationpose_meshes/{key}/mesh.obj'
+    return f'{self.cache_dir}/{key}/mesh.obj'
+
+
+  def load(self, key):
+    '''@return: dict of np arrays or None on miss
+    '''
+    if not self.enabled:
+      return None
+    file = self.get_file(key)
+    if not os.path.exists(file):
+      return None
+    try:
+      with np.load(file, allow_pickle=False) as data:
+        assets = {k: data[k] for k in data.files}
+    except Exception as e:
+      logging.info(f"WARN: failed to load asset cache {file}, {e}")
+      return None
+    logging.info(f"asset cache hit {file}")
+    return assets
+
+
+  def save(self, key, assets):
+    if not self.enabled:
+      return
+    file = self.get_file(key)
+    tmp_file = f'{file}.{uuid.uuid4().hex}.tmp.npz'
+    np.savez(tmp_file, **assets)
+    os.replace(tmp_file, file)   # Atomic so concurrent processes never read a partial file
+    logging.info(f"asset cache saved {file}")
+
+
+  def export_mesh(self, key, mesh):
+    '''Content addressed mesh export, only written once per key. Each key gets its own dir since obj export also writes material/texture files next to it
+    '''
+    file = self.get_mesh_file(key)
+    if not os.path.exists(file):
+      out_dir = os.path.dirname(file)
+      tmp_dir = f'{out_dir}.{uuid.uuid4().hex}.tmp'
+      os.makedirs(tmp_dir, exist_ok=True)   # Also makes the parent dir
+      mesh.export(f'{tmp_dir}/mesh.obj')
+      try:
+        os.replace(tmp_dir, out_dir)
+      except OSError:   # Another process won the race
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return file
+
+
+
+class RotationGridCache:
+  '''Clustered rotation hypothesis grids keyed by (min_n_views, inplane_step, symmetry tfs).
+  The in-memory table is shared by every instance in the process, disk storage is used when cache_dir is given
+  '''
+  _memory = {}
+
+  def __init__(self, cache_dir=None):
+    self.cache_dir = cache_dir
+    if self.cache_dir is not None:
+      os.makedirs(self.cache_dir, exist_ok=True)
+
+
+  def make_key(self, min_n_views, inplane_step, symmetry_tfs, angle_diff=30, dist_diff=99999):
+    symmetry_tfs = np.asarray(symmetry_tfs, dtype=np.float32).reshape(-1,4,4)
+    extra = dict(version=ASSET_CACHE_VERSION, min_n_views=min_n_views, inplane_step=inplane_step, angle_diff=angle_diff, dist_diff=dist_diff)
+    return hash_arrays(symmetry_tfs.round(6), extra=sorted(extra.items()))
+
+
+  def get_file(self, key):
+    return f'{self.cache_dir}/rot_grid_{key}.npy'
+
+
+  def load(self, key):
+    '''@return: (N,4,4) np array or None on miss
+    '''
+    if key in self._memory:
+      return self._memory[key]
+    if self.cache_dir is None:
+      return None
+    file = self.get_file(key)
+    if not os.path.exists(file):
+      return None
+    try:
+      rot_grid = np.load(file, allow_pickle=False)
+    except Exception as e:
+      logging.info(f"WARN: failed to load rot grid cache {file}, {e}")
+      return None
+    self._memory[key] = rot_grid
+    return rot_grid
+
+
+  def save(self, key, rot_grid):
+    rot_grid = np.asarray(rot_grid)
+    self._memory[key] = rot_grid
+    if self.cache_dir is None:
+      return
+    file = self.get_file(key)
+    tmp_file = f'{file}.{uuid.uuid4().hex}.tmp.npy'
+    np.save(tmp_file, rot_grid)
+    os.replace(tmp_file, file)
@@ -0,0 +1,72 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+import argparse,json,sys
+
+
+CONFIG_KEYS = ['mesh_type', 'n_faces', 'H', 'W', 'min_n_views', 'inplane_step', 'n_hypo', 'register_iteration', 'track_iteration', 'score_topk', 'lod_min_faces', 'n_frames', 'seed', 'device']
+
+# (name, getter, higher_is_better)
+METRICS = [
+  ('register_p50_ms', lambda r: r['register']['p50_ms'], False),
+  ('register_p99_ms', lambda r: r['register']['p99_ms'], False),
+  ('track_p50_ms', lambda r: r['track']['p50_ms'] if r['track'] is not None else None, False),
+  ('track_p99_ms', lambda r: r['track']['p99_ms'] if r['track'] is not None else None, False),
+  ('track_fps', lambda r: r['track_fps'], True),
+  ('register_peak_mem_mb', lambda r: r['register_peak_mem_bytes']/1e6 if r['register_peak_mem_bytes'] is not None else None, False),
+  ('track_peak_mem_mb', lambda r: r['track_peak_mem_bytes']/1e6 if r['track_peak_mem_bytes'] is not None else None, False),
+]
+
+
+def config_key(result):
+  '''Keys missing from older reports are None, so they only match runs with the same defaults
+  '''
+  return tuple(result['config'].get(k) for k in CONFIG_KEYS)
+
+
+def compare(base, new, threshold=0.05):
+  '''@return: list of rows (config, metric, base, new, relative change, regressed)
+  '''
+  base_results = {config_key(r): r for r in base['results']}
+  rows = []
+  for r in new['results']:
+    key = config_key(r)
+    if key not in base_results:
+      continue
+    for name, get, higher_is_better in METRICS:
+      b = get(base_results[key])
+      n = get(r)
+      if b is None or n is None or b==0:
+        continue
+      change = (n-b)/b
+      regressed = change<-threshold if higher_is_better else change>threshold
+      rows.append((dict(zip(CONFIG_KEYS, key)), name, b, n, change, regressed))
+  return rows
+
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser(description="Diff two run_benchmark.py reports")
+  parser.add_argument('base', type=str)
+  parser.add_argument('new', type=str)
+  parser.add_argument('--threshold', type=float, default=0.05, help="relative change counted as a regression")
+  args = parser.parse_args()
+
+  with open(args.base) as ff:
+    base = json.load(ff)
+  with open(args.new) as ff:
+    new = json.load(ff)
+  rows = compare(base, new, threshold=args.threshold)
+  n_regressed = 0
+  for config, name, b, n, change, regressed in rows:
+    flag = 'REGRESSED' if regressed else ''
+    n_regressed += regressed
+    print(f"{config['mesh_type']:>12} faces={config['n_faces']:<7} {config['H']}x{config['W']} hypo={config['n_hypo']:<4} topk={config['score_topk']} lod={config['lod_min_faces']} {config['device']} {name:<22} {b:10.2f} -> {n:10.2f} ({change*100:+6.1f}%) {flag}")
+  print(f'{n_regressed} regressions over {len(rows)} metrics')
+  sys.exit(1 if n_regressed>0 else 0)
@@ -0,0 +1,85 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+import os,sys,argparse,json,subprocess,time
+
+bench_dir = os.path.dirname(os.path.realpath(__file__))
+root_dir = os.path.realpath(f'{bench_dir}/..')
+
+# Heavy optional dependencies a tracking process must not pay for at import
+DEFAULT_FORBIDDEN = ['open3d', 'pandas', 'matplotlib', 'torchvision', 'pytorch3d.renderer', 'h5py', 'onnxruntime', 'joblib']
+
+
+def measure_import(module, python=sys.executable):
+  '''Import module in a fresh interpreter with -X importtime
+  @return: wall time in ms, list of (module, self_us, cumulative_us)
+  '''
+  begin = time.perf_counter()
+  proc = subprocess.run([python, '-X', 'importtime', '-c', f'import {module}'], cwd=root_dir, capture_output=True, text=True)
+  wall_ms = (time.perf_counter()-begin)*1000
+  if proc.returncode!=0:
+    raise RuntimeError(f'import {module} failed:\n{proc.stderr[-2000:]}')
+  rows = []
+  for line in proc.stderr.splitlines():
+    if not line.startswith('import time:') or 'self [us]' in line:
+      continue
+    self_us, cumulative_us, name = line[len('import time:'):].split('|')
+    rows.append((name.strip(), int(self_us), int(cumulative_us)))
+  return wall_ms, rows
+
+
+def summarize(rows, top=20):
+  '''Self time summed per top level package, most expensive first
+  '''
+  per_package = {}
+  for name,self_us,_ in rows:
+    package = name.split('.')[0]
+    per_package[package] = per_package.get(package, 0)+self_us
+  return sorted(((k, v/1000) for k,v in per_package.items()), key=lambda x: -x[1])[:top]
+
+
+def find_forbidden(rows, forbidden):
+  loaded = set(name for name,_,_ in rows)
+  return [f for f in forbidden if f in loaded]
+
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser(description="Report the import cost of the tracking entry modules and fail when over budget")
+  parser.add_argument('--modules', type=str, nargs='+', default=['Utils', 'estimater'])
+  parser.add_argument('--budget_ms', type=float, default=None, help="fail when the cumulative import time of a module exceeds this")
+  parser.add_argument('--forbidden', type=str, nargs='*', default=DEFAULT_FORBIDDEN, help="fail when any of these is imported")
+  parser.add_argument('--top', type=int, default=20)
+  parser.add_argument('--out', type=str, default=None, help="optional json report")
+  args = parser.parse_args()
+
+  report = {}
+  failures = []
+  for module in args.modules:
+    wall_ms, rows = measure_import(module)
+    cumulative_ms = max([c for name,_,c in rows if name==module], default=0)/1000
+    packages = summarize(rows, top=args.top)
+    forbidden = find_forbidden(rows, args.forbidden)
+    report[module] = {'wall_ms': wall_ms, 'cumulative_ms': cumulative_ms, 'n_modules': len(rows), 'top_packages_ms': packages, 'forbidden_loaded': forbidden}
+
+    print(f'import {module}: {cumulative_ms:.0f}ms cumulative, {wall_ms:.0f}ms wall incl. interpreter start, {len(rows)} modules')
+    for package,ms in packages:
+      print(f'  {package:<30} {ms:8.1f}ms')
+    if forbidden:
+      failures.append(f'{module} imports {forbidden}')
+    if args.budget_ms is not None and cumulative_ms>args.budget_ms:
+      failures.append(f'{module} takes {cumulative_ms:.0f}ms > budget {args.budget_ms:.0f}ms')
+
+  if args.out is not None:
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out, 'w') as ff:
+      json.dump(report, ff, indent=2)
+  for failure in failures:
+    print(f'FAILED: {failure}')
+  sys.exit(1 if failures else 0)
@@ -0,0 +1,125 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+import os,sys,argparse,json,time
+sys.path.append(f'{os.path.dirname(os.path.realpath(__file__))}/../')
+from benchmarks.run_benchmark import *
+
+bench_dir = os.path.dirname(os.path.realpath(__file__))
+
+
+def perturb_poses(pose, n_poses, trans_noise=0.01, rot_noise_deg=10, seed=0):
+  '''Refiner inputs around the ground truth, like tracking or the survivors of the rotation grid
+  '''
+  rng = np.random.RandomState(seed)
+  poses = []
+  for _ in range(n_poses):
+    axis = rng.normal(size=3)
+    R = rotation_matrix(np.deg2rad(rot_noise_deg)*rng.uniform(0,1), axis/np.linalg.norm(axis))
+    out = pose.copy()
+    out[:3,:3] = R[:3,:3]@out[:3,:3]
+    out[:3,3] += rng.uniform(-trans_noise, trans_noise, size=3)
+    poses.append(out)
+  return np.asarray(poses)
+
+
+def refine_level(est, lod_level, seq, frame_ids, init_poses, iteration):
+  '''@return: refined poses per frame (F,N,4,4) in the centered mesh frame, refiner latencies in ms
+  '''
+  poses_out = []
+  latencies = []
+  for i,init in zip(frame_ids, init_poses):
+    rgb = seq.get_color(i)
+    depth = seq.get_depth(i)
+    xyz_map = depth2xyzmap(depth, seq.K)
+    torch.cuda.synchronize()
+    begin = time.perf_counter()
+    poses, _ = est.refiner.predict(mesh=est.mesh, mesh_tensors=est.mesh_tensors, rgb=rgb, depth=depth, K=seq.K, ob_in_cams=init, xyz_map=xyz_map, glctx=est.glctx, mesh_diameter=est.diameter, iteration=iteration, lod_level=lod_level)
+    torch.cuda.synchronize()
+    latencies.append((time.perf_counter()-begin)*1000)
+    poses_out.append(poses.data.cpu().numpy())
+  return np.asarray(poses_out), latencies
+
+
+def pose_diffs(poses, ref_poses):
+  errs = np.array([pose_errors(p, r) for p,r in zip(poses.reshape(-1,4,4), ref_poses.reshape(-1,4,4))])
+  return {
+    'trans_diff_mm_mean': float(errs[:,0].mean()*1000),
+    'trans_diff_mm_max': float(errs[:,0].max()*1000),
+    'rot_diff_deg_mean': float(errs[:,1].mean()),
+    'rot_diff_deg_max': float(errs[:,1].max()),
+  }
+
+
+def lod_report(est, seq, n_frames=5, n_poses=16, iteration=5, seed=0):
+  '''Refine the same initial poses with every LOD level and with the automatic selection, against the full mesh
+  '''
+  tf_to_center = est.get_tf_to_centered_mesh().data.cpu().numpy()
+  frame_ids = np.linspace(0, len(seq)-1, min(n_frames, len(seq))).round().astype(int)
+  gt_centered = np.asarray([seq.get_gt_pose(i)@np.linalg.inv(tf_to_center) for i in frame_ids])
+  init_poses = np.asarray([perturb_poses(gt, n_poses, seed=seed+j) for j,gt in enumerate(gt_centered)])
+  gt_per_pose = np.repeat(gt_centered[:,None], n_poses, axis=1)
+
+  n_levels = len(est.lod_errors) if est.lod_errors is not None else 1
+  variants = [(f'lod{level}', level) for level in range(n_levels)]
+  variants.append(('auto', est.get_lod_level(est.refiner.cfg)))
+  results = {}
+  ref_poses = None
+  for name,level in variants:
+    poses, latencies = refine_level(est, level, seq, frame_ids, init_poses, iteration)
+    if ref_poses is None:
+      ref_poses = poses
+    result = {
+      'lod_level': level,
+      'n_faces': int(len(get_lod_tensors(est.mesh_tensors, level)['faces'])),
+      'error_mm': float(est.lod_errors[level])*1000 if n_levels>1 else 0.0,
+      'refine': latency_stats(latencies),
+      'vs_full_mesh': pose_diffs(poses, ref_poses),
+      'vs_gt': pose_diffs(poses, gt_per_pose),
+    }
+    results[name] = result
+    logging.info(f"{name}: faces={result['n_faces']}, refine p50={result['refine']['p50_ms']:.1f}ms, vs full mesh: {result['vs_full_mesh']}")
+  return results
+
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser(description="Compare refined poses across the LOD levels of a mesh")
+  parser.add_argument('--mesh_file', type=str, default=None, help="mesh to evaluate, default are the synthetic meshes")
+  parser.add_argument('--mesh_types', type=str, nargs='+', default=['weld_bracket', 'cylinder'], choices=list(MESH_MAKERS.keys()))
+  parser.add_argument('--min_faces', type=int, default=200000, help="synthetic meshes are subdivided until they have at least this many faces")
+  parser.add_argument('--lod_min_faces', type=int, default=5000)
+  parser.add_argument('--n_frames', type=int, default=5)
+  parser.add_argument('--n_poses', type=int, default=16)
+  parser.add_argument('--iteration', type=int, default=5)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--debug_dir', type=str, default=f'{bench_dir}/../debug/lod_report')
+  parser.add_argument('--out', type=str, default=f'{bench_dir}/../debug/lod_report/report.json')
+  args = parser.parse_args()
+  set_logging_format()
+  set_seed(0)
+
+  scorer = ScorePredictor()
+  refiner = PoseRefinePredictor()
+  glctx = dr.RasterizeCudaContext()
+  if args.mesh_file is not None:
+    meshes = {os.path.basename(args.mesh_file): trimesh.load(args.mesh_file, force='mesh')}
+  else:
+    meshes = {mesh_type: make_mesh(mesh_type, min_faces=args.min_faces, seed=args.seed) for mesh_type in args.mesh_types}
+
+  report = {'version': REPORT_VERSION, 'env': get_env_info(), 'args': vars(args), 'results': {}}
+  for name,mesh in meshes.items():
+    est = FoundationPose(model_pts=mesh.vertices, model_normals=mesh.vertex_normals, mesh=mesh, scorer=scorer, refiner=refiner, glctx=glctx, debug=0, debug_dir=args.debug_dir, lod_min_faces=args.lod_min_faces)
+    seq = SyntheticSequence(mesh, n_frames=max(args.n_frames, 2), glctx=glctx, seed=args.seed)
+    report['results'][name] = lod_report(est, seq, n_frames=args.n_frames, n_poses=args.n_poses, iteration=args.iteration, seed=args.seed)
+
+  os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+  with open(args.out, 'w') as ff:
+    json.dump(report, ff, indent=2)
+  logging.info(f'report saved to {args.out}')
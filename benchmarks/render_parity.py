@@ -0,0 +1,220 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+import os,sys,argparse,json,time
+sys.path.append(f'{os.path.dirname(os.path.realpath(__file__))}/../')
+from benchmarks.synthetic import *
+
+bench_dir = os.path.dirname(os.path.realpath(__file__))
+
+
+def random_poses(n_poses, distance=0.5, max_offset=0.05, seed=0):
+  '''Object in front of the camera under random rotations, roughly where hypotheses end up
+  '''
+  rng = np.random.RandomState(seed)
+  poses = []
+  for _ in range(n_poses):
+    pose = random_rotation_matrix(rng.rand(3))
+    pose[:3,3] = [rng.uniform(-max_offset, max_offset), rng.uniform(-max_offset, max_offset), distance+rng.uniform(-max_offset, max_offset)]
+    poses.append(pose)
+  return np.asarray(poses)
+
+
+def roi_boxes(K, poses, mesh_diameter, H, W):
+  '''Square boxes around the projected object centers, like the crops of the refiner and scorer
+  '''
+  centers = (K@poses[:,:3,3].T).T
+  uv = centers[:,:2]/centers[:,2:3]
+  radius = K[0,0]*mesh_diameter/poses[:,2,3]*0.6
+  return np.stack([uv[:,0]-radius, uv[:,1]-radius, uv[:,0]+radius, uv[:,1]+radius], axis=-1)
+
+
+def render(glctx, device, K, H, W, poses, mesh_tensors, bbox2d=None, output_size=None):
+  ob_in_cams = torch.as_tensor(poses, dtype=torch.float, device=device)
+  if bbox2d is not None:
+    bbox2d = torch.as_tensor(bbox2d, dtype=torch.float, device=device)
+  extra = {}
+  begin = time.perf_counter()
+  color, depth, normal = nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=ob_in_cams, glctx=glctx, mesh_tensors=mesh_tensors, use_light=True, get_normal=True, bbox2d=bbox2d, output_size=output_size, extra=extra)
+  if device.type=='cuda':
+    torch.cuda.synchronize()
+  latency_ms = (time.perf_counter()-begin)*1000
+  outputs = {'color': color, 'depth': depth[...,None], 'xyz_map': extra['xyz_map'], 'normal': normal}
+  return {k: v.float().cpu() for k,v in outputs.items()}, latency_ms
+
+
+def check_modes(glctx, device, K, H, W, poses, mesh_tensors, ref, bbox2d=None, output_size=None):
+  '''The geometry and silhouette fast paths against the color render of the same context, they share its rasterization so must agree exactly
+  @return: dict of latencies, list of mismatches
+  '''
+  ob_in_cams = torch.as_tensor(poses, dtype=torch.float, device=device)
+  if bbox2d is not None:
+    bbox2d = torch.as_tensor(bbox2d, dtype=torch.float, device=device)
+  kwargs = dict(K=K, H=H, W=W, glctx=glctx, bbox2d=bbox2d, output_size=output_size)
+  latencies = {}
+  outputs = {}
+  for mode,fn in [('geometry', render_geometry), ('silhouette', render_silhouette)]:
+    begin = time.perf_counter()
+    outputs[mode] = fn(ob_in_cams, mesh_tensors, **kwargs)
+    if device.type=='cuda':
+      torch.cuda.synchronize()
+    latencies[f'{mode}_ms'] = (time.perf_counter()-begin)*1000
+  depth, xyz_map, mask, _ = outputs['geometry']
+  mask_ref = ref['depth'][...,0]>=0.001
+  mismatches = []
+  if not torch.allclose(depth.float().cpu(), ref['depth'][...,0]) or not torch.allclose(xyz_map.float().cpu(), ref['xyz_map']):
+    mismatches.append('geometry depth/xyz')
+  if not (mask.cpu()==mask_ref).all() or not (outputs['silhouette'].cpu()==mask_ref).all():
+    mismatches.append('silhouette mask')
+  return latencies, mismatches
+
+
+def compare(ref, out, depth_tol=0.001, color_tol=2/255.0, normal_tol_deg=2):
+  '''Pixel parity within the silhouette both backends agree on, edge pixels may legitimately differ by coverage
+  @return: dict of metrics
+  '''
+  mask_ref = ref['depth'][...,0]>=0.001
+  mask_out = out['depth'][...,0]>=0.001
+  inter = (mask_ref & mask_out).sum().item()
+  union = (mask_ref | mask_out).sum().item()
+  both = mask_ref & mask_out
+  report = {'mask_iou': inter/max(union,1)}
+  depth_err = (ref['depth']-out['depth'])[both].abs()
+  color_err = (ref['color']-out['color'])[both].abs().amax(dim=-1)
+  xyz_err = (ref['xyz_map']-out['xyz_map'])[both].norm(dim=-1)
+  cos = (ref['normal'][both]*out['normal'][both]).sum(dim=-1).clip(-1,1)
+  normal_err = torch.rad2deg(torch.arccos(cos))
+  for name,err,tol in [('depth', depth_err, depth_tol), ('color', color_err, color_tol), ('xyz_map', xyz_err, depth_tol), ('normal', normal_err, normal_tol_deg)]:
+    report[f'{name}_err_mean'] = float(err.mean()) if len(err)>0 else 0.0
+    report[f'{name}_outlier_ratio'] = float((err>tol).float().mean()) if len(err)>0 else 0.0
+  return report
+
+
+
+def ray_depth_check(mesh, K, poses, depth, n_rays=500, depth_tol=0.001, seed=0):
+  '''Rendered depth against trimesh ray casts through the pixel centers, a reference that needs no gpu
+  @depth: (N,H,W) rendered depth
+  @return: dict of metrics, misses are rendered pixels whose ray hits nothing
+  '''
+  rng = np.random.RandomState(seed)
+  errs = []
+  n_rays_total = 0
+  n_miss = 0
+  K_inv = np.linalg.inv(K)
+  for pose, d in zip(poses, depth):
+    rows, cols = np.nonzero(d>=0.001)
+    if len(rows)==0:
+      continue
+    pick = rng.choice(len(rows), size=min(n_rays, len(rows)), replace=False)
+    rows = rows[pick]
+    cols = cols[pick]
+    dirs_cam = (K_inv@np.stack([cols+0.5, rows+0.5, np.ones(len(rows))], axis=0)).T   # Pixel (r,c) of the renders is centered at u=c+0.5, v=r+0.5
+    R = pose[:3,:3]
+    t = pose[:3,3]
+    origins = np.tile(-R.T@t, (len(dirs_cam),1))
+    locations, index_ray, _ = mesh.ray.intersects_location(origins, dirs_cam@R, multiple_hits=False)
+    hit_depth = (locations@R.T+t)[:,2]
+    errs.append(np.abs(hit_depth-d[rows[index_ray], cols[index_ray]]))
+    n_rays_total += len(rows)
+    n_miss += len(rows)-len(index_ray)
+  errs = np.concatenate(errs) if len(errs)>0 else np.zeros(0)
+  return {
+    'ray_depth_err_mean': float(errs.mean()) if len(errs)>0 else 0.0,
+    'ray_depth_outlier_ratio': float((errs>depth_tol).mean()) if len(errs)>0 else 0.0,
+    'ray_miss_ratio': n_miss/max(n_rays_total, 1),
+  }
+
+
+def check_thresholds(name, metrics, min_mask_iou, max_outlier_ratio, outputs=['depth', 'color', 'xyz_map', 'normal']):
+  failures = []
+  if metrics['mask_iou']<min_mask_iou:
+    failures.append(f"{name} mask iou {metrics['mask_iou']:.4f}")
+  for output in outputs:
+    if metrics[f'{output}_outlier_ratio']>max_outlier_ratio:
+      failures.append(f"{name} {output} outliers {metrics[f'{output}_outlier_ratio']:.4f}")
+  return failures
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser(description="Render the same poses with nvdiffrast and the torch software rasterizer and check pixel parity, for vertex colored and textured meshes. "
+                                               "Also self-checks the torch rasterizer without a gpu: geometry/silhouette modes against the color one, depth against ray casts, textures against equivalent vertex colors. "
+                                               "The nvdiffrast comparison is skipped when cuda is not available")
+  parser.add_argument('--mesh_types', type=str, nargs='+', default=['box', 'cylinder', 'weld_bracket'], choices=list(MESH_MAKERS.keys()))
+  parser.add_argument('--n_poses', type=int, default=16)
+  parser.add_argument('--image_size', type=int, nargs=2, default=[480,640], help="H W")
+  parser.add_argument('--crop_size', type=int, default=160, help="output size of the roi renders")
+  parser.add_argument('--device', type=str, default='cpu', help="device of the torch rasterizer, nvdiffrast always runs on cuda")
+  parser.add_argument('--min_mask_iou', type=float, default=0.98)
+  parser.add_argument('--max_outlier_ratio', type=float, default=0.01, help="fraction of common pixels allowed beyond the per output tolerance")
+  parser.add_argument('--n_rays', type=int, default=500, help="ray casts per pose of the depth self-check")
+  parser.add_argument('--max_ray_outlier_ratio', type=float, default=0.02, help="fraction of ray casts allowed to miss or to differ from the rendered depth, silhouette pixels may do either")
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--out', type=str, default=None, help="optional json report")
+  args = parser.parse_args()
+  set_logging_format()
+
+  H,W = args.image_size
+  K = make_intrinsics(H, W)
+  device = torch.device(args.device)
+  glctx = TorchRasterizeContext(device)
+  has_cuda = torch.cuda.is_available()
+  if has_cuda:
+    ref_device = torch.device('cuda')
+    ref_glctx = dr.RasterizeCudaContext(ref_device)
+  else:
+    logging.info("cuda is not available, skipping the nvdiffrast comparison, only the self-checks of the torch rasterizer run")
+
+  report = {}
+  failures = []
+  for mesh_type in args.mesh_types:
+    base = make_mesh(mesh_type, seed=args.seed)
+    diameter = compute_mesh_diameter(mesh=base)
+    poses = random_poses(args.n_poses, seed=args.seed)
+    bbox2d = roi_boxes(K, poses, diameter, H, W)
+    for visual, mesh in [('vertex_color', base), ('texture', texture_mesh(base, seed=args.seed))]:
+      for mode in ['full', 'roi']:
+        name = f'{mesh_type}/{visual}/{mode}'
+        kwargs = {} if mode=='full' else {'bbox2d': bbox2d, 'output_size': (args.crop_size, args.crop_size)}
+        out, out_ms = render(glctx, device, K, H, W, poses, make_mesh_tensors(mesh, device=device), **kwargs)
+        metrics = {'torch_ms': out_ms}
+        contexts = [('torch', glctx, device, out)]
+        if has_cuda:
+          ref, ref_ms = render(ref_glctx, ref_device, K, H, W, poses, make_mesh_tensors(mesh, device=ref_device), **kwargs)
+          metrics.update(compare(ref, out))
+          metrics['nvdiffrast_ms'] = ref_ms
+          failures += check_thresholds(name, metrics, args.min_mask_iou, args.max_outlier_ratio)
+          contexts.append(('nvdiffrast', ref_glctx, ref_device, ref))
+        for ctx_name,ctx,dev,outputs in contexts:
+          latencies, mismatches = check_modes(ctx, dev, K, H, W, poses, make_mesh_tensors(mesh, device=dev), outputs, **kwargs)
+          metrics.update({f'{ctx_name}_{k}': v for k,v in latencies.items()})
+          failures += [f'{name} {ctx_name} {m} differs from the color render' for m in mismatches]
+        if mode=='full' and visual=='vertex_color':
+          metrics.update(ray_depth_check(base, K, poses, out['depth'][...,0].numpy(), n_rays=args.n_rays, seed=args.seed))
+          for key in ['ray_depth_outlier_ratio', 'ray_miss_ratio']:
+            if metrics[key]>args.max_ray_outlier_ratio:
+              failures.append(f'{name} {key} {metrics[key]:.4f}')
+        report[name] = metrics
+        logging.info(f'{name}: {metrics}')
+
+    # Texture sampling of the torch rasterizer: a texture linear in uv must render like the same gradient as vertex colors
+    name = f'{mesh_type}/texture_self_check'
+    ref, _ = render(glctx, device, K, H, W, poses, make_mesh_tensors(gradient_vertex_colors(base), device=device))
+    out, _ = render(glctx, device, K, H, W, poses, make_mesh_tensors(texture_mesh(base, gradient=True), device=device))
+    metrics = compare(ref, out)
+    failures += check_thresholds(name, metrics, args.min_mask_iou, args.max_outlier_ratio, outputs=['color'])
+    report[name] = metrics
+    logging.info(f'{name}: {metrics}')
+
+  if args.out is not None:
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out, 'w') as ff:
+      json.dump(report, ff, indent=2)
+  for failure in failures:
+    logging.info(f'FAILED: {failure}')
+  sys.exit(1 if failures else 0)
@@ -0,0 +1,199 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+import os,sys,argparse,json,time,platform,subprocess,itertools
+sys.path.append(f'{os.path.dirname(os.path.realpath(__file__))}/../')
+from estimater import *
+from benchmarks.synthetic import *
+
+bench_dir = os.path.dirname(os.path.realpath(__file__))
+
+
+REPORT_VERSION = 2   # 2: full config (grid, top-k, LOD, frames, seed, device), peak memory None off cuda
+
+
+def latency_stats(latencies_ms):
+  x = np.asarray(latencies_ms, dtype=np.float64)
+  if len(x)==0:
+    return None
+  return {
+    'n': int(len(x)),
+    'mean_ms': float(x.mean()),
+    'p50_ms': float(np.percentile(x, 50)),
+    'p90_ms': float(np.percentile(x, 90)),
+    'p99_ms': float(np.percentile(x, 99)),
+    'min_ms': float(x.min()),
+    'max_ms': float(x.max()),
+  }
+
+
+def pose_errors(pose, gt_pose):
+  '''@return: translation error in meters, rotation error in degrees
+  '''
+  trans_err = np.linalg.norm(pose[:3,3]-gt_pose[:3,3])
+  cos = (np.trace(pose[:3,:3].T@gt_pose[:3,:3])-1)/2
+  rot_err = np.rad2deg(np.arccos(np.clip(cos, -1, 1)))
+  return float(trans_err), float(rot_err)
+
+
+def get_env_info():
+  info = {
+    'python': platform.python_version(),
+    'torch': torch.__version__,
+    'cuda': torch.version.cuda,
+    'gpu': torch.cuda.get_device_name() if torch.cuda.is_available() else None,
+    'host': platform.node(),
+    'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+  }
+  try:
+    info['git_commit'] = subprocess.check_output(['git','rev-parse','HEAD'], cwd=bench_dir, stderr=subprocess.DEVNULL).decode().strip()
+  except Exception:
+    info['git_commit'] = None
+  return info
+
+
+def synchronize(device):
+  if device.type=='cuda':
+    torch.cuda.synchronize(device)
+
+
+def bench_one(est, seq, register_iteration, track_iteration, register_repeats, warmup, score_topk=None):
+  '''Time register on the first frame and track_one over the rest of the sequence. Peak memory is only measured on cuda
+  '''
+  device = est.device
+  on_cuda = device.type=='cuda'
+  K = seq.K
+  color = seq.get_color(0)
+  depth = seq.get_depth(0)
+  mask = seq.get_mask(0)
+  for _ in range(warmup):
+    est.register(K=K, rgb=color, depth=depth, ob_mask=mask, iteration=register_iteration, score_topk=score_topk)
+
+  synchronize(device)
+  memory_scope = peak_memory.start(device) if on_cuda else None   # Not a reset of its own, MemoryBudget.measure resets the device peak inside register
+  register_ms = []
+  for _ in range(register_repeats):
+    begin = time.perf_counter()
+    pose = est.register(K=K, rgb=color, depth=depth, ob_mask=mask, iteration=register_iteration, score_topk=score_topk)
+    register_ms.append((time.perf_counter()-begin)*1000)
+  register_peak = peak_memory.stop(memory_scope) if on_cuda else None
+  register_err = pose_errors(pose, seq.get_gt_pose(0))
+
+  memory_scope = peak_memory.start(device) if on_cuda else None
+  track_ms = []
+  trans_errs = []
+  rot_errs = []
+  begin_all = time.perf_counter()
+  for i in range(1, len(seq)):
+    begin = time.perf_counter()
+    pose = est.track_one(rgb=seq.get_color(i), depth=seq.get_depth(i), K=K, iteration=track_iteration)
+    track_ms.append((time.perf_counter()-begin)*1000)
+    trans_err, rot_err = pose_errors(pose, seq.get_gt_pose(i))
+    trans_errs.append(trans_err)
+    rot_errs.append(rot_err)
+  track_wall = time.perf_counter()-begin_all
+  track_peak = peak_memory.stop(memory_scope) if on_cuda else None
+
+  return {
+    'register': latency_stats(register_ms),
+    'register_peak_mem_bytes': int(register_peak) if register_peak is not None else None,
+    'register_trans_err_m': register_err[0],
+    'register_rot_err_deg': register_err[1],
+    'track': latency_stats(track_ms),
+    'track_fps': (len(seq)-1)/track_wall if track_wall>0 else None,
+    'track_peak_mem_bytes': int(track_peak) if track_peak is not None else None,
+    'track_trans_err_m_mean': float(np.mean(trans_errs)) if len(trans_errs)>0 else None,
+    'track_rot_err_deg_mean': float(np.mean(rot_errs)) if len(rot_errs)>0 else None,
+  }
+
+
+def run(args):
+  set_seed(0)
+  os.makedirs(args.debug_dir, exist_ok=True)
+  device = torch.device(args.device) if args.device is not None else get_default_device()
+  scorer = ScorePredictor(device=device)
+  refiner = PoseRefinePredictor(device=device)
+  glctx = make_raster_context(device)
+
+  results = []
+  for mesh_type, min_faces in itertools.product(args.mesh_types, args.min_faces):
+    mesh = make_mesh(mesh_type, min_faces=min_faces, seed=args.seed)
+    est = FoundationPose(model_pts=mesh.vertices, model_normals=mesh.vertex_normals, mesh=mesh, scorer=scorer, refiner=refiner, glctx=glctx, debug=0, debug_dir=args.debug_dir, lod_min_faces=args.lod_min_faces, device=device)
+    for image_size in args.image_sizes:
+      H,W = image_size
+      seq = SyntheticSequence(mesh, n_frames=args.n_frames, H=H, W=W, glctx=glctx, seed=args.seed, device=device)
+      for min_n_views, inplane_step in args.hypotheses:
+        est.make_rotation_grid(min_n_views=min_n_views, inplane_step=inplane_step)
+        config = {
+          'mesh_type': mesh_type,
+          'n_faces': int(len(mesh.faces)),
+          'H': H,
+          'W': W,
+          'min_n_views': min_n_views,
+          'inplane_step': inplane_step,
+          'n_hypo': int(len(est.rot_grid)),
+          'register_iteration': args.register_iteration,
+          'track_iteration': args.track_iteration,
+          'score_topk': args.score_topk,
+          'lod_min_faces': args.lod_min_faces,
+          'n_frames': args.n_frames,
+          'seed': args.seed,
+          'device': str(device),
+        }
+        logging.info(f'benchmark config: {config}')
+        result = bench_one(est, seq, register_iteration=args.register_iteration, track_iteration=args.track_iteration, register_repeats=args.register_repeats, warmup=args.warmup, score_topk=args.score_topk)
+        results.append({'config': config, **result})
+        logging.info(f"register p50:{result['register']['p50_ms']:.1f}ms, track p50:{result['track']['p50_ms']:.1f}ms, track fps:{result['track_fps']:.1f}")
+
+  report = {
+    'version': REPORT_VERSION,
+    'env': get_env_info(),
+    'args': vars(args),
+    'results': results,
+  }
+  os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+  with open(args.out, 'w') as ff:
+    json.dump(report, ff, indent=2)
+  logging.info(f'report saved to {args.out}')
+  return report
+
+
+def parse_size(s):
+  H,W = s.lower().split('x')
+  return (int(H), int(W))
+
+
+def parse_hypo(s):
+  '''min_n_views:inplane_step, e.g. 40:60 is the default grid
+  '''
+  min_n_views, inplane_step = s.split(':')
+  return (int(min_n_views), int(inplane_step))
+
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--mesh_types', type=str, nargs='+', default=['box', 'cylinder', 'weld_bracket'], choices=list(MESH_MAKERS.keys()))
+  parser.add_argument('--min_faces', type=int, nargs='+', default=[0, 20000], help="mesh complexity, meshes are subdivided until they have at least this many faces")
+  parser.add_argument('--image_sizes', type=parse_size, nargs='+', default=[(480,640)], help="HxW")
+  parser.add_argument('--hypotheses', type=parse_hypo, nargs='+', default=[(40,60)], help="rotation grids as min_n_views:inplane_step")
+  parser.add_argument('--n_frames', type=int, default=30)
+  parser.add_argument('--register_iteration', type=int, default=5)
+  parser.add_argument('--track_iteration', type=int, default=2)
+  parser.add_argument('--register_repeats', type=int, default=3)
+  parser.add_argument('--score_topk', type=int, default=None, help="score hypotheses with the bounded memory tournament keeping this many, default is the full set")
+  parser.add_argument('--lod_min_faces', type=int, default=None, help="render hypotheses from a LOD pyramid with levels of at least this many faces, default is the full mesh")
+  parser.add_argument('--device', type=str, default=None, help="cuda or cpu, default is cuda when available. Off cuda hypotheses are rendered with the torch rasterizer")
+  parser.add_argument('--warmup', type=int, default=1)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--debug_dir', type=str, default=f'{bench_dir}/../debug/benchmark')
+  parser.add_argument('--out', type=str, default=f'{bench_dir}/../debug/benchmark/report.json')
+  args = parser.parse_args()
+  set_logging_format()
+  run(args)
@@ -0,0 +1,203 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+import os,sys
+sys.path.append(f'{os.path.dirname(os.path.realpath(__file__))}/../')
+from Utils import *
+
+
+def color_mesh_by_position(mesh, seed=0):
+  '''Smooth procedural vertex colors so the networks get some appearance cues
+  '''
+  rng = np.random.RandomState(seed)
+  freq = rng.uniform(10, 30, size=(3,3))
+  phase = rng.uniform(0, 2*np.pi, size=(3,))
+  v = mesh.vertices-mesh.vertices.mean(axis=0)
+  colors = 0.5+0.4*np.sin(v@freq+phase)
+  mesh.visual = trimesh.visual.ColorVisuals(mesh, vertex_colors=(colors*255).astype(np.uint8))
+  return mesh
+
+
+def subdivide_to(mesh, min_faces):
+  '''Increase mesh complexity without changing the shape
+  '''
+  while len(mesh.faces)<min_faces:
+    mesh = mesh.subdivide()
+  return mesh
+
+
+def make_box_mesh(extents=(0.12,0.08,0.05), min_faces=0, seed=0):
+  mesh = trimesh.creation.box(extents=extents)
+  return color_mesh_by_position(subdivide_to(mesh, min_faces), seed=seed)
+
+
+def make_cylinder_mesh(radius=0.03, height=0.12, sections=32, min_faces=0, seed=0):
+  mesh = trimesh.creation.cylinder(radius=radius, height=height, sections=sections)
+  return color_mesh_by_position(subdivide_to(mesh, min_faces), seed=seed)
+
+
+def make_weld_bracket_mesh(length=0.12, width=0.06, height=0.08, thickness=0.008, min_faces=0, seed=0):
+  '''L shaped bracket with a triangular gusset, a typical welded part without symmetry
+  '''
+  from shapely.geometry import Polygon
+  base = trimesh.creation.box(extents=(length, width, thickness))
+  base.apply_translation([0, 0, thickness/2])
+  wall = trimesh.creation.box(extents=(thickness, width, height))
+  wall.apply_translation([-length/2+thickness/2, 0, height/2])
+  gusset_len = length*0.5
+  gusset_pts = np.array([[0,0],[gusset_len,0],[0,height*0.8]])
+  gusset = trimesh.creation.extrude_polygon(Polygon(gusset_pts), height=thickness)
+  gusset.apply_transform(euler_matrix(np.pi/2, 0, 0))
+  gusset.apply_translation([-length/2+thickness, thickness/2, thickness])
+  mesh = trimesh.util.concatenate([base, wall, gusset])
+  mesh.vertices -= (mesh.vertices.max(axis=0)+mesh.vertices.min(axis=0))/2
+  return color_mesh_by_position(subdivide_to(mesh, min_faces), seed=seed)
+
+
+MESH_MAKERS = {
+  'box': make_box_mesh,
+  'cylinder': make_cylinder_mesh,
+  'weld_bracket': make_weld_bracket_mesh,
+}
+
+
+def make_mesh(mesh_type, min_faces=0, seed=0):
+  if mesh_type not in MESH_MAKERS:
+    raise RuntimeError(f'unknown mesh type {mesh_type}, choose from {list(MESH_MAKERS.keys())}')
+  return MESH_MAKERS[mesh_type](min_faces=min_faces, seed=seed)
+
+
+def planar_uv(mesh, margin=0.1):
+  '''UVs from the x,y extent of the mesh, kept margin away from the texture borders so wrapped sampling never blends the opposite side
+  '''
+  xy = mesh.vertices[:,:2]
+  lo = xy.min(axis=0)
+  hi = xy.max(axis=0)
+  return margin+(1-2*margin)*(xy-lo)/np.maximum(hi-lo, 1e-9)
+
+
+def texture_mesh(mesh, tex_size=256, gradient=False, seed=0):
+  '''Copy of mesh textured through planar_uv, like the obj+png of a reconstruction.
+  The texture is a smooth procedural pattern, or with gradient linear in uv (red=u, green=v) so it renders exactly like gradient_vertex_colors
+  '''
+  coords = (np.arange(tex_size)+0.5)/tex_size
+  u, v = np.meshgrid(coords, 1-coords)   # Image rows go down, v goes up
+  if gradient:
+    img = np.stack([u, v, np.full_like(u, 0.5)], axis=-1)
+  else:
+    rng = np.random.RandomState(seed)
+    freq = rng.uniform(5, 15, size=(2,3))
+    phase = rng.uniform(0, 2*np.pi, size=(3,))
+    img = 0.5+0.4*np.sin(np.stack([u, v], axis=-1)@freq+phase)
+  mesh = mesh.copy()
+  mesh.visual = trimesh.visual.TextureVisuals(uv=planar_uv(mesh), image=Image.fromarray((img*255).round().astype(np.uint8)))
+  return mesh
+
+
+def gradient_vertex_colors(mesh):
+  '''Copy of mesh whose vertex colors are the gradient texture of texture_mesh sampled at the vertices
+  '''
+  uv = planar_uv(mesh)
+  colors = np.concatenate([uv, np.full((len(uv),1), 0.5)], axis=1)
+  mesh = mesh.copy()
+  mesh.visual = trimesh.visual.ColorVisuals(mesh, vertex_colors=(colors*255).round().astype(np.uint8))
+  return mesh
+
+
+def make_intrinsics(H, W, fov_deg=60):
+  f = W/2/np.tan(np.deg2rad(fov_deg)/2)
+  return np.array([[f,0,W/2],[0,f,H/2],[0,0,1]], dtype=np.float64)
+
+
+def make_trajectory(n_frames, distance=0.5, seed=0, max_trans_step=0.004, max_rot_step_deg=3):
+  '''Smooth random object motion in front of the camera
+  @return: (n_frames,4,4) ob_in_cam
+  '''
+  rng = np.random.RandomState(seed)
+  pose = random_rotation_matrix(rng.rand(3))
+  pose[:3,3] = [0, 0, distance]
+  trans_vel = rng.uniform(-1, 1, size=3)*max_trans_step
+  rot_axis = rng.normal(size=3)
+  poses = []
+  for _ in range(n_frames):
+    poses.append(pose.copy())
+    trans_vel = 0.9*trans_vel+0.1*rng.uniform(-1, 1, size=3)*max_trans_step
+    rot_axis = 0.9*rot_axis+0.1*rng.normal(size=3)
+    angle = np.deg2rad(max_rot_step_deg)*rng.uniform(0.3, 1)
+    R = rotation_matrix(angle, rot_axis/np.linalg.norm(rot_axis))
+    pose[:3,:3] = R[:3,:3]@pose[:3,:3]
+    pose[:3,3] = pose[:3,3]+trans_vel
+    pose[2,3] = np.clip(pose[2,3], distance*0.7, distance*1.3)
+  return np.asarray(poses)
+
+
+class SyntheticSequence:
+  '''Procedurally rendered RGB-D sequence with masks and ground truth poses.
+  Exposes the same accessors as YcbineoatReader (K, color_files, id_strs, get_color/get_depth/get_mask/get_gt_pose) so any driver can consume it.
+  Frames are rendered once up front so rendering never shows up in the measured latency
+  '''
+  def __init__(self, mesh, n_frames=30, H=480, W=640, glctx=None, distance=0.5, depth_noise=0.001, seed=0, device=None):
+    '''
+    @device: where the frames are rendered, default is get_default_device(). Off cuda they are rendered with the torch rasterizer
+    '''
+    self.mesh = mesh
+    self.H = H
+    self.W = W
+    self.K = make_intrinsics(H, W)
+    self.gt_poses = make_trajectory(n_frames, distance=distance, seed=seed)
+    self.color_files = [f'synthetic_{i:06d}' for i in range(n_frames)]
+    self.id_strs = [f'{i:06d}' for i in range(n_frames)]
+
+    device = torch.device(device) if device is not None else get_default_device()
+    if glctx is None:
+      glctx = make_raster_context(device)
+    mesh_tensors = make_mesh_tensors(mesh, device=device)
+    rng = np.random.RandomState(seed)
+    background = self.make_background(rng)
+    self.colors = []
+    self.depths = []
+    self.masks = []
+    for pose in self.gt_poses:
+      ob_in_cams = torch.as_tensor(pose, dtype=torch.float, device=device)[None]
+      color, depth, _ = nvdiffrast_render(K=self.K, H=H, W=W, ob_in_cams=ob_in_cams, glctx=glctx, mesh_tensors=mesh_tensors, use_light=True)
+      color = (color[0].data.cpu().numpy()*255).clip(0,255).astype(np.uint8)
+      depth = depth[0].data.cpu().numpy()
+      mask = depth>=0.001
+      color[~mask] = background[~mask]
+      depth_bg = np.full((H,W), distance*2, dtype=np.float32)
+      depth = np.where(mask, depth, depth_bg)
+      depth = depth+rng.normal(scale=depth_noise, size=depth.shape)*(depth>0)
+      self.colors.append(color)
+      self.depths.append(depth.astype(np.float32))
+      self.masks.append(mask.astype(np.uint8))
+
+
+  def make_background(self, rng):
+    noise = rng.randint(0, 255, size=(self.H//8+1, self.W//8+1, 3)).astype(np.uint8)
+    return cv2.resize(noise, (self.W,self.H), interpolation=cv2.INTER_LINEAR)
+
+
+  def __len__(self):
+    return len(self.color_files)
+
+
+  def get_color(self, i):
+    return self.colors[i]
+
+
+  def get_depth(self, i):
+    return self.depths[i]
+
+
+  def get_mask(self, i):
+    return self.masks[i]
+
+
+  def get_gt_pose(self, i):
+    return self.gt_poses[i]
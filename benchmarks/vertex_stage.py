@@ -0,0 +1,105 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+import os,sys,argparse,json,time
+sys.path.append(f'{os.path.dirname(os.path.realpath(__file__))}/../')
+from benchmarks.synthetic import *
+
+
+def legacy_vertex_stage(pos, vnormals, ob_in_cams, mtx, tf=None, get_normal=True):
+  '''The per pose broadcast nvdiffrast_render used before vertex_stage, kept here as the reference
+  '''
+  pts_cam = transform_pts(pos, ob_in_cams)
+  pos_homo = to_homo_torch(pos)
+  pos_clip = (mtx[:,None]@pos_homo[None,...,None])[...,0]
+  if tf is not None:
+    pos_clip = pos_clip@tf
+  vnormals_cam = transform_dirs(vnormals, ob_in_cams) if get_normal else None
+  return pts_cam, pos_clip, vnormals_cam
+
+
+def make_inputs(B, V, device, seed=0):
+  '''Random vertices and poses in front of the camera, with a roi transform like the crops of the refiner and scorer
+  '''
+  gen = torch.Generator(device='cpu').manual_seed(seed)
+  pos = (torch.rand((V,3), generator=gen)-0.5)*0.2
+  vnormals = F.normalize(torch.randn((V,3), generator=gen), dim=-1)
+  ob_in_cams = torch.as_tensor(np.asarray([random_rotation_matrix(np.random.RandomState(seed+i).rand(3)) for i in range(B)]), dtype=torch.float)
+  ob_in_cams[:,:3,3] = torch.tensor([0,0,0.5])
+  K = make_intrinsics(480, 640)
+  projection_mat = torch.as_tensor(projection_matrix_from_intrinsics(K, height=480, width=640, znear=0.001, zfar=100), dtype=torch.float)
+  mtx = projection_mat.reshape(1,4,4)@ob_in_cams
+  tf = torch.eye(4).reshape(1,4,4).repeat(B,1,1)
+  tf[:,0,0] = 4
+  tf[:,1,1] = 3
+  tf[:,3,0] = (torch.rand(B, generator=gen)-0.5)
+  tf[:,3,1] = (torch.rand(B, generator=gen)-0.5)
+  return pos.to(device), vnormals.to(device), ob_in_cams.to(device), mtx.to(device), tf.to(device)
+
+
+def measure(fn, device, n_warmup=3, n_repeat=10):
+  '''@return: median latency in ms, peak memory allocated during the calls in MB (cuda only)
+  '''
+  for _ in range(n_warmup):
+    fn()
+  if device.type=='cuda':
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    base = torch.cuda.memory_allocated()
+  latencies = []
+  for _ in range(n_repeat):
+    begin = time.perf_counter()
+    fn()
+    if device.type=='cuda':
+      torch.cuda.synchronize()
+    latencies.append((time.perf_counter()-begin)*1000)
+  peak_mb = (torch.cuda.max_memory_allocated()-base)/1024**2 if device.type=='cuda' else None
+  return float(np.median(latencies)), peak_mb
+
+
+def check_outputs(ref, out, atol=1e-4, rtol=1e-4):
+  for name,a,b in zip(['pts_cam', 'pos_clip', 'vnormals_cam'], ref, out):
+    if not torch.allclose(a, b, atol=atol, rtol=rtol):
+      raise RuntimeError(f'{name} differs, max abs diff {float((a-b).abs().max()):.3g}')
+
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser(description="Time the vertex stage of nvdiffrast_render, per pose broadcast against one GEMM into reused buffers")
+  parser.add_argument('--batch_sizes', type=int, nargs='+', default=[16, 64, 256])
+  parser.add_argument('--n_vertices', type=int, nargs='+', default=[10000, 100000, 400000])
+  parser.add_argument('--device', type=str, default='cuda')
+  parser.add_argument('--n_repeat', type=int, default=10)
+  parser.add_argument('--out', type=str, default=None, help="optional json report")
+  args = parser.parse_args()
+  set_logging_format()
+
+  device = torch.device(args.device)
+  report = {}
+  with torch.inference_mode():
+    for V in args.n_vertices:
+      for B in args.batch_sizes:
+        pos, vnormals, ob_in_cams, mtx, tf = make_inputs(B, V, device)
+        ref = legacy_vertex_stage(pos, vnormals, ob_in_cams, mtx, tf=tf)
+        out = vertex_stage(pos, vnormals, ob_in_cams, tf.transpose(1,2)@mtx)
+        check_outputs(ref, out)
+        del ref, out
+        legacy_ms, legacy_mb = measure(lambda: legacy_vertex_stage(pos, vnormals, ob_in_cams, mtx, tf=tf), device, n_repeat=args.n_repeat)
+        gemm_ms, gemm_mb = measure(lambda: vertex_stage(pos, vnormals, ob_in_cams, tf.transpose(1,2)@mtx), device, n_repeat=args.n_repeat)
+        result = {'legacy_ms': legacy_ms, 'gemm_ms': gemm_ms, 'speedup': legacy_ms/max(gemm_ms,1e-6), 'legacy_peak_mb': legacy_mb, 'gemm_peak_mb': gemm_mb}
+        report[f'B{B}_V{V}'] = result
+        logging.info(f'B={B} V={V}: {result}')
+        vertex_buffers.clear()
+        if device.type=='cuda':
+          torch.cuda.empty_cache()
+
+  if args.out is not None:
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out, 'w') as ff:
+      json.dump(report, ff, indent=2)
@@ -108,6 +108,7 @@ if __name__=="__main__":
   parser.add_argument('--ref_view_dir', type=str, default=f'/mnt/9a72c439-d0a7-45e8-8d20-d7a235d02763/DATASET/YCB_Video/bowen_addon/ref_views_16')
   parser.add_argument('--dataset', type=str, default=f'ycbv', help='one of [ycbv/linemod]')
   args = parser.parse_args()
+  set_logging_format()
 
   if args.dataset=='ycbv':
     run_ycbv()
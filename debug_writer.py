@@ -0,0 +1,153 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+import os,queue,threading,logging,atexit
+import numpy as np
+import cv2
+from Utils import toOpen3dCloud, LazyModule
+
+imageio = LazyModule('imageio')
+o3d = LazyModule('open3d')
+
+
+POLICIES = ['block', 'drop_new', 'drop_oldest']
+
+
+class DebugWriter:
+  '''Writes debug artifacts (png, ply, obj) from background threads so the caller only pays for a copy of the data.
+  The queue is bounded, when it is full the policy decides:
+    block: wait for a free slot, nothing is lost (backpressure on the caller)
+    drop_new: discard the new artifact
+    drop_oldest: discard the oldest pending artifact to make room
+  Pending artifacts are flushed at interpreter exit
+  '''
+  def __init__(self, max_queue=32, policy='block', n_workers=1):
+    if policy not in POLICIES:
+      raise RuntimeError(f'unknown policy {policy}, choose from {POLICIES}')
+    self.max_queue = max_queue
+    self.policy = policy
+    self.queue = queue.Queue(maxsize=max_queue)
+    self.n_written = 0
+    self.n_dropped = 0
+    self.n_failed = 0
+    self.lock = threading.Lock()
+    self.closed = False
+    self.workers = []
+    for i in range(n_workers):
+      worker = threading.Thread(target=self.run, name=f'debug_writer_{i}', daemon=True)
+      worker.start()
+      self.workers.append(worker)
+    atexit.register(self.close)
+
+
+  def run(self):
+    while True:
+      job = self.queue.get()
+      if job is None:
+        self.queue.task_done()
+        break
+      fn, args, kwargs = job
+      try:
+        fn(*args, **kwargs)
+        with self.lock:
+          self.n_written += 1
+      except Exception as e:
+        logging.info(f"WARN: debug writer failed, {e}")
+        with self.lock:
+          self.n_failed += 1
+      finally:
+        self.queue.task_done()
+
+
+  def has_capacity(self):
+    '''Whether an artifact submitted now would be written without blocking or dropping.
+    Callers use it to skip producing expensive artifacts (e.g. visualization renders) when the writer lags behind
+    '''
+    return not self.closed and self.queue.qsize()<self.max_queue
+
+
+  def submit(self, fn, *args, **kwargs):
+    '''Run fn(*args, **kwargs) on a writer thread. Arguments must not be modified by the caller afterwards
+    @return: True if queued, False if dropped
+    '''
+    if self.closed:
+      return False
+    job = (fn, args, kwargs)
+    if self.policy=='block':
+      self.queue.put(job)
+      return True
+    while True:
+      try:
+        self.queue.put_nowait(job)
+        return True
+      except queue.Full:
+        if self.policy=='drop_new':
+          with self.lock:
+            self.n_dropped += 1
+          return False
+      try:
+        self.queue.get_nowait()
+        self.queue.task_done()
+        with self.lock:
+          self.n_dropped += 1
+      except queue.Empty:
+        pass
+
+
+  def write_image(self, file, img):
+    '''RGB image through imageio
+    '''
+    return self.submit(imageio.imwrite, file, np.array(img, copy=True))
+
+
+  def write_cv2_image(self, file, img):
+    '''BGR or single channel image through cv2, e.g. uint16 depth
+    '''
+    return self.submit(cv2.imwrite, file, np.array(img, copy=True))
+
+
+  def write_point_cloud(self, file, points, colors=None, normals=None):
+    '''Building the open3d cloud also happens on the writer thread
+    '''
+    def write(file, points, colors, normals):
+      o3d.io.write_point_cloud(file, toOpen3dCloud(points, colors=colors, normals=normals))
+    copy = lambda x: None if x is None else np.array(x, copy=True)
+    return self.submit(write, file, copy(points), copy(colors), copy(normals))
+
+
+  def export_mesh(self, file, mesh, transform=None):
+    '''@transform: optional (4,4) applied to a copy of the mesh on the writer thread
+    '''
+    def export(file, mesh, transform):
+      if transform is not None:
+        mesh.apply_transform(transform)
+      mesh.export(file)
+    return self.submit(export, file, mesh.copy(), None if transform is None else np.array(transform, copy=True))
+
+
+  def flush(self):
+    '''Block until every queued artifact is written
+    '''
+    self.queue.join()
+
+
+  def close(self):
+    if self.closed:
+      return
+    self.flush()
+    self.closed = True
+    for _ in self.workers:
+      self.queue.put(None)
+    for worker in self.workers:
+      worker.join()
+
+
+  def get_stats(self):
+    with self.lock:
+      return {'written': self.n_written, 'dropped': self.n_dropped, 'failed': self.n_failed, 'pending': self.queue.qsize()}
@@ -12,16 +12,37 @@ from datareader import *
 import itertools
 from learning.training.predict_score import *
 from learning.training.predict_pose_refine import *
+from asset_cache import *
+from object_registry import *
+from instrumentation import *
+from debug_writer import *
+from template_bank import TemplateBank
 import yaml
 
 
 class FoundationPose:
-  def __init__(self, model_pts, model_normals, symmetry_tfs=None, mesh=None, scorer:ScorePredictor=None, refiner:PoseRefinePredictor=None, glctx=None, debug=0, debug_dir='/home/bowen/debug/novel_pose_debug/'):
+  def __init__(self, model_pts, model_normals, symmetry_tfs=None, mesh=None, scorer:ScorePredictor=None, refiner:PoseRefinePredictor=None, glctx=None, debug=0, debug_dir='/home/bowen/debug/novel_pose_debug/', asset_cache:ObjectAssetCache=None, object_registry:ObjectRegistry=None, rot_grid_cache:RotationGridCache=None, device=None, debug_writer:DebugWriter=None, lod_min_faces=None, registry_max_bytes=None, registry_max_objects=None):
+    '''
+    @device: where every tensor of the estimator lives, default is get_default_device(). Rendering hypotheses with nvdiffrast still needs cuda
+    @debug_writer: writes the debug>=2 artifacts off the hot path, default is a DebugWriter with the block policy. Use drop_new/drop_oldest to keep debug capture on without affecting latency
+    @registry_max_bytes, registry_max_objects: device memory and object count budget of the default object registry (see add_object), objects beyond it are evicted in LRU order. Not with object_registry
+    @asset_cache: default is an ObjectAssetCache in $FOUNDATIONPOSE_CACHE_DIR (or cache/ in the repo), so reloading a mesh skips the voxelization and mesh tensors. ObjectAssetCache(enabled=False) turns it off
+    @lod_min_faces: opt-in, vertex colored meshes with more than 1/lod_ratio times this many faces get a LOD pyramid (textured meshes are warned about and always rendered in full) and hypotheses are rendered at the coarsest level that stays sub-pixel accurate (e.g. 5000). Default None always renders the full mesh
+    '''
+    self.device = torch.device(device) if device is not None else get_default_device()
     self.gt_pose = None
     self.ignore_normal_flip = True
     self.debug = debug
     self.debug_dir = debug_dir
     os.makedirs(debug_dir, exist_ok=True)
+    self.debug_writer = debug_writer
+    self.asset_cache = asset_cache if asset_cache is not None else ObjectAssetCache()
+    if object_registry is not None and (registry_max_bytes is not None or registry_max_objects is not None):
+      raise RuntimeError('registry_max_bytes/registry_max_objects only apply to the default object registry, set them on the object_registry passed instead')
+    self.object_registry = object_registry if object_registry is not None else ObjectRegistry(max_bytes=registry_max_bytes, max_objects=registry_max_objects)
+    self.active_ob_id = None
+    self.rot_grid_cache = rot_grid_cache if rot_grid_cache is not None else RotationGridCache()
+    self.lod_min_faces = lod_min_faces
 
     self.reset_object(model_pts, model_normals, symmetry_tfs=symmetry_tfs, mesh=mesh)
     self.make_rotation_grid(min_n_views=40, inplane_step=60)
@@ -31,17 +52,22 @@ class FoundationPose:
     if scorer is not None:
       self.scorer = scorer
     else:
-      self.scorer = ScorePredictor()
+      self.scorer = ScorePredictor(device=self.device)
 
     if refiner is not None:
       self.refiner = refiner
     else:
-      self.refiner = PoseRefinePredictor()
+      self.refiner = PoseRefinePredictor(device=self.device)
 
     self.pose_last = None   # Used for tracking; per the centered mesh
+    self.track_gate = None
+    self.track_score = None
+    self.frames_since_score = 0
 
 
   def reset_object(self, model_pts, model_normals, symmetry_tfs=None, mesh=None):
+    self.active_ob_id = None   # Anonymous object, not tracked by the object registry
+    self.template_bank = None
     max_xyz = mesh.vertices.max(axis=0)
     min_xyz = mesh.vertices.min(axis=0)
     self.model_center = (min_xyz+max_xyz)/2
@@ -50,42 +76,140 @@ class FoundationPose:
       mesh = mesh.copy()
       mesh.vertices = mesh.vertices - self.model_center.reshape(1,3)
 
-    model_pts = mesh.vertices
-    self.diameter = compute_mesh_diameter(model_pts=mesh.vertices, n_sample=10000)
-    self.vox_size = max(self.diameter/20.0, 0.003)
+    cache_key = self.asset_cache.make_key(self.mesh_ori, model_normals=model_normals, diameter_n_sample=10000, vox_size_ratio=1/20.0, min_vox_size=0.003, lod_min_faces=self.lod_min_faces)
+    assets = self.asset_cache.load(cache_key)
+    if assets is None:
+      assets = self.make_object_assets(mesh, model_normals)
+      self.asset_cache.save(cache_key, assets)
+    else:
+      mesh.vertices = assets['vertices']
+
+    self.diameter = float(assets['diameter'])
+    self.vox_size = float(assets['vox_size'])
     logging.info(f'self.diameter:{self.diameter}, vox_size:{self.vox_size}')
     self.dist_bin = self.vox_size/2
     self.angle_bin = 20  # Deg
-    pcd = toOpen3dCloud(model_pts, normals=model_normals)
-    pcd = pcd.voxel_down_sample(self.vox_size)
-    self.max_xyz = np.asarray(pcd.points).max(axis=0)
-    self.min_xyz = np.asarray(pcd.points).min(axis=0)
-    self.pts = torch.tensor(np.asarray(pcd.points), dtype=torch.float32, device='cuda')
-    self.normals = F.normalize(torch.tensor(np.asarray(pcd.normals), dtype=torch.float32, device='cuda'), dim=-1)
+    self.max_xyz = assets['pts'].max(axis=0)
+    self.min_xyz = assets['pts'].min(axis=0)
+    self.pts = torch.tensor(assets['pts'], dtype=torch.float32, device=self.device)
+    self.normals = F.normalize(torch.tensor(assets['normals'], dtype=torch.float32, device=self.device), dim=-1)
     logging.info(f'self.pts:{self.pts.shape}')
     self.mesh_path = None
     self.mesh = mesh
     if self.mesh is not None:
-      self.mesh_path = f'/tmp/{uuid.uuid4()}.obj'
-      self.mesh.export(self.mesh_path)
-    self.mesh_tensors = make_mesh_tensors(self.mesh)
+      self.mesh_path = self.asset_cache.export_mesh(cache_key, self.mesh)   # Content addressed, reloading a mesh never writes a new file
+    self.mesh_tensors = arrays_to_mesh_tensors({k[len('mesh_tensors/'):]: assets[k] for k in assets if k.startswith('mesh_tensors/')}, device=self.device)
+    self.lod_errors = np.asarray(assets['mesh_tensors/lod_errors']) if 'mesh_tensors/lod_errors' in assets else None   # Host copy, LOD levels are picked without a device sync
+    if self.lod_min_faces is not None and 'mesh_tensors/tex' in assets:
+      logging.info(f"WARN: lod_min_faces={self.lod_min_faces} is ignored for textured meshes, decimation does not keep UV seams. Hypotheses are rendered from the full mesh ({len(mesh.faces)} faces)")
 
     if symmetry_tfs is None:
-      self.symmetry_tfs = torch.eye(4).float().cuda()[None]
+      self.symmetry_tfs = torch.eye(4, dtype=torch.float, device=self.device)[None]
     else:
-      self.symmetry_tfs = torch.as_tensor(symmetry_tfs, device='cuda', dtype=torch.float)
+      self.symmetry_tfs = torch.as_tensor(symmetry_tfs, device=self.device, dtype=torch.float)
 
     logging.info("reset done")
 
 
+  def make_object_assets(self, mesh, model_normals):
+    '''Everything derived from the centered mesh, as host arrays so they can be stored in the asset cache
+    '''
+    model_pts = mesh.vertices
+    diameter = compute_mesh_diameter(model_pts=mesh.vertices, n_sample=10000)
+    vox_size = max(diameter/20.0, 0.003)
+    pcd = toOpen3dCloud(model_pts, normals=model_normals)
+    pcd = pcd.voxel_down_sample(vox_size)
+    assets = {
+      'diameter': np.asarray(diameter, dtype=np.float64),
+      'vox_size': np.asarray(vox_size, dtype=np.float64),
+      'pts': np.asarray(pcd.points, dtype=np.float32),
+      'normals': np.asarray(pcd.normals, dtype=np.float32),
+      'vertices': np.asarray(mesh.vertices),
+    }
+    mesh_arrays = mesh_tensors_to_arrays(make_mesh_tensors(mesh, device=self.device, lod_min_faces=self.lod_min_faces))
+    for k in mesh_arrays:
+      assets[f'mesh_tensors/{k}'] = mesh_arrays[k]
+    return assets
+
+
+
+  def add_object(self, ob_id, model_pts, model_normals, symmetry_tfs=None, mesh=None, activate=False):
+    '''Make an object known to the estimator so register/track_one can switch to it by ob_id.
+    Its state is built lazily on first use and kept resident until evicted by the registry budget
+    '''
+    self.object_registry.add(ob_id, model_pts=model_pts, model_normals=model_normals, symmetry_tfs=symmetry_tfs, mesh=mesh)
+    if ob_id==self.active_ob_id:
+      self.active_ob_id = None
+    if activate:
+      self.set_object(ob_id)
+
+
+  def select_object(self, ob_id):
+    '''Switch to ob_id at the start of register/track calls. An ob_id unknown to the registry is only accepted as a label of the object
+    set by reset_object while no object was added (single object scripts), once objects are registered it is an error
+    '''
+    if ob_id is None:
+      return
+    if ob_id in self.object_registry:
+      self.set_object(ob_id)
+    elif len(self.object_registry)>0:
+      raise RuntimeError(f'ob_id {ob_id} is not registered, call add_object first')
+
+
+  def get_object_state(self):
+    return {k: getattr(self, k, None) for k in OBJECT_STATE_KEYS}
+
+
+  def set_object(self, ob_id):
+    '''Switch the active object, reusing its resident state when available
+    '''
+    if ob_id==self.active_ob_id:
+      return
+    if ob_id not in self.object_registry:
+      raise RuntimeError(f'ob_id {ob_id} is not registered, call add_object first')
+
+    if self.active_ob_id is not None and self.active_ob_id in self.object_registry:
+      self.object_registry.put_state(self.active_ob_id, self.get_object_state(), keep=ob_id)
+
+    state = self.object_registry.get_state(ob_id)
+    if state is None:
+      logging.info(f"building state of object {ob_id}")
+      source = self.object_registry.get_source(ob_id)
+      self.reset_object(**source)
+      self.make_rotation_grid(min_n_views=self.min_n_views, inplane_step=self.inplane_step)
+      self.pose_last = None
+      self.track_score = None
+      self.frames_since_score = 0
+      state = self.get_object_state()
+    else:
+      for k in state:
+        setattr(self, k, state[k])
+    self.active_ob_id = ob_id
+    self.object_registry.put_state(ob_id, state)
+
+
+  def get_lod_level(self, cfg):
+    '''LOD level the crops of a scorer/refiner config are rendered at. Box crops have the same scale whatever the pose, so this is decided on the host before any render
+    '''
+    if self.lod_errors is None:
+      return 0
+    return select_lod_level(self.lod_errors, crop_px_per_meter(cfg['input_resize'], cfg['crop_ratio'], self.diameter))
+
 
   def get_tf_to_centered_mesh(self):
-    tf_to_center = torch.eye(4, dtype=torch.float, device='cuda')
-    tf_to_center[:3,3] = -torch.as_tensor(self.model_center, device='cuda', dtype=torch.float)
+    '''Cached on device, rebuilding it every frame would cost a host to device copy
+    '''
+    cached = getattr(self, 'tf_to_center_cache', None)
+    if cached is not None and cached[1].device==self.device and np.array_equal(cached[0], self.model_center):
+      return cached[1]
+    tf_to_center = torch.eye(4, dtype=torch.float, device=self.device)
+    tf_to_center[:3,3] = -torch.as_tensor(self.model_center, device=self.device, dtype=torch.float)
+    self.tf_to_center_cache = (np.array(self.model_center, copy=True), tf_to_center)
     return tf_to_center
 
 
   def to_device(self, s='cuda:0'):
+    self.device = torch.device(s)
     for k in self.__dict__:
       self.__dict__[k] = self.__dict__[k]
       if torch.is_tensor(self.__dict__[k]) or isinstance(self.__dict__[k], nn.Module):
@@ -95,42 +219,96 @@ class FoundationPose:
       logging.info(f"Moving {k} to device {s}")
       self.mesh_tensors[k] = self.mesh_tensors[k].to(s)
     if self.refiner is not None:
-      self.refiner.model.to(s)
+      self.refiner.to(s)
     if self.scorer is not None:
-      self.scorer.model.to(s)
+      self.scorer.to(s)
     if self.glctx is not None:
-      self.glctx = dr.RasterizeCudaContext(s)
+      self.glctx = make_raster_context(s)
+    if self.template_bank is not None:
+      self.template_bank.to(s)
+    self.object_registry.to_device(s)
 
 
 
   def make_rotation_grid(self, min_n_views=40, inplane_step=60):
-    cam_in_obs = sample_views_icosphere(n_views=min_n_views)
-    logging.info(f'cam_in_obs:{cam_in_obs.shape}')
-    rot_grid = []
-    for i in range(len(cam_in_obs)):
-      for inplane_rot in np.deg2rad(np.arange(0, 360, inplane_step)):
-        cam_in_ob = cam_in_obs[i]
-        R_inplane = euler_matrix(0,0,inplane_rot)
-        cam_in_ob = cam_in_ob@R_inplane
-        ob_in_cam = np.linalg.inv(cam_in_ob)
-        rot_grid.append(ob_in_cam)
-
-    rot_grid = np.asarray(rot_grid)
-    logging.info(f"rot_grid:{rot_grid.shape}")
-    rot_grid = mycpp.cluster_poses(30, 99999, rot_grid, self.symmetry_tfs.data.cpu().numpy())
-    rot_grid = np.asarray(rot_grid)
-    logging.info(f"after cluster, rot_grid:{rot_grid.shape}")
-    self.rot_grid = torch.as_tensor(rot_grid, device='cuda', dtype=torch.float)
+    self.min_n_views = min_n_views
+    self.inplane_step = inplane_step
+    symmetry_tfs = self.symmetry_tfs.data.cpu().numpy()
+    rot_grid = None
+    if self.rot_grid_cache is not None:
+      cache_key = self.rot_grid_cache.make_key(min_n_views, inplane_step, symmetry_tfs)
+      rot_grid = self.rot_grid_cache.load(cache_key)
+      if rot_grid is not None:
+        logging.info(f"rot_grid cache hit:{rot_grid.shape}")
+
+    if rot_grid is None:
+      cam_in_obs = sample_views_icosphere(n_views=min_n_views)
+      logging.info(f'cam_in_obs:{cam_in_obs.shape}')
+      rot_grid = []
+      for i in range(len(cam_in_obs)):
+        for inplane_rot in np.deg2rad(np.arange(0, 360, inplane_step)):
+          cam_in_ob = cam_in_obs[i]
+          R_inplane = euler_matrix(0,0,inplane_rot)
+          cam_in_ob = cam_in_ob@R_inplane
+          ob_in_cam = np.linalg.inv(cam_in_ob)
+          rot_grid.append(ob_in_cam)
+
+      rot_grid = np.asarray(rot_grid)
+      logging.info(f"rot_grid:{rot_grid.shape}")
+      rot_grid = mycpp.cluster_poses(30, 99999, rot_grid, symmetry_tfs)
+      rot_grid = np.asarray(rot_grid)
+      logging.info(f"after cluster, rot_grid:{rot_grid.shape}")
+      if self.rot_grid_cache is not None:
+        self.rot_grid_cache.save(cache_key, rot_grid)
+
+    self.rot_grid = torch.as_tensor(rot_grid, device=self.device, dtype=torch.float)
     logging.info(f"self.rot_grid: {self.rot_grid.shape}")
 
 
+  def make_template_bank(self, z0=None):
+    '''Render the refiner crops of every rot_grid rotation of the active object (see template_bank.py), kept in the asset cache when it is enabled.
+    register then takes the crops of its first refinement iteration from the bank instead of rasterizing them
+    @return: the bank
+    '''
+    meta = TemplateBank.make_meta(self.refiner.cfg, self.diameter, run_name=self.refiner.run_name)
+    file = None
+    if self.asset_cache.enabled:
+      key = self.asset_cache.make_key(self.mesh_ori, kind='template_bank', rot_grid=hash_arrays(self.rot_grid.data.cpu().numpy()), z0=z0, **{f'template_{k}': v for k,v in meta.items()})
+      file = f'{self.asset_cache.cache_dir}/templates_{key}.npz'
+      if os.path.exists(file):
+        self.template_bank = TemplateBank.load(file, device=self.device)
+        return self.template_bank
+    self.init_glctx()
+    self.template_bank = TemplateBank.build(self.rot_grid, mesh=self.mesh, mesh_tensors=self.mesh_tensors, mesh_diameter=self.diameter, cfg=self.refiner.cfg, glctx=self.glctx, z0=z0, run_name=self.refiner.run_name, device=self.device)
+    if file is not None:
+      self.template_bank.save(file)
+    return self.template_bank
+
+
+  def load_template_bank(self, file):
+    bank = TemplateBank.load(file, device=self.device)
+    if not bank.matches(self.rot_grid, self.refiner.cfg, self.diameter):
+      raise RuntimeError(f'template bank {file} was made for another object, rotation grid or refiner')
+    self.template_bank = bank
+    return bank
+
+
+  def get_templates(self, poses, K):
+    '''Crops of the register hypotheses from the template bank, None when they have to be rendered
+    '''
+    if self.template_bank is None or not self.template_bank.matches(self.rot_grid, self.refiner.cfg, self.diameter):
+      return None
+    return self.template_bank.get(poses, K)
+
+
   def generate_random_pose_hypo(self, K, rgb, depth, mask, scene_pts=None):
     '''
     @scene_pts: torch tensor (N,3)
     '''
-    ob_in_cams = self.rot_grid.clone()
-    center = self.guess_translation(depth=depth, mask=mask, K=K)
-    ob_in_cams[:,:3,3] = torch.tensor(center, device='cuda', dtype=torch.float).reshape(1,3)
+    with trace_span('hypothesis_generation', n_hypo=len(self.rot_grid)):
+      ob_in_cams = self.rot_grid.clone()
+      center = self.guess_translation(depth=depth, mask=mask, K=K)
+      ob_in_cams[:,:3,3] = torch.tensor(center, device=self.device, dtype=torch.float).reshape(1,3)
     return ob_in_cams
 
 
@@ -150,35 +328,71 @@ class FoundationPose:
     center = (np.linalg.inv(K)@np.asarray([uc,vc,1]).reshape(3,1))*zc
 
     if self.debug>=2:
-      pcd = toOpen3dCloud(center.reshape(1,3))
-      o3d.io.write_point_cloud(f'{self.debug_dir}/init_center.ply', pcd)
+      self.get_debug_writer().write_point_cloud(f'{self.debug_dir}/init_center.ply', center.reshape(1,3))
 
     return center.reshape(3)
 
 
-  def register(self, K, rgb, depth, ob_mask, ob_id=None, glctx=None, iteration=5):
-    '''Copmute pose from given pts to self.pcd
-    @pts: (N,3) np array, downsampled scene points
+  def guess_translation_tensor(self, depth, mask, K):
+    '''Same as guess_translation but on device tensors without any host sync. The median is the lower median
+    @depth: (H,W) tensor
+    @mask: (H,W) tensor
+    @K: (3,3) tensor
+    @return: (3,) tensor, zeros when the mask or its valid depth is empty
     '''
-    set_seed(0)
-    logging.info('Welcome')
+    H,W = mask.shape[-2:]
+    mask = mask>0
+    vs,us = torch.meshgrid(torch.arange(H, device=mask.device, dtype=torch.float), torch.arange(W, device=mask.device, dtype=torch.float), indexing='ij')
+    uc = (torch.where(mask, us, float(W)).amin()+torch.where(mask, us, -1.0).amax())/2.0
+    vc = (torch.where(mask, vs, float(H)).amin()+torch.where(mask, vs, -1.0).amax())/2.0
+    valid = mask & (depth>=0.001)
+    zc = torch.nanmedian(torch.where(valid, depth, float('nan')))
+    center = torch.stack([(uc-K[0,2])/K[0,0], (vc-K[1,2])/K[1,1], torch.ones_like(uc)])*zc   # Unprojected from fx/fy/cx/cy, linalg.inv would check for singularity on the host
+    return torch.where(valid.any(), center, torch.zeros_like(center))
+
+
+  def get_debug_writer(self):
+    if self.debug_writer is None:
+      self.debug_writer = DebugWriter(policy='block')
+    return self.debug_writer
+
+
+  def want_vis(self):
+    '''Visualization re-renders every hypothesis, so it is only produced at debug>=2 and when the debug writer can take it
+    '''
+    return self.debug>=2 and self.get_debug_writer().has_capacity()
 
+
+  def init_glctx(self, glctx=None):
     if self.glctx is None:
       if glctx is None:
-        self.glctx = dr.RasterizeCudaContext()
+        self.glctx = make_raster_context(self.device)   # Software rasterizer off cuda
         # self.glctx = dr.RasterizeGLContext()
       else:
         self.glctx = glctx
 
-    depth = erode_depth(depth, radius=2, device='cuda')
-    depth = bilateral_filter_depth(depth, radius=2, device='cuda')
+
+  def register(self, K, rgb, depth, ob_mask, ob_id=None, glctx=None, iteration=5, prune_schedule=None, score_topk=None):
+    '''Copmute pose from given pts to self.pcd
+    @pts: (N,3) np array, downsampled scene points
+    @prune_schedule: optional successive halving, see refine_with_pruning
+    @score_topk: score with the bounded memory tournament of ScorePredictor.predict_topk and only keep the best score_topk poses in self.poses/self.scores
+    '''
+    set_seed(0)
+    logging.info('Welcome')
+    self.select_object(ob_id)
+
+    self.init_glctx(glctx)
+
+    with trace_span('depth_filter'):
+      depth = erode_depth(depth, radius=2, device=self.device)
+      depth = bilateral_filter_depth(depth, radius=2, device=self.device)
 
     if self.debug>=2:
       xyz_map = depth2xyzmap(depth, K)
       valid = xyz_map[...,2]>=0.001
-      pcd = toOpen3dCloud(xyz_map[valid], rgb[valid])
-      o3d.io.write_point_cloud(f'{self.debug_dir}/scene_raw.ply',pcd)
-      cv2.imwrite(f'{self.debug_dir}/ob_mask.png', (ob_mask*255.0).clip(0,255))
+      self.get_debug_writer().write_point_cloud(f'{self.debug_dir}/scene_raw.ply', xyz_map[valid], rgb[valid])
+      self.get_debug_writer().write_cv2_image(f'{self.debug_dir}/ob_mask.png', (ob_mask*255.0).clip(0,255))
 
     normal_map = None
     valid = (depth>=0.001) & (ob_mask>0)
@@ -189,11 +403,10 @@ class FoundationPose:
       return pose
 
     if self.debug>=2:
-      imageio.imwrite(f'{self.debug_dir}/color.png', rgb)
-      cv2.imwrite(f'{self.debug_dir}/depth.png', (depth*1000).astype(np.uint16))
+      self.get_debug_writer().write_image(f'{self.debug_dir}/color.png', rgb)
+      self.get_debug_writer().write_cv2_image(f'{self.debug_dir}/depth.png', (depth*1000).astype(np.uint16))
       valid = xyz_map[...,2]>=0.001
-      pcd = toOpen3dCloud(xyz_map[valid], rgb[valid])
-      o3d.io.write_point_cloud(f'{self.debug_dir}/scene_complete.ply',pcd)
+      self.get_debug_writer().write_point_cloud(f'{self.debug_dir}/scene_complete.ply', xyz_map[valid], rgb[valid])
 
     self.H, self.W = depth.shape[:2]
     self.K = K
@@ -201,31 +414,32 @@ class FoundationPose:
     self.ob_mask = ob_mask
 
     poses = self.generate_random_pose_hypo(K=K, rgb=rgb, depth=depth, mask=ob_mask, scene_pts=None)
-    poses = poses.data.cpu().numpy()
     logging.info(f'poses:{poses.shape}')
-    center = self.guess_translation(depth=depth, mask=ob_mask, K=K)
-
-    poses = torch.as_tensor(poses, device='cuda', dtype=torch.float)
-    poses[:,:3,3] = torch.as_tensor(center.reshape(1,3), device='cuda')
 
     add_errs = self.compute_add_err_to_gt_pose(poses)
     logging.info(f"after viewpoint, add_errs min:{add_errs.min()}")
 
     xyz_map = depth2xyzmap(depth, K)
-    poses, vis = self.refiner.predict(mesh=self.mesh, mesh_tensors=self.mesh_tensors, rgb=rgb, depth=depth, K=K, ob_in_cams=poses.data.cpu().numpy(), normal_map=normal_map, xyz_map=xyz_map, glctx=self.glctx, mesh_diameter=self.diameter, iteration=iteration, get_vis=self.debug>=2)
-    if vis is not None:
-      imageio.imwrite(f'{self.debug_dir}/vis_refiner.png', vis)
-
-    scores, vis = self.scorer.predict(mesh=self.mesh, rgb=rgb, depth=depth, K=K, ob_in_cams=poses.data.cpu().numpy(), normal_map=normal_map, mesh_tensors=self.mesh_tensors, glctx=self.glctx, mesh_diameter=self.diameter, get_vis=self.debug>=2)
+    templates = self.get_templates(poses, K)
+    if prune_schedule is None:
+      poses, vis = self.refiner.predict(mesh=self.mesh, mesh_tensors=self.mesh_tensors, rgb=rgb, depth=depth, K=K, ob_in_cams=poses, normal_map=normal_map, xyz_map=xyz_map, glctx=self.glctx, mesh_diameter=self.diameter, iteration=iteration, get_vis=self.want_vis(), templates=templates, lod_level=self.get_lod_level(self.refiner.cfg))
+    else:
+      poses, vis = self.refine_with_pruning(rgb=rgb, depth=depth, K=K, ob_in_cams=poses, xyz_map=xyz_map, iteration=iteration, prune_schedule=prune_schedule, templates=templates)
     if vis is not None:
-      imageio.imwrite(f'{self.debug_dir}/vis_score.png', vis)
+      self.get_debug_writer().write_image(f'{self.debug_dir}/vis_refiner.png', vis)
 
     add_errs = self.compute_add_err_to_gt_pose(poses)
     logging.info(f"final, add_errs min:{add_errs.min()}")
 
-    ids = torch.as_tensor(scores).argsort(descending=True)
+    if score_topk is None:
+      scores, vis = self.scorer.predict(mesh=self.mesh, rgb=rgb, depth=depth, K=K, ob_in_cams=poses, normal_map=normal_map, mesh_tensors=self.mesh_tensors, glctx=self.glctx, mesh_diameter=self.diameter, get_vis=self.want_vis(), lod_level=self.get_lod_level(self.scorer.cfg))
+      if vis is not None:
+        self.get_debug_writer().write_image(f'{self.debug_dir}/vis_score.png', vis)
+      ids = torch.as_tensor(scores).argsort(descending=True)
+      scores = scores[ids]
+    else:
+      ids, scores = self.scorer.predict_topk(mesh=self.mesh, rgb=rgb, depth=depth, K=K, ob_in_cams=poses, k=score_topk, normal_map=normal_map, mesh_tensors=self.mesh_tensors, glctx=self.glctx, mesh_diameter=self.diameter, lod_level=self.get_lod_level(self.scorer.cfg))
     logging.info(f'sort ids:{ids}')
-    scores = scores[ids]
     poses = poses[ids]
 
     logging.info(f'sorted scores:{scores}')
@@ -236,35 +450,365 @@ class FoundationPose:
 
     self.poses = poses
     self.scores = scores
+    self.track_score = None   # Tracking confidence, measured by the tracking gate (see score_pose_last)
+    with trace_span('result_conversion'):
+      self.frames_since_score = 0
+      best_pose = best_pose.data.cpu().numpy()
+
+    return best_pose
+
+
+  def refine_with_pruning(self, rgb, depth, K, ob_in_cams, xyz_map, iteration, prune_schedule, templates=None):
+    '''Successive halving: score the hypotheses after some refiner iterations and only keep refining the best ones
+    @prune_schedule: dict with
+      milestones: list of (iteration, keep_ratio), e.g. [(1,0.25),(3,0.25)] scores after the 1st and 3rd iteration and keeps the top 25% each time
+      min_keep: never keep fewer hypotheses than this, default 1
+      early_stop_margin: if the leader's score logit beats the runner-up by this much, only the leader is refined further
+    @templates: crops of ob_in_cams for the first iteration, see get_templates
+    @return: refined poses (M,4,4) torch tensor of the survivors, vis
+    '''
+    milestones = dict(prune_schedule.get('milestones', []))
+    min_keep = prune_schedule.get('min_keep', 1)
+    early_stop_margin = prune_schedule.get('early_stop_margin', None)
+    checkpoints = sorted(k for k in milestones if 0<k<iteration)
+
+    poses = ob_in_cams
+    done = 0
+    vis = None
+    for k in checkpoints+[iteration]:
+      last = k==iteration
+      poses, vis = self.refiner.predict(mesh=self.mesh, mesh_tensors=self.mesh_tensors, rgb=rgb, depth=depth, K=K, ob_in_cams=poses, normal_map=None, xyz_map=xyz_map, glctx=self.glctx, mesh_diameter=self.diameter, iteration=k-done, get_vis=last and self.want_vis(), templates=templates if done==0 else None, lod_level=self.get_lod_level(self.refiner.cfg))
+      done = k
+      if last or len(poses)<=1:
+        continue
+      scores, _ = self.scorer.predict(mesh=self.mesh, rgb=rgb, depth=depth, K=K, ob_in_cams=poses, normal_map=None, mesh_tensors=self.mesh_tensors, glctx=self.glctx, mesh_diameter=self.diameter, lod_level=self.get_lod_level(self.scorer.cfg))
+      ids = scores.argsort(descending=True)
+      n_keep = min(len(poses), max(min_keep, int(np.ceil(len(poses)*milestones[k]))))
+      if early_stop_margin is not None and scores[ids[0]]-scores[ids[1]]>=early_stop_margin:
+        logging.info(f'leader is decisive after iteration {k}, margin:{scores[ids[0]]-scores[ids[1]]}')
+        n_keep = 1
+      poses = poses[ids[:n_keep]]
+      logging.info(f'after iteration {k}, keep {n_keep} hypotheses')
+
+    return poses, vis
+
+
+  def register_batch(self, frames, ob_id=None, glctx=None, iteration=5, max_frames_per_batch=4):
+    '''Register several frames of the same object, packing their hypotheses into shared refiner and scorer forward passes
+    @frames: list of (K, rgb, depth, ob_mask), all frames must have the same resolution
+    @max_frames_per_batch: frames packed together, bounds the memory of the crops
+    @return: list of (4,4) np array, one pose per frame wrt. the original mesh
+    The tracking state (pose_last, poses, scores, best_id, track_score) and the frame state (H, W, K, ob_mask, ob_id) are all set from the last frame that could be refined, as register would for that frame
+    '''
+    set_seed(0)
+    logging.info('Welcome')
+    self.select_object(ob_id)
+    self.init_glctx(glctx)
+
+    H,W = frames[0][2].shape[:2]
+    for K,rgb,depth,ob_mask in frames:
+      if depth.shape[:2]!=(H,W):
+        raise RuntimeError(f'all frames must have the same resolution, got {depth.shape[:2]} and {(H,W)}')
+
+    poses_out = [None]*len(frames)
+    todo = []
+    for i,(K,rgb,depth,ob_mask) in enumerate(frames):
+      with trace_span('depth_filter'):
+        depth = erode_depth(depth, radius=2, device=self.device)
+        depth = bilateral_filter_depth(depth, radius=2, device=self.device)
+      valid = (depth>=0.001) & (ob_mask>0)
+      if valid.sum()<4:
+        logging.info(f'frame {i} valid too small')
+        pose = np.eye(4)
+        pose[:3,3] = self.guess_translation(depth=depth, mask=ob_mask, K=K)
+        poses_out[i] = pose
+        continue
+      todo.append((i, K, rgb, depth, ob_mask))
+
+    n_hypo = len(self.rot_grid)
+    for start in range(0, len(todo), max_frames_per_batch):
+      chunk = todo[start:start+max_frames_per_batch]
+      Ks = np.stack([np.asarray(K, dtype=np.float32) for _,K,_,_,_ in chunk])
+      rgbs = np.stack([rgb for _,_,rgb,_,_ in chunk])
+      depths = np.stack([depth for _,_,_,depth,_ in chunk])
+      xyz_maps = np.stack([depth2xyzmap(depth, K) for _,K,_,depth,_ in chunk])
+      poses = []
+      for _,K,rgb,depth,ob_mask in chunk:
+        poses.append(self.generate_random_pose_hypo(K=K, rgb=rgb, depth=depth, mask=ob_mask, scene_pts=None))
+      poses = torch.cat(poses, dim=0)
+      frame_ids = torch.arange(len(chunk), device=self.device).repeat_interleave(n_hypo)
+      logging.info(f'frames:{len(chunk)}, poses:{poses.shape}')
+
+      poses, _ = self.refiner.predict(mesh=self.mesh, mesh_tensors=self.mesh_tensors, rgb=rgbs, depth=depths, K=Ks, ob_in_cams=poses, normal_map=None, xyz_map=xyz_maps, glctx=self.glctx, mesh_diameter=self.diameter, iteration=iteration, frame_ids=frame_ids, lod_level=self.get_lod_level(self.refiner.cfg))
+      scores, _ = self.scorer.predict(mesh=self.mesh, rgb=rgbs, depth=depths, K=Ks, ob_in_cams=poses, normal_map=None, mesh_tensors=self.mesh_tensors, glctx=self.glctx, mesh_diameter=self.diameter, frame_ids=frame_ids, group_size=n_hypo, lod_level=self.get_lod_level(self.scorer.cfg))
+
+      poses = poses.reshape(len(chunk), n_hypo, 4, 4)
+      best_ids = scores.reshape(len(chunk), n_hypo).argmax(dim=1)
+      best_poses = poses[torch.arange(len(chunk), device=poses.device), best_ids]
+      best_poses_ori = (best_poses@self.get_tf_to_centered_mesh()[None]).data.cpu().numpy()
+      for j,(i,_,_,_,_) in enumerate(chunk):
+        poses_out[i] = best_poses_ori[j]
+
+      if start+max_frames_per_batch>=len(todo):
+        _, K, _, depth, ob_mask = chunk[-1]
+        self.H, self.W = depth.shape[:2]
+        self.K = K
+        self.ob_id = ob_id
+        self.ob_mask = ob_mask
+        ids = scores.reshape(len(chunk), n_hypo)[-1].argsort(descending=True)
+        self.poses = poses[-1][ids]
+        self.scores = scores.reshape(len(chunk), n_hypo)[-1][ids]
+        self.best_id = ids[0]
+        self.pose_last = self.poses[0]
+        self.track_score = None
+        self.frames_since_score = 0
+
+    return poses_out
+
+
+  def register_instances(self, K, rgb, depth, masks, ob_id=None, glctx=None, iteration=5, max_instances_per_batch=4):
+    '''Register several instances of the same object visible in one image. The frame is preprocessed once and
+    the hypotheses of all instances are refined and scored in shared batches, each instance ranked as its own set
+    @masks: list of (H,W) instance masks
+    @return: poses (N,4,4) np array wrt. the original mesh, scores (N,) np array. Instances with too few valid pixels get the guessed translation and score -inf
+    '''
+    set_seed(0)
+    logging.info('Welcome')
+    self.select_object(ob_id)
+    self.init_glctx(glctx)
+
+    with trace_span('depth_filter'):
+      depth = erode_depth(depth, radius=2, device=self.device)
+      depth = bilateral_filter_depth(depth, radius=2, device=self.device)
+      xyz_map = depth2xyzmap(depth, K)
 
-    return best_pose.data.cpu().numpy()
+    poses_out = np.tile(np.eye(4)[None], (len(masks),1,1))
+    scores_out = np.full((len(masks)), -np.inf)
+    todo = []
+    for i,mask in enumerate(masks):
+      valid = (depth>=0.001) & (mask>0)
+      if valid.sum()<4:
+        logging.info(f'instance {i} valid too small')
+        poses_out[i,:3,3] = self.guess_translation(depth=depth, mask=mask, K=K)
+        continue
+      todo.append(i)
+
+    n_hypo = len(self.rot_grid)
+    for start in range(0, len(todo), max_instances_per_batch):
+      chunk = todo[start:start+max_instances_per_batch]
+      poses = torch.cat([self.generate_random_pose_hypo(K=K, rgb=rgb, depth=depth, mask=masks[i], scene_pts=None) for i in chunk], dim=0)
+      logging.info(f'instances:{len(chunk)}, poses:{poses.shape}')
+
+      poses, _ = self.refiner.predict(mesh=self.mesh, mesh_tensors=self.mesh_tensors, rgb=rgb, depth=depth, K=K, ob_in_cams=poses, normal_map=None, xyz_map=xyz_map, glctx=self.glctx, mesh_diameter=self.diameter, iteration=iteration, lod_level=self.get_lod_level(self.refiner.cfg))
+      scores, _ = self.scorer.predict(mesh=self.mesh, rgb=rgb, depth=depth, K=K, ob_in_cams=poses, normal_map=None, mesh_tensors=self.mesh_tensors, glctx=self.glctx, mesh_diameter=self.diameter, group_size=n_hypo, lod_level=self.get_lod_level(self.scorer.cfg))
+
+      poses = poses.reshape(len(chunk), n_hypo, 4, 4)
+      scores = scores.reshape(len(chunk), n_hypo)
+      best_scores, best_ids = scores.max(dim=1)
+      best_poses = poses[torch.arange(len(chunk), device=poses.device), best_ids]
+      best_poses = (best_poses@self.get_tf_to_centered_mesh()[None]).data.cpu().numpy()
+      best_scores = best_scores.data.cpu().numpy()
+      for j,i in enumerate(chunk):
+        poses_out[i] = best_poses[j]
+        scores_out[i] = best_scores[j]
+
+    return poses_out, scores_out
 
 
   def compute_add_err_to_gt_pose(self, poses):
     '''
     @poses: wrt. the centered mesh
     '''
-    return -torch.ones(len(poses), device='cuda', dtype=torch.float)
+    return -torch.ones(len(poses), device=self.device, dtype=torch.float)
+
+
+  def set_tracking_gate(self, score_interval=10, score_thres=None, trans_update_thres=None, rot_update_thres=None, register_iteration=5, n_perturb=16, perturb_rot_deg=10, perturb_trans_ratio=0.05):
+    '''Make track_one verify the tracked pose with the scorer and fall back to register when confidence drops.
+    The scorer's logits come from attention across the set of poses scored together, so a pose alone has no meaningful score.
+    The tracked pose is scored in a set with fixed perturbations of itself instead, its confidence is the fraction of them it beats
+    @score_interval: score the tracked pose every this many frames
+    @score_thres: confidence in [0,1] below which tracking is considered lost, e.g. 0.8
+    @trans_update_thres: meters, score right away when the refiner's last translation update is larger (cheap drift trigger)
+    @rot_update_thres: radian, same for the last rotation update
+    @register_iteration: refiner iterations of the fallback register
+    @n_perturb: number of perturbed poses scored with the tracked one
+    @perturb_rot_deg: rotation of each perturbation about a random axis
+    @perturb_trans_ratio: translation of each perturbation along a random direction, times the object diameter
+    '''
+    self.track_gate = dict(score_interval=score_interval, score_thres=score_thres, trans_update_thres=trans_update_thres, rot_update_thres=rot_update_thres, register_iteration=register_iteration)
+    rng = np.random.RandomState(0)
+    perturbations = []
+    for _ in range(n_perturb):
+      axis = rng.normal(size=3)
+      direction = rng.normal(size=3)
+      tf = rotation_matrix(np.deg2rad(perturb_rot_deg), axis/np.linalg.norm(axis))
+      tf[:3,3] = direction/np.linalg.norm(direction)*perturb_trans_ratio   # Scaled by the diameter of the object tracked at the time
+      perturbations.append(tf)
+    self.track_perturbations = torch.as_tensor(np.asarray(perturbations), dtype=torch.float, device=self.device)
+
+
+  def score_tracking(self, rgb, depth, K):
+    '''Score the tracked pose if the gate's interval or drift triggers fire
+    @depth: filtered depth
+    @return: score or None if not scored this frame
+    '''
+    gate = self.track_gate
+    self.frames_since_score += 1
+    triggered = self.frames_since_score>=gate['score_interval']
+    if not triggered and gate['trans_update_thres'] is not None and self.refiner.last_trans_update is not None:
+      triggered = self.refiner.last_trans_update.norm(dim=-1).max().item()>gate['trans_update_thres']
+    if not triggered and gate['rot_update_thres'] is not None and self.refiner.last_rot_update is not None:
+      R = self.refiner.last_rot_update
+      cos = ((R[:,0,0]+R[:,1,1]+R[:,2,2]-1)/2).clip(-1,1)
+      triggered = torch.acos(cos).max().item()>gate['rot_update_thres']
+    if not triggered:
+      return None
+    return self.score_pose_last(rgb=rgb, depth=depth, K=K)
+
+
+  def score_pose_last(self, rgb, depth, K):
+    '''Confidence of self.pose_last in [0,1], the fraction of its perturbations (see set_tracking_gate) that score below it in the same set
+    @depth: filtered depth
+    '''
+    deltas = self.track_perturbations
+    poses = self.pose_last.reshape(1,4,4).repeat(1+len(deltas),1,1)
+    poses[1:,:3,:3] = poses[1:,:3,:3]@deltas[:,:3,:3]
+    poses[1:,:3,3] += deltas[:,:3,3]*self.diameter
+    scores, _ = self.scorer.predict(mesh=self.mesh, rgb=rgb, depth=depth, K=K, ob_in_cams=poses, normal_map=None, mesh_tensors=self.mesh_tensors, glctx=self.glctx, mesh_diameter=self.diameter, lod_level=self.get_lod_level(self.scorer.cfg))
+    self.frames_since_score = 0
+    return float((scores[1:]<scores[0]).float().mean())
+
+
+  def preprocess_depth(self, depth, K):
+    '''Depth filtering and xyz map used by track_one, split out so a pipeline can run it ahead of the refiner.
+    Stateless, TrackPipeline calls it from another thread and stream while the estimator is tracking
+    @return: filtered depth (H,W) and xyz_map (H,W,3) torch tensors
+    '''
+    with trace_span('depth_filter'):
+      depth = torch.as_tensor(depth, device=self.device, dtype=torch.float)
+      depth = erode_depth(depth, radius=2, device=self.device)
+      depth = bilateral_filter_depth(depth, radius=2, device=self.device)
+      logging.info("depth processing done")
+
+      xyz_map = depth2xyzmap_batch(depth[None], device_constants.get(K, self.device)[None], zfar=np.inf)[0]
+    return depth, xyz_map
 
 
-  def track_one(self, rgb, depth, K, iteration, extra={}):
+  def track_one(self, rgb, depth, K, iteration, extra={}, ob_id=None, ob_mask=None, preprocessed=None):
+    '''
+    @ob_mask: only used by the tracking gate (see set_tracking_gate) to re-register when confidence drops
+    @preprocessed: optional output of preprocess_depth for this frame
+    '''
+    self.select_object(ob_id)
     if self.pose_last is None:
       logging.info("Please init pose by register first")
       raise RuntimeError
     logging.info("Welcome")
+    depth_raw = depth
 
-    depth = torch.as_tensor(depth, device='cuda', dtype=torch.float)
-    depth = erode_depth(depth, radius=2, device='cuda')
-    depth = bilateral_filter_depth(depth, radius=2, device='cuda')
-    logging.info("depth processing done")
-
-    xyz_map = depth2xyzmap_batch(depth[None], torch.as_tensor(K, dtype=torch.float, device='cuda')[None], zfar=np.inf)[0]
+    if preprocessed is None:
+      depth, xyz_map = self.preprocess_depth(depth, K)
+    else:
+      depth, xyz_map = preprocessed
 
-    pose, vis = self.refiner.predict(mesh=self.mesh, mesh_tensors=self.mesh_tensors, rgb=rgb, depth=depth, K=K, ob_in_cams=self.pose_last.reshape(1,4,4).data.cpu().numpy(), normal_map=None, xyz_map=xyz_map, mesh_diameter=self.diameter, glctx=self.glctx, iteration=iteration, get_vis=self.debug>=2)
+    pose, vis = self.refiner.predict(mesh=self.mesh, mesh_tensors=self.mesh_tensors, rgb=rgb, depth=depth, K=K, ob_in_cams=self.pose_last.reshape(1,4,4), normal_map=None, xyz_map=xyz_map, mesh_diameter=self.diameter, glctx=self.glctx, iteration=iteration, get_vis=self.want_vis(), lod_level=self.get_lod_level(self.refiner.cfg))
     logging.info("pose done")
     if self.debug>=2:
       extra['vis'] = vis
     self.pose_last = pose
-    return (pose@self.get_tf_to_centered_mesh()).data.cpu().numpy().reshape(4,4)
 
+    if self.track_gate is not None:
+      score = self.score_tracking(rgb=rgb, depth=depth, K=K)
+      if score is not None:
+        self.track_score = score
+      extra['score'] = self.track_score
+      extra['scored'] = score is not None
+      extra['reregistered'] = False
+      score_thres = self.track_gate['score_thres']
+      if score is not None and score_thres is not None and score<score_thres:
+        if ob_mask is not None:
+          logging.info(f'tracking score {score} below {score_thres}, re-register')
+          if torch.is_tensor(depth_raw):
+            depth_raw = depth_raw.data.cpu().numpy()
+          pose_tracked = self.pose_last
+          pose_registered = self.register(K=K, rgb=rgb, depth=depth_raw, ob_mask=ob_mask, iteration=self.track_gate['register_iteration'])
+          if self.pose_last is not pose_tracked:   # register refined and scored a new pose, not just a translation guess from too few valid pixels
+            self.track_score = self.score_pose_last(rgb=rgb, depth=depth, K=K)
+            extra['score'] = self.track_score
+            extra['reregistered'] = True
+            return pose_registered
+          logging.info('too few valid pixels in the mask to re-register')
+        else:
+          logging.info(f'tracking score {score} below {score_thres}, no mask to re-register')
+
+    with trace_span('result_conversion'):
+      pose = (pose@self.get_tf_to_centered_mesh()).data.cpu().numpy().reshape(4,4)
+    return pose
+
+
+  def register_tensor(self, K, rgb, depth, ob_mask, ob_id=None, glctx=None, iteration=5):
+    '''register for inputs already on the device (e.g. from a gpu decoder). Nothing is copied back to the host and
+    nothing waits for the device, so calls can be queued behind other work. Debug artifacts are not written
+    @K: (3,3), @rgb: (H,W,3), @depth: (H,W), @ob_mask: (H,W), tensors or np arrays
+    @return: (4,4) tensor on self.device wrt. the original mesh. Like register, with fewer than 4 valid pixels it is the guessed translation
+    '''
+    set_seed(0)
+    self.select_object(ob_id)
+    self.init_glctx(glctx)
+
+    K = torch.as_tensor(K, device=self.device, dtype=torch.float)
+    rgb = torch.as_tensor(rgb, device=self.device, dtype=torch.float)
+    ob_mask = torch.as_tensor(ob_mask, device=self.device)
+    depth, xyz_map = self.preprocess_depth(depth, K)
+
+    valid = (depth>=0.001) & (ob_mask>0)
+    center = self.guess_translation_tensor(depth=depth, mask=ob_mask, K=K)
+    with trace_span('hypothesis_generation', n_hypo=len(self.rot_grid)):
+      poses = self.rot_grid.clone()
+      poses[:,:3,3] = center.reshape(1,3)
+
+    self.H, self.W = depth.shape[:2]
+    self.K = K
+    self.ob_id = ob_id
+    self.ob_mask = ob_mask
+
+    poses, _ = self.refiner.predict(mesh=self.mesh, mesh_tensors=self.mesh_tensors, rgb=rgb, depth=depth, K=K, ob_in_cams=poses, normal_map=None, xyz_map=xyz_map, glctx=self.glctx, mesh_diameter=self.diameter, iteration=iteration, lod_level=self.get_lod_level(self.refiner.cfg))
+    scores, _ = self.scorer.predict(mesh=self.mesh, rgb=rgb, depth=depth, K=K, ob_in_cams=poses, normal_map=None, mesh_tensors=self.mesh_tensors, glctx=self.glctx, mesh_diameter=self.diameter, lod_level=self.get_lod_level(self.scorer.cfg))
+
+    ids = scores.argsort(descending=True)
+    scores = scores[ids]
+    poses = poses[ids]
+
+    fallback = torch.eye(4, device=self.device, dtype=torch.float)
+    fallback[:3,3] = center
+    pose_last = torch.where(valid.sum()>=4, poses[0], fallback)
+    self.pose_last = pose_last
+    self.best_id = ids[0]
+    self.poses = poses
+    self.scores = scores
+    self.track_score = None   # Like register, the tracking confidence is only measured by the tracking gate
+    self.frames_since_score = 0
+
+    return pose_last@self.get_tf_to_centered_mesh()
+
+
+  def track_one_tensor(self, rgb, depth, K, iteration, ob_id=None, preprocessed=None):
+    '''track_one for inputs already on the device, the pose stays on the device. The tracking gate is not applied,
+    it needs the score on the host to decide whether to re-register
+    @return: (4,4) tensor on self.device wrt. the original mesh
+    '''
+    self.select_object(ob_id)
+    if self.pose_last is None:
+      logging.info("Please init pose by register first")
+      raise RuntimeError
+
+    K = torch.as_tensor(K, device=self.device, dtype=torch.float)
+    rgb = torch.as_tensor(rgb, device=self.device, dtype=torch.float)
+    if preprocessed is None:
+      depth, xyz_map = self.preprocess_depth(depth, K)
+    else:
+      depth, xyz_map = preprocessed
 
+    pose, _ = self.refiner.predict(mesh=self.mesh, mesh_tensors=self.mesh_tensors, rgb=rgb, depth=depth, K=K, ob_in_cams=self.pose_last.reshape(1,4,4), normal_map=None, xyz_map=xyz_map, mesh_diameter=self.diameter, glctx=self.glctx, iteration=iteration, lod_level=self.get_lod_level(self.refiner.cfg))
+    self.pose_last = pose.reshape(4,4)
+    return self.pose_last@self.get_tf_to_centered_mesh()
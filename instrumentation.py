@@ -0,0 +1,273 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+import os,time,json,threading,logging
+from contextlib import nullcontext
+import numpy as np
+import torch
+
+
+_NULL_SPAN = nullcontext()
+
+
+class PeakMemoryWatch:
+  '''Peak allocated device memory of nested or concurrent scopes (spans, MemoryBudget.measure), on any thread.
+  torch keeps one peak counter per device, a reset from one thread would wipe the peak another thread is measuring.
+  So resets only happen here under a lock, after the current peak has been folded into every open scope of the device
+  '''
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.scopes = {}   # id -> [device index, peak folded so far]
+    self.next_id = 0
+
+
+  @staticmethod
+  def device_index(device):
+    device = torch.device('cuda') if device is None else torch.device(device)
+    return device.index if device.index is not None else torch.cuda.current_device()
+
+
+  def start(self, device=None):
+    '''@return: id to pass to stop
+    '''
+    index = self.device_index(device)
+    with self.lock:
+      peak = torch.cuda.max_memory_allocated(index)
+      for scope in self.scopes.values():
+        if scope[0]==index:
+          scope[1] = max(scope[1], peak)
+      torch.cuda.reset_peak_memory_stats(index)
+      scope_id = self.next_id
+      self.next_id += 1
+      self.scopes[scope_id] = [index, 0]
+    return scope_id
+
+
+  def stop(self, scope_id):
+    '''@return: peak bytes allocated on the device since start, including what concurrent work allocated
+    '''
+    with self.lock:
+      index, peak = self.scopes.pop(scope_id)
+      return max(peak, torch.cuda.max_memory_allocated(index))
+
+
+peak_memory = PeakMemoryWatch()
+
+
+class NullTracer:
+  '''Installed by default, span() hands back a shared no-op context so disabled tracing costs a method call
+  '''
+  enabled = False
+
+  def span(self, name, **meta):
+    return _NULL_SPAN
+
+
+
+class Span:
+  def __init__(self, tracer, name, meta):
+    self.tracer = tracer
+    self.name = name
+    self.meta = meta
+    self.peak = 0
+
+
+  def __enter__(self):
+    tracer = self.tracer
+    stack = tracer.get_stack()
+    if tracer.record_memory:
+      self.memory_scope = peak_memory.start()
+    self.parent = stack[-1].name if stack else None
+    stack.append(self)
+    self.start_event = None
+    if tracer.cuda_events:
+      tracer.ensure_ref_event()
+      self.start_event = torch.cuda.Event(enable_timing=True)
+      self.start_event.record()
+    self.begin = time.perf_counter()
+    return self
+
+
+  def __exit__(self, *exc):
+    tracer = self.tracer
+    end = time.perf_counter()
+    end_event = None
+    if self.start_event is not None:
+      end_event = torch.cuda.Event(enable_timing=True)
+      end_event.record()
+    stack = tracer.get_stack()
+    stack.pop()
+    record = {
+      'name': self.name,
+      'parent': self.parent,
+      'depth': len(stack),
+      'tid': threading.get_ident(),
+      'thread': threading.current_thread().name,
+      'begin_ms': (self.begin-tracer.t0)*1000,
+      'wall_ms': (end-self.begin)*1000,
+      'meta': self.meta,
+    }
+    if tracer.record_memory:
+      self.peak = peak_memory.stop(self.memory_scope)
+      record['peak_mem_bytes'] = self.peak
+    tracer.add_record(record, self.start_event, end_event)
+    return False
+
+
+
+class Tracer:
+  '''Records wall time, device time (cuda events), peak device memory and caller metadata (e.g. hypothesis counts) of named spans.
+  Device times are only resolved when the records are read, so tracing never forces a sync inside the traced code.
+  Spans nest and may come from several threads, each thread keeps its own stack
+  '''
+  enabled = True
+
+  def __init__(self, cuda_events=None, record_memory=None):
+    '''
+    @cuda_events: time the device with cuda events, default when cuda is available
+    @record_memory: peak torch allocator memory per span, default when cuda is available
+    '''
+    has_cuda = torch.cuda.is_available()
+    self.cuda_events = has_cuda if cuda_events is None else cuda_events
+    self.record_memory = has_cuda if record_memory is None else record_memory
+    self.local = threading.local()
+    self.lock = threading.Lock()
+    self.reset()
+
+
+  def reset(self):
+    with self.lock:
+      self.records = []
+      self.events = []
+      self.ref_event = None
+      self.t0 = time.perf_counter()
+
+
+  def get_stack(self):
+    if not hasattr(self.local, 'stack'):
+      self.local.stack = []
+    return self.local.stack
+
+
+  def ensure_ref_event(self):
+    '''Device timestamps are measured from this event so device spans can be laid out on the same timeline
+    '''
+    if self.ref_event is None:
+      with self.lock:
+        if self.ref_event is None:
+          self.ref_event = torch.cuda.Event(enable_timing=True)
+          self.ref_event.record()
+          self.ref_wall_ms = (time.perf_counter()-self.t0)*1000
+
+
+  def span(self, name, **meta):
+    return Span(self, name, meta)
+
+
+  def add_record(self, record, start_event, end_event):
+    with self.lock:
+      self.records.append(record)
+      self.events.append((start_event, end_event))
+
+
+  def get_records(self):
+    '''@return: list of dict, one per finished span, with device_ms/device_begin_ms filled in when timed with cuda events
+    '''
+    with self.lock:
+      records = list(self.records)
+      events = list(self.events)
+    if any(e[0] is not None for e in events):
+      torch.cuda.synchronize()
+    for record,(start_event,end_event) in zip(records, events):
+      if start_event is None or 'device_ms' in record:
+        continue
+      record['device_ms'] = start_event.elapsed_time(end_event)
+      record['device_begin_ms'] = self.ref_wall_ms+self.ref_event.elapsed_time(start_event)
+    return records
+
+
+  def summary(self):
+    '''@return: dict name -> count and wall/device time statistics in ms
+    '''
+    groups = {}
+    for record in self.get_records():
+      groups.setdefault(record['name'], []).append(record)
+    out = {}
+    for name,records in groups.items():
+      wall = np.array([r['wall_ms'] for r in records])
+      stats = {
+        'count': len(records),
+        'wall_ms_total': float(wall.sum()),
+        'wall_ms_mean': float(wall.mean()),
+        'wall_ms_p50': float(np.percentile(wall, 50)),
+        'wall_ms_p95': float(np.percentile(wall, 95)),
+      }
+      if 'device_ms' in records[0]:
+        device = np.array([r['device_ms'] for r in records])
+        stats['device_ms_total'] = float(device.sum())
+        stats['device_ms_mean'] = float(device.mean())
+      if 'peak_mem_bytes' in records[0]:
+        stats['peak_mem_bytes'] = int(max(r['peak_mem_bytes'] for r in records))
+      out[name] = stats
+    return out
+
+
+  def export_json(self, out_file):
+    os.makedirs(os.path.dirname(os.path.abspath(out_file)), exist_ok=True)
+    with open(out_file, 'w') as ff:
+      json.dump({'summary': self.summary(), 'records': self.get_records()}, ff, indent=2, default=str)
+    logging.info(f"trace saved to {out_file}")
+
+
+  def export_chrome_trace(self, out_file):
+    '''Chrome trace event format, open with chrome://tracing or https://ui.perfetto.dev
+    Host spans are laid out per thread, device spans on an extra 'cuda' track
+    '''
+    pid = os.getpid()
+    trace_events = []
+    tids = {}
+    for record in self.get_records():
+      tids[record['tid']] = record['thread']
+      args = dict(record['meta'])
+      for k in ['device_ms', 'peak_mem_bytes']:
+        if k in record:
+          args[k] = record[k]
+      trace_events.append({'name': record['name'], 'ph': 'X', 'pid': pid, 'tid': record['tid'], 'ts': record['begin_ms']*1000, 'dur': record['wall_ms']*1000, 'args': args})
+      if 'device_ms' in record:
+        trace_events.append({'name': record['name'], 'ph': 'X', 'pid': pid, 'tid': 'cuda', 'ts': record['device_begin_ms']*1000, 'dur': record['device_ms']*1000, 'args': dict(record['meta'])})
+    for tid,thread_name in tids.items():
+      trace_events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': thread_name}})
+    os.makedirs(os.path.dirname(os.path.abspath(out_file)), exist_ok=True)
+    with open(out_file, 'w') as ff:
+      json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, ff, default=str)
+    logging.info(f"chrome trace saved to {out_file}")
+
+
+
+_tracer = NullTracer()
+
+
+def get_tracer():
+  return _tracer
+
+
+def set_tracer(tracer):
+  '''Install a Tracer process wide, None disables tracing
+  @return: the previous tracer
+  '''
+  global _tracer
+  prev = _tracer
+  _tracer = tracer if tracer is not None else NullTracer()
+  return prev
+
+
+def trace_span(name, **meta):
+  '''with trace_span('refiner_forward', n_poses=len(A)): ...
+  '''
+  return _tracer.span(name, **meta)
@@ -0,0 +1,122 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+import os,sys,logging,threading,copy,inspect,argparse,glob
+import torch
+from omegaconf import OmegaConf
+code_dir = os.path.dirname(os.path.realpath(__file__))
+WEIGHTS_DIR = os.path.realpath(f'{code_dir}/../../weights')
+
+
+# Process wide cache of configs and networks, so every PoseRefinePredictor/ScorePredictor (and every FoundationPose
+# constructing them implicitly) shares one module per (checkpoint, device) instead of reloading it.
+# The shared modules are in eval mode and must be treated as read only
+
+_lock = threading.RLock()
+_configs = {}
+_networks = {}
+_stats = {'config_loads': 0, 'network_loads': 0, 'network_hits': 0}
+
+
+def load_config(run_name, weights_dir=WEIGHTS_DIR):
+  '''@return: a copy of the run's config.yml, free to modify
+  '''
+  file = f'{weights_dir}/{run_name}/config.yml'
+  with _lock:
+    if file not in _configs:
+      _configs[file] = OmegaConf.load(file)
+      _stats['config_loads'] += 1
+    return copy.deepcopy(_configs[file])
+
+
+def torch_load_supports_mmap():
+  return 'mmap' in inspect.signature(torch.load).parameters
+
+
+def load_state_dict(ckpt_file):
+  '''Weights on cpu without reading the whole file up front when possible:
+    a .safetensors next to the checkpoint is memory mapped (needs the safetensors package, see convert_to_safetensors)
+    otherwise torch.load memory maps the checkpoint on torch versions supporting it
+  '''
+  st_file = os.path.splitext(ckpt_file)[0]+'.safetensors'
+  if os.path.exists(st_file):
+    try:
+      from safetensors.torch import load_file
+      return load_file(st_file, device='cpu'), True
+    except ImportError:
+      logging.info(f"WARN: safetensors is not installed, ignoring {st_file}")
+  mmap = torch_load_supports_mmap()
+  kwargs = {'mmap': True} if mmap else {}
+  ckpt = torch.load(ckpt_file, map_location='cpu', **kwargs)
+  if 'model' in ckpt:
+    ckpt = ckpt['model']
+  return ckpt, mmap
+
+
+def get_network(name, ckpt_file, build_fn, device, share_memory=True):
+  '''
+  @name: network kind, part of the cache key with the checkpoint and the device
+  @build_fn: returns the network with random weights on cpu, only called on a miss
+  @share_memory: on cpu, keep the weights where forked workers read them without copying: the memory mapped file when
+    parameters can take over the loaded storage, shared memory otherwise
+  @return: the shared module
+  '''
+  device = torch.device(device)
+  key = (name, os.path.realpath(ckpt_file), str(device))
+  with _lock:
+    if key in _networks:
+      _stats['network_hits'] += 1
+      return _networks[key]
+
+    logging.info(f"Using pretrained model from {ckpt_file}")
+    state_dict, mapped = load_state_dict(ckpt_file)
+    model = build_fn()
+    assign = device.type=='cpu' and mapped and 'assign' in inspect.signature(model.load_state_dict).parameters
+    if assign:   # Parameters become views of the mapped file, nothing is copied
+      model.load_state_dict(state_dict, assign=True)
+    else:
+      model.load_state_dict(state_dict)
+    model.to(device).eval()
+    if device.type=='cpu' and share_memory and not assign:
+      model.share_memory()
+    _networks[key] = model
+    _stats['network_loads'] += 1
+    return model
+
+
+def clear():
+  with _lock:
+    _configs.clear()
+    _networks.clear()
+
+
+def get_stats():
+  with _lock:
+    return dict(_stats, n_networks=len(_networks))
+
+
+def convert_to_safetensors(ckpt_file):
+  '''Write a .safetensors next to the checkpoint, get_network picks it up from then on
+  '''
+  from safetensors.torch import save_file
+  state_dict, _ = load_state_dict(ckpt_file)
+  out_file = os.path.splitext(ckpt_file)[0]+'.safetensors'
+  save_file({k: v.contiguous() for k,v in state_dict.items()}, out_file)
+  logging.info(f"saved {out_file}")
+  return out_file
+
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser(description="Convert the checkpoints under weights/ to safetensors for memory mapped loading")
+  parser.add_argument('--weights_dir', type=str, default=WEIGHTS_DIR)
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.INFO)
+  for ckpt_file in sorted(glob.glob(f'{args.weights_dir}/*/model_best.pth')):
+    convert_to_safetensors(ckpt_file)
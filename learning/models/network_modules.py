@@ -7,7 +7,7 @@
 # license agreement from NVIDIA CORPORATION is strictly prohibited.
 
 
-import os,sys,copy,math,tqdm
+import os,sys,copy,math
 import numpy as np
 dir_path = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(dir_path)
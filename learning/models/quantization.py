@@ -0,0 +1,288 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+import os,sys,logging,argparse,copy,time,json
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+code_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f'{code_dir}/../../')
+from learning.models.runtime import OUTPUT_NAMES, EagerRuntime
+
+
+# int8 cpu inference of RefineNet/ScoreNetMultiPair:
+#   conv encoders: static quantization with per-channel weights, activation ranges calibrated on recorded crops
+#   transformer/attention heads: dynamic quantization of every linear layer, including the attention projections.
+#     nn.MultiheadAttention keeps its qkv projection as a raw parameter and out_proj as a NonDynamicallyQuantizableLinear,
+#     so attention is first rebuilt from plain nn.Linear (LinearMultiheadAttention, UnfusedEncoderLayer). What stays fp32 is
+#     the attention softmax/matmuls, layer norms and the positional embedding
+# Quantized kernels only exist on cpu, so the int8 runtime always runs there
+
+ENCODER_NAMES = {
+  'refine': ['encodeA', 'encodeAB'],
+  'score': ['encoderA', 'encoderAB'],
+}
+
+
+class CropRecorder:
+  '''Wraps a predictor's runtime and keeps a copy of the network inputs it sees, to calibrate and evaluate the int8 networks on real crops.
+  predictor.runtime = CropRecorder(predictor.runtime) then run the estimator on representative frames and save()
+  '''
+  def __init__(self, runtime, max_items=2048):
+    self.runtime = runtime
+    self.max_items = max_items
+    self.batches = []
+    self.n_items = 0
+
+
+  def __call__(self, A, B, L=None):
+    if self.n_items<self.max_items:
+      self.batches.append({'A': A.data.cpu().half(), 'B': B.data.cpu().half(), 'L': L})
+      self.n_items += len(A)
+    return self.runtime(A, B, L=L)
+
+
+  def to(self, device):
+    self.runtime.to(device)
+    return self
+
+
+  def save(self, out_file):
+    os.makedirs(os.path.dirname(os.path.abspath(out_file)), exist_ok=True)
+    torch.save(self.batches, out_file)
+    logging.info(f"{self.n_items} recorded crops saved to {out_file}")
+
+
+
+def load_crops(file):
+  '''@return: list of dict with A,B float tensors on cpu and L (group size of the scorer, None for the refiner)
+  '''
+  batches = torch.load(file, map_location='cpu')
+  return [{'A': b['A'].float(), 'B': b['B'].float(), 'L': b['L']} for b in batches]
+
+
+def run_model(model, batch):
+  if batch['L'] is None:
+    return model(batch['A'], batch['B'])
+  return model(batch['A'], batch['B'], L=batch['L'])
+
+
+class LinearMultiheadAttention(nn.Module):
+  '''Inference only nn.MultiheadAttention whose input and output projections are plain nn.Linear, so quantize_dynamic covers them.
+  Takes over the weights of att. Returns (output, None), attention masks are not supported
+  '''
+  def __init__(self, att:nn.MultiheadAttention):
+    super().__init__()
+    if not att._qkv_same_embed_dim:
+      raise RuntimeError('only attention with the same embed dim for query, key and value is supported')
+    self.embed_dim = att.embed_dim
+    self.num_heads = att.num_heads
+    self.batch_first = att.batch_first
+    self.in_proj = nn.Linear(self.embed_dim, 3*self.embed_dim, bias=att.in_proj_bias is not None)
+    self.in_proj.weight = nn.Parameter(att.in_proj_weight.detach().clone())
+    if att.in_proj_bias is not None:
+      self.in_proj.bias = nn.Parameter(att.in_proj_bias.detach().clone())
+    self.out_proj = nn.Linear(self.embed_dim, self.embed_dim, bias=att.out_proj.bias is not None)
+    self.out_proj.load_state_dict(att.out_proj.state_dict())
+
+
+  def forward(self, query, key, value, need_weights=False, attn_mask=None, key_padding_mask=None, **kwargs):
+    if attn_mask is not None or key_padding_mask is not None:
+      raise RuntimeError('attention masks are not supported')
+    if not self.batch_first:
+      query, key, value = [x.transpose(0,1) for x in (query, key, value)]
+    E = self.embed_dim
+    if query is key and key is value:   # Self attention, one projection
+      q, k, v = self.in_proj(query).chunk(3, dim=-1)
+    else:
+      q = self.in_proj(query)[...,:E]
+      k = self.in_proj(key)[...,E:2*E]
+      v = self.in_proj(value)[...,2*E:]
+    N, L, _ = q.shape
+    q, k, v = [x.reshape(N, -1, self.num_heads, E//self.num_heads).transpose(1,2) for x in (q, k, v)]
+    out = F.scaled_dot_product_attention(q, k, v).transpose(1,2).reshape(N, L, E)
+    out = self.out_proj(out)
+    if not self.batch_first:
+      out = out.transpose(0,1)
+    return out, None
+
+
+
+class UnfusedEncoderLayer(nn.Module):
+  '''Inference only nn.TransformerEncoderLayer run op by op, its fused fast path reads the fp32 attention weights directly.
+  Dropout is left out, it is the identity in eval
+  '''
+  def __init__(self, layer:nn.TransformerEncoderLayer):
+    super().__init__()
+    self.self_attn = LinearMultiheadAttention(layer.self_attn)
+    self.linear1 = layer.linear1
+    self.linear2 = layer.linear2
+    self.norm1 = layer.norm1
+    self.norm2 = layer.norm2
+    self.activation = layer.activation
+    self.norm_first = layer.norm_first
+
+
+  def feed_forward(self, x):
+    return self.linear2(self.activation(self.linear1(x)))
+
+
+  def forward(self, src, src_mask=None, src_key_padding_mask=None, **kwargs):
+    x = src
+    if self.norm_first:
+      h = self.norm1(x)
+      x = x+self.self_attn(h, h, h, attn_mask=src_mask, key_padding_mask=src_key_padding_mask)[0]
+      x = x+self.feed_forward(self.norm2(x))
+    else:
+      x = self.norm1(x+self.self_attn(x, x, x, attn_mask=src_mask, key_padding_mask=src_key_padding_mask)[0])
+      x = self.norm2(x+self.feed_forward(x))
+    return x
+
+
+
+def make_attention_quantizable(module):
+  '''Replace the encoder layers and attention modules of module in place, see LinearMultiheadAttention
+  @return: module
+  '''
+  for name, child in module.named_children():
+    if isinstance(child, nn.TransformerEncoderLayer):
+      setattr(module, name, UnfusedEncoderLayer(child))
+    elif isinstance(child, nn.MultiheadAttention):
+      setattr(module, name, LinearMultiheadAttention(child))
+    else:
+      make_attention_quantizable(child)
+  return module
+
+
+@torch.no_grad()
+def quantize_model(kind, model, calib_batches=None, backend='fbgemm'):
+  '''
+  @model: fp32 network, not modified
+  @calib_batches: recorded crops (see CropRecorder), without them only the linear layers are quantized
+  @return: int8 model on cpu
+  '''
+  torch.backends.quantized.engine = backend
+  model_q = copy.deepcopy(model).float().cpu().eval()
+  if calib_batches:
+    qconfig_mapping = get_default_qconfig_mapping(backend)   # Per-channel weights
+    example = calib_batches[0]
+    x = torch.cat([example['A'][:1], example['B'][:1]], dim=0)
+    name_in, name_ab = ENCODER_NAMES[kind]
+    encoder_in = prepare_fx(getattr(model_q, name_in), qconfig_mapping, example_inputs=(x,))
+    feat = encoder_in(x)
+    ab = torch.cat((feat[:1], feat[1:]), dim=1)
+    encoder_ab = prepare_fx(getattr(model_q, name_ab), qconfig_mapping, example_inputs=(ab,))
+    setattr(model_q, name_in, encoder_in)
+    setattr(model_q, name_ab, encoder_ab)
+    for batch in calib_batches:
+      run_model(model_q, batch)
+    setattr(model_q, name_in, convert_fx(encoder_in))
+    setattr(model_q, name_ab, convert_fx(encoder_ab))
+  else:
+    logging.info("no calibration crops, conv encoders stay in fp32")
+  make_attention_quantizable(model_q)
+  model_q = quantize_dynamic(model_q, {nn.Linear}, dtype=torch.qint8)
+  n_linear = sum(isinstance(m, torch.ao.nn.quantized.dynamic.Linear) for m in model_q.modules())
+  logging.info(f"{n_linear} linear layers quantized to int8, attention projections included")
+  return model_q
+
+
+
+class QuantizedRuntime(EagerRuntime):
+  '''Runtime of the int8 networks, inputs are moved to cpu and outputs back to the device of the inputs
+  '''
+  def __init__(self, kind, model, calib_file=None, backend='fbgemm'):
+    calib_batches = load_crops(calib_file) if calib_file is not None else None
+    super().__init__(quantize_model(kind, model, calib_batches=calib_batches, backend=backend), amp=False)
+
+
+  @torch.no_grad()
+  def __call__(self, A, B, L=None):
+    output = super().__call__(A.float().cpu(), B.float().cpu(), L=L)
+    return {k: output[k].to(A.device) for k in output}
+
+
+  def to(self, device):
+    return self
+
+
+
+def measure_latency(model, batch, repeats=10, warmup=2):
+  for _ in range(warmup):
+    run_model(model, batch)
+  latencies = []
+  for _ in range(repeats):
+    begin = time.perf_counter()
+    run_model(model, batch)
+    latencies.append((time.perf_counter()-begin)*1000)
+  return float(np.median(latencies))
+
+
+@torch.no_grad()
+def compare(kind, model_fp32, model_int8, eval_batches, repeats=10):
+  '''Accuracy and cpu latency of the int8 network against fp32 on recorded crops
+  @return: dict of metrics
+  '''
+  errs = {name: [] for name in OUTPUT_NAMES[kind]}
+  top1_agree = []
+  for batch in eval_batches:
+    ref = run_model(model_fp32, batch)
+    out = run_model(model_int8, batch)
+    for name in OUTPUT_NAMES[kind]:
+      errs[name].append((ref[name].float()-out[name].float()).abs().reshape(len(ref[name]),-1).mean(dim=1))
+    if kind=='score':
+      L = batch['L']
+      top1_agree.append(ref['score_logit'].reshape(-1,L).argmax(dim=1)==out['score_logit'].reshape(-1,L).argmax(dim=1))
+  report = {}
+  for name in errs:
+    err = torch.cat(errs[name]).numpy()
+    report[f'{name}_abs_err_mean'] = float(err.mean())
+    report[f'{name}_abs_err_max'] = float(err.max())
+  if top1_agree:
+    report['score_top1_agreement'] = float(torch.cat(top1_agree).float().mean())
+  report['fp32_latency_ms'] = measure_latency(model_fp32, eval_batches[0], repeats=repeats)
+  report['int8_latency_ms'] = measure_latency(model_int8, eval_batches[0], repeats=repeats)
+  report['speedup'] = report['fp32_latency_ms']/report['int8_latency_ms']
+  report['batch_size'] = int(len(eval_batches[0]['A']))
+  return report
+
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser(description="Quantize the refiner or scorer to int8 and compare it against the fp32 weights on recorded crops")
+  parser.add_argument('--network', type=str, default='refine', choices=list(ENCODER_NAMES.keys()))
+  parser.add_argument('--calib_file', type=str, required=True, help="crops recorded with CropRecorder, used to calibrate the conv encoders")
+  parser.add_argument('--eval_file', type=str, default=None, help="crops to evaluate on, default is calib_file")
+  parser.add_argument('--num_threads', type=int, default=None)
+  parser.add_argument('--repeats', type=int, default=10)
+  parser.add_argument('--out', type=str, default=None, help="optional json report")
+  args = parser.parse_args()
+
+  from Utils import set_logging_format
+  from learning.training.predict_pose_refine import PoseRefinePredictor
+  from learning.training.predict_score import ScorePredictor
+  set_logging_format()
+  if args.num_threads is not None:
+    torch.set_num_threads(args.num_threads)
+
+  predictor = PoseRefinePredictor(device='cpu') if args.network=='refine' else ScorePredictor(device='cpu')
+  model_fp32 = predictor.model.float().eval()
+  calib_batches = load_crops(args.calib_file)
+  eval_batches = load_crops(args.eval_file) if args.eval_file is not None else calib_batches
+  model_int8 = quantize_model(args.network, model_fp32, calib_batches=calib_batches)
+  report = compare(args.network, model_fp32, model_int8, eval_batches, repeats=args.repeats)
+  for k,v in report.items():
+    logging.info(f'{k}: {v}')
+  if args.out is not None:
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out, 'w') as ff:
+      json.dump(report, ff, indent=2)
@@ -0,0 +1,261 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+import os,sys,logging,argparse
+import numpy as np
+import torch
+import torch.nn as nn
+code_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f'{code_dir}/../../')
+
+
+# Export of RefineNet/ScoreNetMultiPair to TorchScript and ONNX, and runtimes the predictors call instead of the eager module.
+# Every runtime is called like the eager network: runtime(A,B) for the refiner and runtime(A,B,L=group_size) for the scorer, returning the same output dict.
+# The exported graphs take the scorer input grouped as (n_groups,group_size,C,H,W), so both the number and the size of the groups stay dynamic
+
+NETWORK_KINDS = ['refine', 'score']
+OUTPUT_NAMES = {
+  'refine': ['trans', 'rot'],
+  'score': ['score_logit'],
+}
+BACKENDS = ['eager', 'torchscript', 'onnx', 'int8']
+
+
+class RefineNetExport(nn.Module):
+  '''Tuple outputs, dicts can not leave an exported graph
+  '''
+  def __init__(self, model):
+    super().__init__()
+    self.model = model
+
+  def forward(self, A, B):
+    output = self.model(A, B)
+    return output['trans'], output['rot']
+
+
+
+class ScoreNetExport(nn.Module):
+  def __init__(self, model):
+    super().__init__()
+    self.model = model
+
+  def forward(self, A, B):
+    '''
+    @A: (n_groups,L,C,H,W)
+    @return: (n_groups,L) score logits
+    '''
+    output = self.model(A.flatten(0,1), B.flatten(0,1), L=A.shape[1])
+    return output['score_logit']
+
+
+
+def make_export_module(kind, model):
+  if kind=='refine':
+    return RefineNetExport(model).eval()
+  if kind=='score':
+    return ScoreNetExport(model).eval()
+  raise RuntimeError(f'unknown network kind {kind}, choose from {NETWORK_KINDS}')
+
+
+def make_example_inputs(kind, cfg, batch=2, group_size=3, device='cpu', seed=0):
+  '''Random inputs in the layout of the exported graph
+  '''
+  H,W = cfg['input_resize'][1], cfg['input_resize'][0]
+  shape = (batch, cfg['c_in'], H, W) if kind=='refine' else (batch, group_size, cfg['c_in'], H, W)
+  gen = torch.Generator(device='cpu').manual_seed(seed)
+  A = torch.rand(shape, generator=gen).to(device)
+  B = torch.rand(shape, generator=gen).to(device)
+  return A, B
+
+
+@torch.no_grad()
+def export_torchscript(kind, model, out_file, example_inputs):
+  module = make_export_module(kind, model)
+  traced = torch.jit.trace(module, example_inputs, check_trace=False)
+  os.makedirs(os.path.dirname(os.path.abspath(out_file)), exist_ok=True)
+  traced.save(out_file)
+  logging.info(f"torchscript {kind} saved to {out_file}")
+  return out_file
+
+
+@torch.no_grad()
+def export_onnx(kind, model, out_file, example_inputs, opset=17):
+  module = make_export_module(kind, model)
+  if kind=='refine':
+    dynamic_axes = {'A': {0:'batch'}, 'B': {0:'batch'}, 'trans': {0:'batch'}, 'rot': {0:'batch'}}
+  else:
+    dynamic_axes = {'A': {0:'n_groups', 1:'group_size'}, 'B': {0:'n_groups', 1:'group_size'}, 'score_logit': {0:'n_groups', 1:'group_size'}}
+  os.makedirs(os.path.dirname(os.path.abspath(out_file)), exist_ok=True)
+  torch.onnx.export(module, example_inputs, out_file, input_names=['A','B'], output_names=OUTPUT_NAMES[kind], dynamic_axes=dynamic_axes, opset_version=opset)
+  logging.info(f"onnx {kind} saved to {out_file}")
+  return out_file
+
+
+
+class EagerRuntime:
+  def __init__(self, model, amp=True):
+    self.model = model
+    self.amp = amp
+
+
+  def __call__(self, A, B, L=None):
+    with torch.autocast(device_type=A.device.type, enabled=self.amp and A.device.type=='cuda'):
+      if L is None:
+        return self.model(A, B)
+      return self.model(A, B, L=L)
+
+
+  def to(self, device):
+    self.model.to(device)
+    return self
+
+
+
+class ExportedRuntime:
+  '''Shared by the exported backends: groups the scorer inputs and names the outputs
+  '''
+  def __init__(self, kind):
+    if kind not in NETWORK_KINDS:
+      raise RuntimeError(f'unknown network kind {kind}, choose from {NETWORK_KINDS}')
+    self.kind = kind
+
+
+  def __call__(self, A, B, L=None):
+    if self.kind=='score':
+      A = A.reshape(-1, L, *A.shape[1:])
+      B = B.reshape(-1, L, *B.shape[1:])
+    outputs = self.run(A.float().contiguous(), B.float().contiguous())
+    return dict(zip(OUTPUT_NAMES[self.kind], outputs))
+
+
+
+class TorchScriptRuntime(ExportedRuntime):
+  def __init__(self, kind, file, device=None):
+    super().__init__(kind)
+    self.file = file
+    self.module = torch.jit.load(file, map_location=device)
+    self.module.eval()
+
+
+  @torch.no_grad()
+  def run(self, A, B):
+    outputs = self.module(A, B)
+    return outputs if isinstance(outputs, (tuple,list)) else (outputs,)
+
+
+  def to(self, device):
+    self.module.to(device)
+    return self
+
+
+
+class OnnxRuntime(ExportedRuntime):
+  '''onnxruntime is only needed when this backend is used. Inputs and outputs go through host memory, the outputs are put back on the device of the inputs
+  '''
+  def __init__(self, kind, file, device=None, providers=None):
+    super().__init__(kind)
+    import onnxruntime as ort
+    self.file = file
+    if providers is None:
+      providers = ['CPUExecutionProvider']
+      if device is not None and torch.device(device).type=='cuda':
+        providers = ['CUDAExecutionProvider']+providers
+    self.session = ort.InferenceSession(file, providers=providers)
+    logging.info(f"onnxruntime providers: {self.session.get_providers()}")
+
+
+  def run(self, A, B):
+    outputs = self.session.run(OUTPUT_NAMES[self.kind], {'A': A.data.cpu().numpy(), 'B': B.data.cpu().numpy()})
+    return tuple(torch.as_tensor(out, device=A.device) for out in outputs)
+
+
+  def to(self, device):
+    return self
+
+
+
+def make_runtime(kind, backend='eager', model=None, file=None, device=None, amp=True):
+  '''
+  @model: the eager network, used by the eager and int8 backends
+  @file: exported graph for the torchscript/onnx backends, calibration crops for int8 (see learning/models/quantization.py)
+  '''
+  if backend=='eager':
+    return EagerRuntime(model, amp=amp)
+  if backend=='int8':
+    from learning.models.quantization import QuantizedRuntime
+    return QuantizedRuntime(kind, model, calib_file=file)
+  if file is None or not os.path.exists(file):
+    raise RuntimeError(f'{backend} runtime needs an exported graph, {file} does not exist')
+  if backend=='torchscript':
+    return TorchScriptRuntime(kind, file, device=device)
+  if backend=='onnx':
+    return OnnxRuntime(kind, file, device=device)
+  raise RuntimeError(f'unknown backend {backend}, choose from {BACKENDS}')
+
+
+@torch.no_grad()
+def check_parity(kind, model, runtime, cfg, batch_sizes=(1,5), group_size=4, device='cpu', atol=1e-3, rtol=1e-3):
+  '''Compare a runtime to the eager network in float32, on batch sizes other than the export example so baked in shapes are caught
+  @return: dict output name -> max abs error, and whether all outputs are within tolerance
+  '''
+  model.eval()
+  errs = {name: 0.0 for name in OUTPUT_NAMES[kind]}
+  ok = True
+  for i,batch in enumerate(batch_sizes):
+    A, B = make_example_inputs(kind, cfg, batch=batch, group_size=group_size, device=device, seed=i)
+    if kind=='refine':
+      ref = model(A, B)
+      out = runtime(A, B)
+    else:
+      ref = model(A.flatten(0,1), B.flatten(0,1), L=group_size)
+      out = runtime(A.flatten(0,1), B.flatten(0,1), L=group_size)
+    for name in OUTPUT_NAMES[kind]:
+      r = ref[name].float()
+      o = out[name].float().to(r.device).reshape(r.shape)
+      errs[name] = max(errs[name], float((r-o).abs().max()))
+      ok = ok and torch.allclose(r, o, atol=atol, rtol=rtol)
+  return errs, ok
+
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser(description="Export the refiner and scorer networks and check the exported graphs against eager torch")
+  parser.add_argument('--out_dir', type=str, default=f'{code_dir}/../../weights/exported')
+  parser.add_argument('--networks', type=str, nargs='+', default=NETWORK_KINDS, choices=NETWORK_KINDS)
+  parser.add_argument('--formats', type=str, nargs='+', default=['torchscript', 'onnx'], choices=['torchscript', 'onnx'])
+  parser.add_argument('--device', type=str, default='cpu', help="device of the export and the parity check, cpu checks onnx on the CPU execution provider")
+  parser.add_argument('--opset', type=int, default=17)
+  parser.add_argument('--atol', type=float, default=1e-3)
+  args = parser.parse_args()
+
+  from Utils import set_logging_format
+  from learning.training.predict_pose_refine import PoseRefinePredictor
+  from learning.training.predict_score import ScorePredictor
+  set_logging_format()
+
+  failed = []
+  for kind in args.networks:
+    predictor = PoseRefinePredictor(device=args.device) if kind=='refine' else ScorePredictor(device=args.device)
+    model = predictor.model.float().eval()
+    example_inputs = make_example_inputs(kind, predictor.cfg, device=args.device)
+    for fmt in args.formats:
+      ext = 'pt' if fmt=='torchscript' else 'onnx'
+      out_file = f'{args.out_dir}/{kind}_{predictor.run_name}.{ext}'
+      if fmt=='torchscript':
+        export_torchscript(kind, model, out_file, example_inputs)
+      else:
+        export_onnx(kind, model, out_file, example_inputs, opset=args.opset)
+      runtime = make_runtime(kind, backend=fmt, file=out_file, device=args.device)
+      errs, ok = check_parity(kind, model, runtime, predictor.cfg, device=args.device, atol=args.atol, rtol=args.atol)
+      logging.info(f"{kind} {fmt} parity {'ok' if ok else 'FAILED'}, max abs err: {errs}")
+      if not ok:
+        failed.append(f'{kind}/{fmt}')
+  if failed:
+    logging.info(f"parity failed for {failed}")
+    sys.exit(1)
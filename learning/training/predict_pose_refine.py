@@ -19,70 +19,92 @@ from learning.models.refine_network import RefineNet
 from learning.datasets.h5_dataset import *
 from Utils import *
 from datareader import *
+from instrumentation import trace_span
+from learning.models.runtime import make_runtime
+from learning.models import model_registry
 
 
 
 @torch.inference_mode()
-def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_ratio, xyz_map, normal_map=None, mesh_diameter=None, cfg=None, glctx=None, mesh_tensors=None, dataset:PoseRefinePairH5Dataset=None):
+def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_ratio, xyz_map, normal_map=None, mesh_diameter=None, cfg=None, glctx=None, mesh_tensors=None, dataset:PoseRefinePairH5Dataset=None, frame_ids=None, device=None, templates=None, lod_level=0):
+  '''
+  @frame_ids: (B,) tensor, when given rgb/depth/xyz_map/normal_map/K are stacked frames (F,...) and each pose is cropped from its own frame
+  @device: where the crops are made, default is get_default_device()
+  @templates: dict with rgb and xyz_map (B,3,H,W) rendered crops of the poses, used instead of rasterizing (see template_bank.py). Not with use_normal
+  @lod_level: LOD level the poses are rendered at, see Utils.select_lod_level
+  '''
   logging.info("Welcome make_crop_data_batch")
-  H,W = depth.shape[:2]
+  if device is None:
+    device = get_default_device()
+  H,W = depth.shape[-2:]
   args = []
   method = 'box_3d'
-  tf_to_crops = compute_crop_window_tf_batch(pts=mesh.vertices, H=H, W=W, poses=ob_in_cams, K=K, crop_ratio=crop_ratio, out_size=(render_size[1], render_size[0]), method=method, mesh_diameter=mesh_diameter)
+  Ks = device_constants.get(K, device).reshape(-1,3,3)
+  projection_mat = projection_matrix_from_intrinsics_batch(Ks, height=H, width=W, znear=0.001, zfar=100)
+  B = len(ob_in_cams)
+  if frame_ids is not None:
+    frame_ids = torch.as_tensor(frame_ids, device=device, dtype=torch.long)
+    projection_mat = projection_mat[frame_ids]
+    Ks = Ks[frame_ids]
+  else:
+    projection_mat = projection_mat.expand(B,4,4)
+  poseA = torch.as_tensor(ob_in_cams, dtype=torch.float, device=device)
+  tf_to_crops = compute_crop_window_tf_batch(pts=mesh.vertices, H=H, W=W, poses=poseA, K=Ks if frame_ids is not None else K, crop_ratio=crop_ratio, out_size=(render_size[1], render_size[0]), method=method, mesh_diameter=mesh_diameter)
 
   logging.info("make tf_to_crops done")
 
-  B = len(ob_in_cams)
-  poseA = torch.as_tensor(ob_in_cams, dtype=torch.float, device='cuda')
-
   bs = 512
   rgb_rs = []
   depth_rs = []
   normal_rs = []
   xyz_map_rs = []
 
-  bbox2d_crop = torch.as_tensor(np.array([0, 0, cfg['input_resize'][0]-1, cfg['input_resize'][1]-1]).reshape(2,2), device='cuda', dtype=torch.float)
-  bbox2d_ori = transform_pts(bbox2d_crop, tf_to_crops.inverse()).reshape(-1,4)
-
-  for b in range(0,len(poseA),bs):
-    extra = {}
-    rgb_r, depth_r, normal_r = nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=poseA[b:b+bs], context='cuda', get_normal=cfg['use_normal'], glctx=glctx, mesh_tensors=mesh_tensors, output_size=cfg['input_resize'], bbox2d=bbox2d_ori[b:b+bs], use_light=True, extra=extra)
-    rgb_rs.append(rgb_r)
-    depth_rs.append(depth_r[...,None])
-    normal_rs.append(normal_r)
-    xyz_map_rs.append(extra['xyz_map'])
-  rgb_rs = torch.cat(rgb_rs, dim=0).permute(0,3,1,2) * 255
-  depth_rs = torch.cat(depth_rs, dim=0).permute(0,3,1,2)  #(B,1,H,W)
-  xyz_map_rs = torch.cat(xyz_map_rs, dim=0).permute(0,3,1,2)  #(B,3,H,W)
-  Ks = torch.as_tensor(K, device='cuda', dtype=torch.float).reshape(1,3,3)
-  if cfg['use_normal']:
-    normal_rs = torch.cat(normal_rs, dim=0).permute(0,3,1,2)  #(B,3,H,W)
-
-  logging.info("render done")
-
-  rgbBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(rgb, dtype=torch.float, device='cuda').permute(2,0,1)[None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='bilinear', align_corners=False)
-  if rgb_rs.shape[-2:]!=cfg['input_resize']:
-    rgbAs = kornia.geometry.transform.warp_perspective(rgb_rs, tf_to_crops, dsize=render_size, mode='bilinear', align_corners=False)
-  else:
-    rgbAs = rgb_rs
-  if xyz_map_rs.shape[-2:]!=cfg['input_resize']:
-    xyz_mapAs = kornia.geometry.transform.warp_perspective(xyz_map_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
-  else:
-    xyz_mapAs = xyz_map_rs
-  xyz_mapBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(xyz_map, device='cuda', dtype=torch.float).permute(2,0,1)[None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)  #(B,3,H,W)
+  bbox2d_crop = device_constants.get(np.array([0, 0, cfg['input_resize'][0]-1, cfg['input_resize'][1]-1]).reshape(2,2), device)
+  bbox2d_ori = transform_pts(bbox2d_crop, torch.linalg.inv_ex(tf_to_crops)[0]).reshape(-1,4)
 
-  if cfg['use_normal']:
-    normalAs = kornia.geometry.transform.warp_perspective(normal_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
-    normalBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(normal_map, dtype=torch.float, device='cuda').permute(2,0,1)[None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
+  if templates is not None:
+    rgb_rs = templates['rgb']
+    xyz_map_rs = templates['xyz_map']
   else:
-    normalAs = None
-    normalBs = None
+    with trace_span('crop_render', n_poses=B):
+      for b in range(0,len(poseA),bs):
+        extra = {}
+        rgb_r, depth_r, normal_r = nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=poseA[b:b+bs], context='cuda', get_normal=cfg['use_normal'], glctx=glctx, mesh_tensors=mesh_tensors, output_size=cfg['input_resize'], bbox2d=bbox2d_ori[b:b+bs], use_light=True, extra=extra, projection_mat=projection_mat[b:b+bs], lod_level=lod_level)
+        rgb_rs.append(rgb_r)
+        depth_rs.append(depth_r[...,None])
+        normal_rs.append(normal_r)
+        xyz_map_rs.append(extra['xyz_map'])
+      rgb_rs = torch.cat(rgb_rs, dim=0).permute(0,3,1,2) * 255
+      depth_rs = torch.cat(depth_rs, dim=0).permute(0,3,1,2)  #(B,1,H,W)
+      xyz_map_rs = torch.cat(xyz_map_rs, dim=0).permute(0,3,1,2)  #(B,3,H,W)
+      if cfg['use_normal']:
+        normal_rs = torch.cat(normal_rs, dim=0).permute(0,3,1,2)  #(B,3,H,W)
 
-  logging.info("warp done")
-
-  mesh_diameters = torch.ones((len(rgbAs)), dtype=torch.float, device='cuda')*mesh_diameter
-  pose_data = BatchPoseData(rgbAs=rgbAs, rgbBs=rgbBs, depthAs=None, depthBs=None, normalAs=normalAs, normalBs=normalBs, poseA=poseA, poseB=None, xyz_mapAs=xyz_mapAs, xyz_mapBs=xyz_mapBs, tf_to_crops=tf_to_crops, Ks=Ks, mesh_diameters=mesh_diameters)
-  pose_data = dataset.transform_batch(batch=pose_data, H_ori=H, W_ori=W, bound=1)
+  logging.info("render done")
+  with trace_span('crop_warp', n_poses=B):
+    rgbBs = warp_perspective_frames(torch.as_tensor(rgb, dtype=torch.float, device=device).movedim(-1,-3), tf_to_crops, dsize=render_size, mode='bilinear', frame_ids=frame_ids)
+    if rgb_rs.shape[-2:]!=cfg['input_resize']:
+      rgbAs = kornia.geometry.transform.warp_perspective(rgb_rs, tf_to_crops, dsize=render_size, mode='bilinear', align_corners=False)
+    else:
+      rgbAs = rgb_rs
+    if xyz_map_rs.shape[-2:]!=cfg['input_resize']:
+      xyz_mapAs = kornia.geometry.transform.warp_perspective(xyz_map_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
+    else:
+      xyz_mapAs = xyz_map_rs
+    xyz_mapBs = warp_perspective_frames(torch.as_tensor(xyz_map, device=device, dtype=torch.float).movedim(-1,-3), tf_to_crops, dsize=render_size, mode='nearest', frame_ids=frame_ids)  #(B,3,H,W)
+
+    if cfg['use_normal']:
+      normalAs = kornia.geometry.transform.warp_perspective(normal_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
+      normalBs = warp_perspective_frames(torch.as_tensor(normal_map, dtype=torch.float, device=device).movedim(-1,-3), tf_to_crops, dsize=render_size, mode='nearest', frame_ids=frame_ids)
+    else:
+      normalAs = None
+      normalBs = None
+
+    logging.info("warp done")
+
+    mesh_diameters = torch.ones((len(rgbAs)), dtype=torch.float, device=device)*mesh_diameter
+    pose_data = BatchPoseData(rgbAs=rgbAs, rgbBs=rgbBs, depthAs=None, depthBs=None, normalAs=normalAs, normalBs=normalBs, poseA=poseA, poseB=None, xyz_mapAs=xyz_mapAs, xyz_mapBs=xyz_mapBs, tf_to_crops=tf_to_crops, Ks=Ks, mesh_diameters=mesh_diameters)
+    pose_data = dataset.transform_batch(batch=pose_data, H_ori=H, W_ori=W, bound=1, device=device)
 
   logging.info("pose batch data done")
 
@@ -91,15 +113,21 @@ def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_rati
 
 
 class PoseRefinePredictor:
-  def __init__(self,):
+  def __init__(self, device=None, runtime_backend='eager', runtime_file=None):
+    '''
+    @device: where the model runs and crops are made, default is get_default_device()
+    @runtime_backend: eager, torchscript or onnx, see learning/models/runtime.py to export the graph. int8 runs a quantized copy on cpu, see learning/models/quantization.py
+    @runtime_file: exported graph of the torchscript/onnx backends, calibration crops of int8
+    '''
     logging.info("welcome")
+    self.device = torch.device(device) if device is not None else get_default_device()
     self.amp = True
     self.run_name = "2023-10-28-18-33-37"
     model_name = 'model_best.pth'
     code_dir = os.path.dirname(os.path.realpath(__file__))
     ckpt_dir = f'{code_dir}/../../weights/{self.run_name}/{model_name}'
 
-    self.cfg = OmegaConf.load(f'{code_dir}/../../weights/{self.run_name}/config.yml')
+    self.cfg = model_registry.load_config(self.run_name)
 
     self.cfg['ckpt_dir'] = ckpt_dir
     self.cfg['enable_amp'] = True
@@ -132,30 +160,47 @@ class PoseRefinePredictor:
     logging.info(f"self.cfg: \n {OmegaConf.to_yaml(self.cfg)}")
 
     self.dataset = PoseRefinePairH5Dataset(cfg=self.cfg, h5_file='', mode='test')
-    self.model = RefineNet(cfg=self.cfg, c_in=self.cfg['c_in']).cuda()
-
-    logging.info(f"Using pretrained model from {ckpt_dir}")
-    print(f"Using pretrained model from {ckpt_dir}") # debug
-    ckpt = torch.load(ckpt_dir)
-    if 'model' in ckpt:
-      ckpt = ckpt['model']
-    self.model.load_state_dict(ckpt)
-
-    self.model.cuda().eval()
+    self.runtime_backend = runtime_backend
+    self.runtime_file = runtime_file
+    self.load_model()
     logging.info("init done")
     self.last_trans_update = None
     self.last_rot_update = None
+    self.converge_tol = None   # Default of predict's converge_tol
+    # Poses cropped, rendered and refined together, sized from the memory budget. Initial guess of ~96 float32 crop sized channels per pose (crops and activations) until measured
+    self.memory_budget = MemoryBudget(bytes_per_item=4*96*self.cfg.input_resize[0]*self.cfg.input_resize[1], max_chunk=1024)
+    self.last_n_active = None
+
+
+  def load_model(self):
+    '''The network is shared process wide through the model registry, per checkpoint and device
+    '''
+    self.model = model_registry.get_network('refine', self.cfg['ckpt_dir'], build_fn=lambda: RefineNet(cfg=self.cfg, c_in=self.cfg['c_in']), device=self.device)
+    self.runtime = make_runtime('refine', backend=self.runtime_backend, model=self.model, file=self.runtime_file, device=self.device, amp=self.amp)
+
+
+  def to(self, device):
+    '''Switch to the shared network of another device, the network itself is never moved since other predictors may use it
+    '''
+    self.device = torch.device(device)
+    self.load_model()
+    return self
 
 
   @torch.inference_mode()
-  def predict(self, rgb, depth, K, ob_in_cams, xyz_map, normal_map=None, get_vis=False, mesh=None, mesh_tensors=None, glctx=None, mesh_diameter=None, iteration=5):
+  def predict(self, rgb, depth, K, ob_in_cams, xyz_map, normal_map=None, get_vis=False, mesh=None, mesh_tensors=None, glctx=None, mesh_diameter=None, iteration=5, frame_ids=None, converge_tol=None, templates=None, lod_level=0):
     '''
     @rgb: np array (H,W,3)
-    @ob_in_cams: np array (N,4,4)
+    @ob_in_cams: np array or tensor (N,4,4), tensors already on self.device are used without a copy
+    @frame_ids: (N,) frame index of each pose, rgb/depth/xyz_map/K are then stacked over frames (F,...)
+    @converge_tol: (trans meters, rot radian). A hypothesis whose last update is below both is frozen and no longer
+      rendered or inferred, the loop ends early once every hypothesis converged. Default is self.converge_tol, None runs all iterations
+    @templates: crops of the input poses for the first iteration instead of rendering them, see template_bank.TemplateBank.get
+    @lod_level: LOD level the crops are rendered at, chosen once by the caller (see FoundationPose.get_lod_level), 0 is the full mesh
     '''
-    torch.set_default_tensor_type('torch.cuda.FloatTensor')
+    if converge_tol is None:
+      converge_tol = self.converge_tol
     logging.info(f'ob_in_cams:{ob_in_cams.shape}')
-    tf_to_center = np.eye(4)
     ob_centered_in_cams = ob_in_cams
     mesh_centered = mesh
 
@@ -165,31 +210,43 @@ class PoseRefinePredictor:
 
     crop_ratio = self.cfg['crop_ratio']
     logging.info(f"trans_normalizer:{self.cfg['trans_normalizer']}, rot_normalizer:{self.cfg['rot_normalizer']}")
-    bs = 1024
-
-    B_in_cams = torch.as_tensor(ob_centered_in_cams, device='cuda', dtype=torch.float)
 
+    B_in_cams = torch.as_tensor(ob_centered_in_cams, device=self.device, dtype=torch.float).clone()
+    N = len(B_in_cams)
+    active = torch.arange(N, device=self.device)
+    if frame_ids is not None:
+      frame_ids = torch.as_tensor(frame_ids, device=self.device, dtype=torch.long)
+    trans_updates = torch.zeros((N,3), device=self.device, dtype=torch.float)
+    rot_updates = torch.eye(3, device=self.device, dtype=torch.float)[None].repeat(N,1,1)
 
     if mesh_tensors is None:
-      mesh_tensors = make_mesh_tensors(mesh_centered)
+      mesh_tensors = make_mesh_tensors(mesh_centered, device=self.device)
 
-    rgb_tensor = torch.as_tensor(rgb, device='cuda', dtype=torch.float)
-    depth_tensor = torch.as_tensor(depth, device='cuda', dtype=torch.float)
-    xyz_map_tensor = torch.as_tensor(xyz_map, device='cuda', dtype=torch.float)
+    rgb_tensor = torch.as_tensor(rgb, device=self.device, dtype=torch.float)
+    depth_tensor = torch.as_tensor(depth, device=self.device, dtype=torch.float)
+    xyz_map_tensor = torch.as_tensor(xyz_map, device=self.device, dtype=torch.float)
     trans_normalizer = self.cfg['trans_normalizer']
     if not isinstance(trans_normalizer, float):
-      trans_normalizer = torch.as_tensor(list(trans_normalizer), device='cuda', dtype=torch.float).reshape(1,3)
-
-    for _ in range(iteration):
-      logging.info("making cropped data")
-      pose_data = make_crop_data_batch(self.cfg.input_resize, B_in_cams, mesh_centered, rgb_tensor, depth_tensor, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter)
-      B_in_cams = []
-      for b in range(0, pose_data.rgbAs.shape[0], bs):
-        A = torch.cat([pose_data.rgbAs[b:b+bs].cuda(), pose_data.xyz_mapAs[b:b+bs].cuda()], dim=1).float()
-        B = torch.cat([pose_data.rgbBs[b:b+bs].cuda(), pose_data.xyz_mapBs[b:b+bs].cuda()], dim=1).float()
-        logging.info("forward start")
-        with torch.cuda.amp.autocast(enabled=self.amp):
-          output = self.model(A,B)
+      trans_normalizer = device_constants.get(list(trans_normalizer), self.device).reshape(1,3)
+
+    for it in range(iteration):
+      B_in_cams_active = []
+      trans_deltas = []
+      rot_mat_deltas = []
+      bs = self.memory_budget.chunk_size(self.device)
+      for b in range(0, len(active), bs):
+        ids = active[b:b+bs]
+        with self.memory_budget.measure(self.device, n_items=len(ids)):
+          logging.info("making cropped data")
+          templates_chunk = {k: v[ids] for k,v in templates.items()} if templates is not None and it==0 and not self.cfg['use_normal'] else None
+          pose_data = make_crop_data_batch(self.cfg.input_resize, B_in_cams[ids], mesh_centered, rgb_tensor, depth_tensor, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter, frame_ids=frame_ids[ids] if frame_ids is not None else None, device=self.device, templates=templates_chunk, lod_level=lod_level)
+          A = torch.cat([pose_data.rgbAs, pose_data.xyz_mapAs], dim=1).float()
+          B = torch.cat([pose_data.rgbBs, pose_data.xyz_mapBs], dim=1).float()
+          pose_data.rgbAs = pose_data.rgbBs = pose_data.xyz_mapAs = pose_data.xyz_mapBs = None   # Only A,B are needed from here, free the crops before the forward
+          logging.info("forward start")
+          with trace_span('refiner_forward', n_poses=len(A)):
+            output = self.runtime(A,B)
+          del A, B
         for k in output:
           output[k] = output[k].float()
         logging.info("forward done")
@@ -201,19 +258,19 @@ class PoseRefinePredictor:
 
         elif self.cfg['trans_rep']=='deepim':
           def project_and_transform_to_crop(centers):
-            uvs = (pose_data.Ks[b:b+bs]@centers.reshape(-1,3,1)).reshape(-1,3)
+            uvs = (pose_data.Ks@centers.reshape(-1,3,1)).reshape(-1,3)
             uvs = uvs/uvs[:,2:3]
-            uvs = (pose_data.tf_to_crops[b:b+bs]@uvs.reshape(-1,3,1)).reshape(-1,3)
+            uvs = (pose_data.tf_to_crops@uvs.reshape(-1,3,1)).reshape(-1,3)
             return uvs[:,:2]
 
           rot_delta = output["rot"]
-          z_pred = output['trans'][:,2]*pose_data.poseA[b:b+bs][...,2,3]
-          uvA_crop = project_and_transform_to_crop(pose_data.poseA[b:b+bs][...,:3,3])
+          z_pred = output['trans'][:,2]*pose_data.poseA[...,2,3]
+          uvA_crop = project_and_transform_to_crop(pose_data.poseA[...,:3,3])
           uv_pred_crop = uvA_crop + output['trans'][:,:2]*self.cfg['input_resize'][0]
-          uv_pred = transform_pts(uv_pred_crop, pose_data.tf_to_crops[b:b+bs].inverse().cuda())
-          center_pred = torch.cat([uv_pred, torch.ones((len(rot_delta),1), dtype=torch.float, device='cuda')], dim=-1)
-          center_pred = (pose_data.Ks[b:b+bs].inverse().cuda()@center_pred.reshape(len(rot_delta),3,1)).reshape(len(rot_delta),3) * z_pred.reshape(len(rot_delta),1)
-          trans_delta = center_pred-pose_data.poseA[b:b+bs][...,:3,3]
+          uv_pred = transform_pts(uv_pred_crop, torch.linalg.inv_ex(pose_data.tf_to_crops)[0])
+          center_pred = torch.cat([uv_pred, torch.ones((len(rot_delta),1), dtype=torch.float, device=self.device)], dim=-1)
+          center_pred = (torch.linalg.inv_ex(pose_data.Ks)[0]@center_pred.reshape(len(rot_delta),3,1)).reshape(len(rot_delta),3) * z_pred.reshape(len(rot_delta),1)
+          trans_delta = center_pred-pose_data.poseA[...,:3,3]
 
         else:
           trans_delta = output["trans"]
@@ -229,21 +286,36 @@ class PoseRefinePredictor:
         if self.cfg['normalize_xyz']:
           trans_delta *= (mesh_diameter/2)
 
-        B_in_cam = egocentric_delta_pose_to_pose(pose_data.poseA[b:b+bs], trans_delta=trans_delta, rot_mat_delta=rot_mat_delta)
-        B_in_cams.append(B_in_cam)
-
-      B_in_cams = torch.cat(B_in_cams, dim=0).reshape(len(ob_in_cams),4,4)
-
-    B_in_cams_out = B_in_cams@torch.tensor(tf_to_center[None], device='cuda', dtype=torch.float)
-    torch.cuda.empty_cache()
-    self.last_trans_update = trans_delta
-    self.last_rot_update = rot_mat_delta
+        B_in_cam = egocentric_delta_pose_to_pose(pose_data.poseA, trans_delta=trans_delta, rot_mat_delta=rot_mat_delta)
+        B_in_cams_active.append(B_in_cam)
+        trans_deltas.append(trans_delta.expand(len(B_in_cam),3))
+        rot_mat_deltas.append(rot_mat_delta)
+
+      trans_delta = torch.cat(trans_deltas, dim=0)
+      rot_mat_delta = torch.cat(rot_mat_deltas, dim=0)
+      B_in_cams[active] = torch.cat(B_in_cams_active, dim=0).reshape(len(active),4,4)
+      trans_updates[active] = trans_delta
+      rot_updates[active] = rot_mat_delta
+
+      if converge_tol is not None:
+        rot_angle = torch.acos(((rot_mat_delta[:,0,0]+rot_mat_delta[:,1,1]+rot_mat_delta[:,2,2]-1)/2).clip(-1,1))
+        converged = (trans_delta.norm(dim=-1)<converge_tol[0]) & (rot_angle<converge_tol[1])
+        active = active[~converged]
+        logging.info(f'{len(active)}/{N} hypotheses still active')
+        if len(active)==0:
+          break
+
+    B_in_cams_out = B_in_cams
+    empty_device_cache(self.device)
+    self.last_trans_update = trans_updates
+    self.last_rot_update = rot_updates
+    self.last_n_active = len(active)
 
     if get_vis:
       logging.info("get_vis...")
       canvas = []
       padding = 2
-      pose_data = make_crop_data_batch(self.cfg.input_resize, torch.as_tensor(ob_centered_in_cams), mesh_centered, rgb, depth, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter)
+      pose_data = make_crop_data_batch(self.cfg.input_resize, torch.as_tensor(ob_centered_in_cams), mesh_centered, rgb, depth, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter, frame_ids=frame_ids, device=self.device, lod_level=lod_level)
       for id in range(0, len(B_in_cams)):
         rgbA_vis = (pose_data.rgbAs[id]*255).permute(1,2,0).data.cpu().numpy()
         rgbB_vis = (pose_data.rgbBs[id]*255).permute(1,2,0).data.cpu().numpy()
@@ -267,7 +339,7 @@ class PoseRefinePredictor:
         canvas.append(row)
       canvas = make_grid_image(canvas, nrow=1, padding=padding, pad_value=255)
 
-      pose_data = make_crop_data_batch(self.cfg.input_resize, B_in_cams, mesh_centered, rgb, depth, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter)
+      pose_data = make_crop_data_batch(self.cfg.input_resize, B_in_cams, mesh_centered, rgb, depth, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter, frame_ids=frame_ids, device=self.device, lod_level=lod_level)
       canvas_refined = []
       for id in range(0, len(B_in_cams)):
         rgbA_vis = (pose_data.rgbAs[id]*255).permute(1,2,0).data.cpu().numpy()
@@ -290,7 +362,7 @@ class PoseRefinePredictor:
 
       canvas_refined = make_grid_image(canvas_refined, nrow=1, padding=padding, pad_value=255)
       canvas = make_grid_image([canvas, canvas_refined], nrow=2, padding=padding, pad_value=255)
-      torch.cuda.empty_cache()
+      empty_device_cache(self.device)
       return B_in_cams_out, canvas
 
     return B_in_cams_out, None
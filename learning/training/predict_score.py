@@ -12,9 +12,7 @@ import os,sys,kornia
 import time
 import numpy as np
 import torch
-import torch.distributed as dist
 from omegaconf import OmegaConf
-from tqdm import tqdm
 code_dir = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(f'{code_dir}/../../../')
 from learning.datasets.h5_dataset import *
@@ -22,6 +20,9 @@ from learning.models.score_network import *
 from learning.datasets.pose_dataset import *
 from Utils import *
 from datareader import *
+from instrumentation import trace_span
+from learning.models.runtime import make_runtime
+from learning.models import model_registry
 
 
 def vis_batch_data_scores(pose_data, ids, scores, pad_margin=5):
@@ -54,60 +55,75 @@ def vis_batch_data_scores(pose_data, ids, scores, pad_margin=5):
 
 
 @torch.no_grad()
-def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_ratio, normal_map=None, mesh_diameter=None, glctx=None, mesh_tensors=None, dataset:TripletH5Dataset=None, cfg=None):
+def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_ratio, normal_map=None, mesh_diameter=None, glctx=None, mesh_tensors=None, dataset:TripletH5Dataset=None, cfg=None, frame_ids=None, device=None, lod_level=0):
+  '''
+  @frame_ids: (B,) tensor, when given rgb/depth/K are stacked frames (F,...) and each pose is cropped from its own frame
+  @device: where the crops are made, default is get_default_device()
+  @lod_level: LOD level the poses are rendered at, see Utils.select_lod_level
+  '''
   logging.info("Welcome make_crop_data_batch")
-  H,W = depth.shape[:2]
+  if device is None:
+    device = get_default_device()
+  H,W = depth.shape[-2:]
 
   args = []
   method = 'box_3d'
-  tf_to_crops = compute_crop_window_tf_batch(pts=mesh.vertices, H=H, W=W, poses=ob_in_cams, K=K, crop_ratio=crop_ratio, out_size=(render_size[1], render_size[0]), method=method, mesh_diameter=mesh_diameter)
-  logging.info("make tf_to_crops done")
-
+  Ks = device_constants.get(K, device).reshape(-1,3,3)
+  projection_mat = projection_matrix_from_intrinsics_batch(Ks, height=H, width=W, znear=0.001, zfar=100)
   B = len(ob_in_cams)
-  poseAs = torch.as_tensor(ob_in_cams, dtype=torch.float, device='cuda')
+  if frame_ids is not None:
+    frame_ids = torch.as_tensor(frame_ids, device=device, dtype=torch.long)
+    projection_mat = projection_mat[frame_ids]
+    Ks = Ks[frame_ids]
+  else:
+    projection_mat = projection_mat.expand(B,4,4)
+  poseAs = torch.as_tensor(ob_in_cams, dtype=torch.float, device=device)
+  tf_to_crops = compute_crop_window_tf_batch(pts=mesh.vertices, H=H, W=W, poses=poseAs, K=Ks if frame_ids is not None else K, crop_ratio=crop_ratio, out_size=(render_size[1], render_size[0]), method=method, mesh_diameter=mesh_diameter)
+  logging.info("make tf_to_crops done")
 
   bs = 512
   rgb_rs = []
   depth_rs = []
   xyz_map_rs = []
 
-  bbox2d_crop = torch.as_tensor(np.array([0, 0, cfg['input_resize'][0]-1, cfg['input_resize'][1]-1]).reshape(2,2), device='cuda', dtype=torch.float)
-  bbox2d_ori = transform_pts(bbox2d_crop, tf_to_crops.inverse()[:,None]).reshape(-1,4)
+  bbox2d_crop = device_constants.get(np.array([0, 0, cfg['input_resize'][0]-1, cfg['input_resize'][1]-1]).reshape(2,2), device)
+  bbox2d_ori = transform_pts(bbox2d_crop, torch.linalg.inv_ex(tf_to_crops)[0][:,None]).reshape(-1,4)
 
-  for b in range(0,len(ob_in_cams),bs):
-    extra = {}
-    rgb_r, depth_r, normal_r = nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=poseAs[b:b+bs], context='cuda', get_normal=cfg['use_normal'], glctx=glctx, mesh_tensors=mesh_tensors, output_size=cfg['input_resize'], bbox2d=bbox2d_ori[b:b+bs], use_light=True, extra=extra)
-    rgb_rs.append(rgb_r)
-    depth_rs.append(depth_r[...,None])
-    xyz_map_rs.append(extra['xyz_map'])
+  with trace_span('crop_render', n_poses=B):
+    for b in range(0,len(ob_in_cams),bs):
+      extra = {}
+      rgb_r, depth_r, normal_r = nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=poseAs[b:b+bs], context='cuda', get_normal=cfg['use_normal'], glctx=glctx, mesh_tensors=mesh_tensors, output_size=cfg['input_resize'], bbox2d=bbox2d_ori[b:b+bs], use_light=True, extra=extra, projection_mat=projection_mat[b:b+bs], lod_level=lod_level)
+      rgb_rs.append(rgb_r)
+      depth_rs.append(depth_r[...,None])
+      xyz_map_rs.append(extra['xyz_map'])
 
-  rgb_rs = torch.cat(rgb_rs, dim=0).permute(0,3,1,2) * 255
-  depth_rs = torch.cat(depth_rs, dim=0).permute(0,3,1,2)
-  xyz_map_rs = torch.cat(xyz_map_rs, dim=0).permute(0,3,1,2)  #(B,3,H,W)
+    rgb_rs = torch.cat(rgb_rs, dim=0).permute(0,3,1,2) * 255
+    depth_rs = torch.cat(depth_rs, dim=0).permute(0,3,1,2)
+    xyz_map_rs = torch.cat(xyz_map_rs, dim=0).permute(0,3,1,2)  #(B,3,H,W)
   logging.info("render done")
+  with trace_span('crop_warp', n_poses=B):
+    rgbBs = warp_perspective_frames(torch.as_tensor(rgb, dtype=torch.float, device=device).movedim(-1,-3), tf_to_crops, dsize=render_size, mode='bilinear', frame_ids=frame_ids)
+    depthBs = warp_perspective_frames(torch.as_tensor(depth, dtype=torch.float, device=device).unsqueeze(-3), tf_to_crops, dsize=render_size, mode='nearest', frame_ids=frame_ids)
+    if rgb_rs.shape[-2:]!=cfg['input_resize']:
+      rgbAs = kornia.geometry.transform.warp_perspective(rgb_rs, tf_to_crops, dsize=render_size, mode='bilinear', align_corners=False)
+      depthAs = kornia.geometry.transform.warp_perspective(depth_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
+    else:
+      rgbAs = rgb_rs
+      depthAs = depth_rs
 
-  rgbBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(rgb, dtype=torch.float, device='cuda').permute(2,0,1)[None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='bilinear', align_corners=False)
-  depthBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(depth, dtype=torch.float, device='cuda')[None,None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
-  if rgb_rs.shape[-2:]!=cfg['input_resize']:
-    rgbAs = kornia.geometry.transform.warp_perspective(rgb_rs, tf_to_crops, dsize=render_size, mode='bilinear', align_corners=False)
-    depthAs = kornia.geometry.transform.warp_perspective(depth_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
-  else:
-    rgbAs = rgb_rs
-    depthAs = depth_rs
-
-  if xyz_map_rs.shape[-2:]!=cfg['input_resize']:
-    xyz_mapAs = kornia.geometry.transform.warp_perspective(xyz_map_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
-  else:
-    xyz_mapAs = xyz_map_rs
+    if xyz_map_rs.shape[-2:]!=cfg['input_resize']:
+      xyz_mapAs = kornia.geometry.transform.warp_perspective(xyz_map_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
+    else:
+      xyz_mapAs = xyz_map_rs
 
-  normalAs = None
-  normalBs = None
+    normalAs = None
+    normalBs = None
 
-  Ks = torch.as_tensor(K, dtype=torch.float).reshape(1,3,3).expand(len(rgbAs),3,3)
-  mesh_diameters = torch.ones((len(rgbAs)), dtype=torch.float, device='cuda')*mesh_diameter
+    Ks = Ks.expand(len(rgbAs),3,3)
+    mesh_diameters = torch.ones((len(rgbAs)), dtype=torch.float, device=device)*mesh_diameter
 
-  pose_data = BatchPoseData(rgbAs=rgbAs, rgbBs=rgbBs, depthAs=depthAs, depthBs=depthBs, normalAs=normalAs, normalBs=normalBs, poseA=poseAs, xyz_mapAs=xyz_mapAs, tf_to_crops=tf_to_crops, Ks=Ks, mesh_diameters=mesh_diameters)
-  pose_data = dataset.transform_batch(pose_data, H_ori=H, W_ori=W, bound=1)
+    pose_data = BatchPoseData(rgbAs=rgbAs, rgbBs=rgbBs, depthAs=depthAs, depthBs=depthBs, normalAs=normalAs, normalBs=normalBs, poseA=poseAs, xyz_mapAs=xyz_mapAs, tf_to_crops=tf_to_crops, Ks=Ks, mesh_diameters=mesh_diameters)
+    pose_data = dataset.transform_batch(pose_data, H_ori=H, W_ori=W, bound=1, device=device)
 
   logging.info("pose batch data done")
 
@@ -115,15 +131,21 @@ def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_rati
 
 
 class ScorePredictor:
-  def __init__(self, amp=True):
+  def __init__(self, amp=True, device=None, runtime_backend='eager', runtime_file=None):
+    '''
+    @device: where the model runs and crops are made, default is get_default_device()
+    @runtime_backend: eager, torchscript or onnx, see learning/models/runtime.py to export the graph. int8 runs a quantized copy on cpu, see learning/models/quantization.py
+    @runtime_file: exported graph of the torchscript/onnx backends, calibration crops of int8
+    '''
     self.amp = amp
+    self.device = torch.device(device) if device is not None else get_default_device()
     self.run_name = "2024-01-11-20-02-45"
 
     model_name = 'model_best.pth'
     code_dir = os.path.dirname(os.path.realpath(__file__))
     ckpt_dir = f'{code_dir}/../../weights/{self.run_name}/{model_name}'
 
-    self.cfg = OmegaConf.load(f'{code_dir}/../../weights/{self.run_name}/config.yml')
+    self.cfg = model_registry.load_config(self.run_name)
 
     self.cfg['ckpt_dir'] = ckpt_dir
     self.cfg['enable_amp'] = True
@@ -145,26 +167,45 @@ class ScorePredictor:
     logging.info(f"self.cfg: \n {OmegaConf.to_yaml(self.cfg)}")
 
     self.dataset = ScoreMultiPairH5Dataset(cfg=self.cfg, mode='test', h5_file=None, max_num_key=1)
-    self.model = ScoreNetMultiPair(cfg=self.cfg, c_in=self.cfg['c_in']).cuda()
+    self.runtime_backend = runtime_backend
+    self.runtime_file = runtime_file
+    self.load_model()
+    # Poses cropped, rendered and scored together, sized from the memory budget. Initial guess of ~96 float32 crop sized channels per pose (crops and activations) until measured
+    self.memory_budget = MemoryBudget(bytes_per_item=4*96*self.cfg.input_resize[0]*self.cfg.input_resize[1], max_chunk=1024)
+    # Largest set ranked by one cross attention in predict_topk, its cost grows quadratically with the set size
+    self.tournament_size = 64
+    logging.info("init done")
 
-    logging.info(f"Using pretrained model from {ckpt_dir}")
-    print(f"Using pretrained model from {ckpt_dir}") # debug
-    ckpt = torch.load(ckpt_dir)
-    if 'model' in ckpt:
-      ckpt = ckpt['model']
-    self.model.load_state_dict(ckpt)
 
-    self.model.cuda().eval()
-    logging.info("init done")
+  def load_model(self):
+    '''The network is shared process wide through the model registry, per checkpoint and device
+    '''
+    self.model = model_registry.get_network('score', self.cfg['ckpt_dir'], build_fn=lambda: ScoreNetMultiPair(cfg=self.cfg, c_in=self.cfg['c_in']), device=self.device)
+    self.runtime = make_runtime('score', backend=self.runtime_backend, model=self.model, file=self.runtime_file, device=self.device, amp=self.amp)
+
+
+  def to(self, device):
+    '''Switch to the shared network of another device, the network itself is never moved since other predictors may use it
+    '''
+    self.device = torch.device(device)
+    self.load_model()
+    return self
 
 
   @torch.inference_mode()
-  def predict(self, rgb, depth, K, ob_in_cams, normal_map=None, get_vis=False, mesh=None, mesh_tensors=None, glctx=None, mesh_diameter=None):
+  def predict(self, rgb, depth, K, ob_in_cams, normal_map=None, get_vis=False, mesh=None, mesh_tensors=None, glctx=None, mesh_diameter=None, frame_ids=None, group_size=None, lod_level=0):
     '''
     @rgb: np array (H,W,3)
+    @frame_ids: (N,) frame index of each pose, rgb/depth/K are then stacked over frames (F,...)
+    @group_size: poses are ranked against each other in consecutive groups of this size (e.g. one group per frame). Default is a single group
+    @lod_level: LOD level the crops are rendered at, chosen once by the caller (see FoundationPose.get_lod_level), 0 is the full mesh
     '''
     logging.info(f"ob_in_cams:{ob_in_cams.shape}")
-    ob_in_cams = torch.as_tensor(ob_in_cams, dtype=torch.float, device='cuda')
+    ob_in_cams = torch.as_tensor(ob_in_cams, dtype=torch.float, device=self.device)
+    if group_size is None:
+      group_size = len(ob_in_cams)
+    if len(ob_in_cams)%group_size!=0:
+      raise RuntimeError(f'{len(ob_in_cams)} poses can not be split into groups of {group_size}')
 
     logging.info(f'self.cfg.use_normal:{self.cfg.use_normal}')
     if not self.cfg.use_normal:
@@ -173,56 +214,100 @@ class ScorePredictor:
     logging.info("making cropped data")
 
     if mesh_tensors is None:
-      mesh_tensors = make_mesh_tensors(mesh)
-
-    rgb = torch.as_tensor(rgb, device='cuda', dtype=torch.float)
-    depth = torch.as_tensor(depth, device='cuda', dtype=torch.float)
+      mesh_tensors = make_mesh_tensors(mesh, device=self.device)
 
-    pose_data = make_crop_data_batch(self.cfg.input_resize, ob_in_cams, mesh, rgb, depth, K, crop_ratio=self.cfg['crop_ratio'], glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, cfg=self.cfg, mesh_diameter=mesh_diameter)
+    rgb = torch.as_tensor(rgb, device=self.device, dtype=torch.float)
+    depth = torch.as_tensor(depth, device=self.device, dtype=torch.float)
+    if frame_ids is not None:
+      frame_ids = torch.as_tensor(frame_ids, device=self.device, dtype=torch.long)
 
-    def find_best_among_pairs(pose_data:BatchPoseData):
+    def score_groups(pose_data:BatchPoseData):
+      '''Each group of poses is one set for the cross attention, several groups share a forward pass
+      '''
       logging.info(f'pose_data.rgbAs.shape[0]: {pose_data.rgbAs.shape[0]}')
-      ids = []
-      scores = []
-      bs = pose_data.rgbAs.shape[0]
-      for b in range(0, pose_data.rgbAs.shape[0], bs):
-        A = torch.cat([pose_data.rgbAs[b:b+bs].cuda(), pose_data.xyz_mapAs[b:b+bs].cuda()], dim=1).float()
-        B = torch.cat([pose_data.rgbBs[b:b+bs].cuda(), pose_data.xyz_mapBs[b:b+bs].cuda()], dim=1).float()
-        if pose_data.normalAs is not None:
-          A = torch.cat([A, pose_data.normalAs.cuda().float()], dim=1)
-          B = torch.cat([B, pose_data.normalBs.cuda().float()], dim=1)
-        with torch.cuda.amp.autocast(enabled=self.amp):
-          output = self.model(A, B, L=len(A))
-        scores_cur = output["score_logit"].float().reshape(-1)
-        ids.append(scores_cur.argmax()+b)
-        scores.append(scores_cur)
-      ids = torch.stack(ids, dim=0).reshape(-1)
-      scores = torch.cat(scores, dim=0).reshape(-1)
-      return ids, scores
-
-    pose_data_iter = pose_data
-    global_ids = torch.arange(len(ob_in_cams), device='cuda', dtype=torch.long)
-    scores_global = torch.zeros((len(ob_in_cams)), dtype=torch.float, device='cuda')
-
-    while 1:
-      ids, scores = find_best_among_pairs(pose_data_iter)
-      if len(ids)==1:
-        scores_global[global_ids] = scores + 100
-        break
-      global_ids = global_ids[ids]
-      pose_data_iter = pose_data.select_by_indices(global_ids)
-
-    scores = scores_global
+      A = torch.cat([pose_data.rgbAs, pose_data.xyz_mapAs], dim=1).float()
+      B = torch.cat([pose_data.rgbBs, pose_data.xyz_mapBs], dim=1).float()
+      if pose_data.normalAs is not None:
+        A = torch.cat([A, pose_data.normalAs.float()], dim=1)
+        B = torch.cat([B, pose_data.normalBs.float()], dim=1)
+      with trace_span('scorer_forward', n_poses=len(A), group_size=group_size):
+        output = self.runtime(A, B, L=group_size)
+      return output["score_logit"].float().reshape(-1)
+
+    # Crops of one chunk are freed before the next one is rendered, whole groups only
+    scores = []
+    bs = self.memory_budget.chunk_size(self.device, multiple=group_size)
+    for b in range(0, len(ob_in_cams), bs):
+      with self.memory_budget.measure(self.device, n_items=len(ob_in_cams[b:b+bs])):
+        pose_data = make_crop_data_batch(self.cfg.input_resize, ob_in_cams[b:b+bs], mesh, rgb, depth, K, crop_ratio=self.cfg['crop_ratio'], glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, cfg=self.cfg, mesh_diameter=mesh_diameter, frame_ids=frame_ids[b:b+bs] if frame_ids is not None else None, device=self.device, lod_level=lod_level)
+        scores.append(score_groups(pose_data))
+        del pose_data
+    scores = torch.cat(scores, dim=0) + 100
 
     logging.info(f'forward done')
-    torch.cuda.empty_cache()
+    empty_device_cache(self.device)
 
     if get_vis:
       logging.info("get_vis...")
       canvas = []
       ids = scores.argsort(descending=True)
+      pose_data = make_crop_data_batch(self.cfg.input_resize, ob_in_cams, mesh, rgb, depth, K, crop_ratio=self.cfg['crop_ratio'], glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, cfg=self.cfg, mesh_diameter=mesh_diameter, frame_ids=frame_ids, device=self.device, lod_level=lod_level)
       canvas = vis_batch_data_scores(pose_data, ids=ids, scores=scores)
       return scores, canvas
 
     return scores, None
 
+
+
+  @torch.inference_mode()
+  def predict_topk(self, rgb, depth, K, ob_in_cams, k=1, tournament_size=None, normal_map=None, mesh=None, mesh_tensors=None, glctx=None, mesh_diameter=None, lod_level=0):
+    '''Tournament scoring: the cross attention only ever sees sets of at most tournament_size poses, so memory stays bounded however many hypotheses there are.
+    Each round splits the candidates into balanced sets and advances the best k of every set, the last round ranks all survivors as one set,
+    so the returned scores are comparable with each other like those of predict. With no more than tournament_size poses this is exactly predict
+    @k: at most tournament_size//2, so every round shrinks the candidates
+    @return: ids (k,) into ob_in_cams and scores (k,), best first
+    '''
+    if tournament_size is None:
+      tournament_size = self.tournament_size
+    if k<1 or 2*k>tournament_size:
+      raise RuntimeError(f'k={k} must be in [1, tournament_size//2={tournament_size//2}]')
+    ob_in_cams = torch.as_tensor(ob_in_cams, dtype=torch.float, device=self.device)
+    if mesh_tensors is None:
+      mesh_tensors = make_mesh_tensors(mesh, device=self.device)
+    kwargs = dict(rgb=rgb, depth=depth, K=K, normal_map=normal_map, mesh=mesh, mesh_tensors=mesh_tensors, glctx=glctx, mesh_diameter=mesh_diameter, lod_level=lod_level)
+
+    candidates = torch.arange(len(ob_in_cams), device=self.device)
+    round_id = 0
+    while len(candidates)>tournament_size:
+      n_sets = int(np.ceil(len(candidates)/tournament_size))
+      base = len(candidates)//n_sets
+      n_big = len(candidates)%n_sets    # The first n_big sets get one more pose
+      winners = []
+      for begin,end,set_size in [(0, n_big*(base+1), base+1), (n_big*(base+1), len(candidates), base)]:
+        if end==begin:
+          continue
+        ids = candidates[begin:end]
+        scores, _ = self.predict(ob_in_cams=ob_in_cams[ids], group_size=set_size, **kwargs)
+        best = scores.reshape(-1,set_size).topk(k, dim=1).indices
+        winners.append(ids.reshape(-1,set_size).gather(1, best).reshape(-1))
+      logging.info(f'tournament round {round_id}: {len(candidates)} poses in {n_sets} sets, {n_sets*k} advance')
+      candidates = torch.cat(winners, dim=0)
+      round_id += 1
+
+    scores, _ = self.predict(ob_in_cams=ob_in_cams[candidates], **kwargs)
+    scores, order = scores.topk(min(k, len(candidates)))
+    return candidates[order], scores
+
+
+  def compare_topk(self, rgb, depth, K, ob_in_cams, k=1, tournament_size=None, **kwargs):
+    '''Tournament against the full set scoring of predict, the reference for accuracy
+    @return: dict with whether both pick the same best pose and how many of the reference top k the tournament keeps
+    '''
+    ids, scores = self.predict_topk(rgb=rgb, depth=depth, K=K, ob_in_cams=ob_in_cams, k=k, tournament_size=tournament_size, **kwargs)
+    ref_scores, _ = self.predict(rgb=rgb, depth=depth, K=K, ob_in_cams=ob_in_cams, **kwargs)
+    ref_ids = ref_scores.topk(len(ids)).indices
+    return {
+      'top1_agree': bool(ids[0]==ref_ids[0]),
+      'recall_at_k': float(torch.isin(ids, ref_ids).float().mean()),
+      'ref_rank_of_best': int((ref_scores>ref_scores[ids[0]]).sum()),
+    }
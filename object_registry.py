@@ -0,0 +1,129 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+import logging
+from collections import OrderedDict
+import torch
+import torch.nn as nn
+
+
+# Everything FoundationPose keeps per object. Swapping these in and out is all it takes to change the active object
+OBJECT_STATE_KEYS = [
+  'model_center', 'mesh_ori', 'diameter', 'vox_size', 'dist_bin', 'angle_bin', 'max_xyz', 'min_xyz',
+  'pts', 'normals', 'mesh_path', 'mesh', 'mesh_tensors', 'symmetry_tfs', 'rot_grid', 'pose_last', 'track_score', 'frames_since_score',
+  'template_bank', 'lod_errors',
+]
+
+
+def estimate_state_nbytes(state):
+  '''Device memory held by the tensors of an object state
+  '''
+  if torch.is_tensor(state):
+    return state.numel()*state.element_size()
+  if hasattr(state, 'state_tensors'):   # Objects holding tensors, e.g. TemplateBank
+    return estimate_state_nbytes(state.state_tensors())
+  if isinstance(state, dict):
+    return sum(estimate_state_nbytes(v) for v in state.values())
+  if isinstance(state, (list, tuple)):
+    return sum(estimate_state_nbytes(v) for v in state)
+  return 0
+
+
+def move_state_to(state, device):
+  if torch.is_tensor(state) or isinstance(state, nn.Module) or hasattr(state, 'state_tensors'):
+    return state.to(device)
+  if isinstance(state, dict):
+    return {k: move_state_to(v, device) for k,v in state.items()}
+  return state
+
+
+class ObjectRegistry:
+  '''Objects known to an estimator, keyed by ob_id.
+  Each entry keeps the inputs needed to rebuild the object (cheap with an asset cache) and, while resident, its ready-to-use state.
+  Resident states are evicted in LRU order once max_bytes or max_objects is exceeded.
+  '''
+  def __init__(self, max_bytes=None, max_objects=None):
+    self.max_bytes = max_bytes
+    self.max_objects = max_objects
+    self.sources = {}
+    self.states = OrderedDict()   # ob_id -> state, most recently used last
+    self.nbytes = {}
+
+
+  def __contains__(self, ob_id):
+    return ob_id in self.sources
+
+
+  def __len__(self):
+    return len(self.sources)
+
+
+  def add(self, ob_id, model_pts, model_normals, symmetry_tfs=None, mesh=None):
+    if ob_id in self.sources:
+      self.drop_state(ob_id)
+    self.sources[ob_id] = dict(model_pts=model_pts, model_normals=model_normals, symmetry_tfs=symmetry_tfs, mesh=mesh)
+
+
+  def remove(self, ob_id):
+    self.drop_state(ob_id)
+    self.sources.pop(ob_id, None)
+
+
+  def get_source(self, ob_id):
+    return self.sources[ob_id]
+
+
+  def get_state(self, ob_id):
+    '''@return: the resident state and mark it as most recently used, None if not resident
+    '''
+    if ob_id not in self.states:
+      return None
+    self.states.move_to_end(ob_id)
+    return self.states[ob_id]
+
+
+  def put_state(self, ob_id, state, keep=None):
+    '''@keep: ob_id that must not be evicted, usually the active one
+    '''
+    self.states[ob_id] = state
+    self.states.move_to_end(ob_id)
+    self.nbytes[ob_id] = estimate_state_nbytes(state)
+    self.evict(keep=ob_id if keep is None else keep)
+
+
+  def drop_state(self, ob_id):
+    self.states.pop(ob_id, None)
+    self.nbytes.pop(ob_id, None)
+
+
+  def resident_nbytes(self):
+    return sum(self.nbytes.values())
+
+
+  def over_budget(self):
+    if self.max_objects is not None and len(self.states)>self.max_objects:
+      return True
+    if self.max_bytes is not None and self.resident_nbytes()>self.max_bytes:
+      return True
+    return False
+
+
+  def evict(self, keep=None):
+    for ob_id in list(self.states.keys()):
+      if not self.over_budget():
+        break
+      if ob_id==keep:
+        continue
+      logging.info(f"evict object {ob_id}, {self.nbytes[ob_id]/1e6:.1f}MB")
+      self.drop_state(ob_id)
+
+
+  def to_device(self, device):
+    for ob_id in self.states:
+      self.states[ob_id] = move_state_to(self.states[ob_id], device)
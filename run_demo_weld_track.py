@@ -31,12 +31,21 @@ def main():
   track_refine_iter = 2
   # 调试级别，控制可视化输出 默认为 1 级
   debug = 3
+  # 是否使用多线程流水线 (读取/预处理/跟踪/保存并行)，调试级别 >=3 时仍使用串行循环
+  pipelined = False
+  # 是否记录各阶段耗时，结果保存为 trace.json 和 chrome_trace.json (可用 chrome://tracing 打开)
+  trace = False
+  # 优化收敛阈值 (平移米, 旋转弧度)，更新量低于阈值的假设不再渲染和推理，None 表示跑满迭代次数
+  converge_tol = None
  
   # 调试信息存储目录
   debug_dir = f'{code_dir}/my_data_debug3'
  
   set_logging_format()  # 设置日志格式
   set_seed(0)
+  if trace:
+    tracer = Tracer()
+    set_tracer(tracer)
  
   mesh = trimesh.load(mesh_file)  # 读取 3D 物体网格文件
  
@@ -86,6 +95,7 @@ def main():
   # 初始化姿态估计器
   scorer = ScorePredictor()  # 评分模型，可能用于评估姿态估计的质量
   refiner = PoseRefinePredictor()  # 姿态优化模型，用于优化初始姿态估计结果
+  refiner.converge_tol = converge_tol
   glctx = dr.RasterizeCudaContext()  # 可能是一个 CUDA 计算环境，用于高效渲染
  
   # 创建姿态估计器 est，传入 3D 物体模型、评分器、优化器、调试参数等
@@ -99,6 +109,17 @@ def main():
   reader = YcbineoatReader(video_dir=test_scene_dir, shorter_side=480, zfar=np.inf) 
   # debug: shorter_side缩放输入图片，同时也会缩放内参
  
+  if pipelined and debug < 3:
+    from track_pipeline import TrackPipeline, make_default_sink
+    sink = make_default_sink(reader, debug_dir, to_origin, bbox, debug=debug)
+    pipeline = TrackPipeline(est, reader, register_iteration=est_refine_iter, track_iteration=track_refine_iter, sink=sink)
+    stats = pipeline.run()
+    logging.info(f"pipeline fps: {stats['total']['fps']:.1f}")
+    if trace:
+      tracer.export_json(f'{debug_dir}/trace.json')
+      tracer.export_chrome_trace(f'{debug_dir}/chrome_trace.json')
+    return
+ 
   # 实时视频处理
   # 遍历 test_scene_dir 目录中的所有 RGB 帧，并读取对应的深度图
   for i in range(len(reader.color_files)):
@@ -115,13 +136,11 @@ def main():
  
       # 只有当 debug 级别 大于等于 3 时，才会执行下面的代码
       if debug >= 3:  # debug为1级 最基本的可视化 debug为2级 保存中间结果track_vis中的图像 debug为3级 更详细的可视化，例如导出变换后的 3D 物体模型和场景点云
-        m = mesh.copy()
-        m.apply_transform(pose)
-        m.export(f'{debug_dir}/model_tf.obj')
+        # 调试文件由后台线程写出，不占用推理时间
+        est.get_debug_writer().export_mesh(f'{debug_dir}/model_tf.obj', mesh, transform=pose)
         xyz_map = depth2xyzmap(depth, reader.K)
         valid = depth >= 0.001
-        pcd = toOpen3dCloud(xyz_map[valid], color[valid])
-        o3d.io.write_point_cloud(f'{debug_dir}/scene_complete.ply', pcd)
+        est.get_debug_writer().write_point_cloud(f'{debug_dir}/scene_complete.ply', xyz_map[valid], color[valid])
     else:
       # 进行姿态跟踪，从前一帧的姿态开始，优化track_refine_iter轮
       pose = est.track_one(rgb=color, depth=depth, K=reader.K, iteration=track_refine_iter)
@@ -142,7 +161,14 @@ def main():
     # 如果 debug >= 2，保存可视化的跟踪结果图片
     if debug >= 2:
       os.makedirs(f'{debug_dir}/track_vis', exist_ok=True)
-      imageio.imwrite(f'{debug_dir}/track_vis/{reader.id_strs[i]}.png', vis)
+      est.get_debug_writer().write_image(f'{debug_dir}/track_vis/{reader.id_strs[i]}.png', vis)
+
+  if est.debug_writer is not None:
+    est.debug_writer.flush()
+
+  if trace:
+    tracer.export_json(f'{debug_dir}/trace.json')
+    tracer.export_chrome_trace(f'{debug_dir}/chrome_trace.json')
  
  
 if __name__ == '__main__':
@@ -142,6 +142,7 @@ if __name__=='__main__':
   parser.add_argument('--debug', type=int, default=0)
   parser.add_argument('--debug_dir', type=str, default=f'{code_dir}/debug')
   opt = parser.parse_args()
+  set_logging_format()
   set_seed(0)
 
   detect_type = 'mask'   # mask / box / detected
@@ -174,6 +174,7 @@ if __name__=='__main__':
   parser.add_argument('--debug', type=int, default=0)
   parser.add_argument('--debug_dir', type=str, default=f'/root/autodl-tmp/lm_test_all/debug') # lm_test_all  lm_test
   opt = parser.parse_args()
+  set_logging_format()
   set_seed(0)
  
   detect_type = 'mask'   # mask / box / detected
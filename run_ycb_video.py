@@ -140,6 +140,7 @@ if __name__=='__main__':
   parser.add_argument('--debug', type=int, default=0)
   parser.add_argument('--debug_dir', type=str, default=f'{code_dir}/debug')
   opt = parser.parse_args()
+  set_logging_format()
   os.environ["YCB_VIDEO_DIR"] = opt.ycbv_dir
 
   set_seed(0)
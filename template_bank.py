@@ -0,0 +1,209 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+import os,sys,json,uuid,argparse,kornia
+code_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(code_dir)
+from Utils import *
+
+
+# Refiner crops of every rot_grid rotation, rendered once per object at a canonical depth on the optical axis of a canonical camera.
+# The crop of a pose (R,t) is the template of R warped by the homography the plane through the object center, facing the canonical
+# camera, induces between the canonical camera/crop and the actual ones (see crop_homography). That is exact on that plane whatever
+# the intrinsics, depth and image position, the xyz crop is the template's, object centered, shifted by t.
+# What a homography can not undo is the change of viewing direction when t is off the optical axis, and the change of perspective
+# relief with depth. The hypotheses of register share one translation, guessed from the mask, so one check decides for all of them
+# whether the templates are close enough (translation near the optical axis and near the canonical depth) or the crops are rendered
+
+TEMPLATE_BANK_VERSION = 1
+CANONICAL_SIZE = 480
+
+
+def canonical_intrinsics(size=480, fov_deg=60):
+  f = size/2/np.tan(np.deg2rad(fov_deg)/2)
+  return np.array([[f,0,size/2],[0,f,size/2],[0,0,1]], dtype=np.float64)
+
+
+class TemplateBank:
+  def __init__(self, rotations, rgb, xyz_rel, z0, meta, max_off_axis_deg=10, max_depth_ratio=2):
+    '''
+    @rotations: (N,3,3) tensor, rotation of each template
+    @rgb: (N,3,H,W) uint8 tensor
+    @xyz_rel: (N,3,H,W) float16 tensor, rendered points minus the object center, nan on background
+    @meta: dict of the params the crops depend on, see make_meta
+    @max_off_axis_deg: templates are used while the angle between the optical axis and the direction to the object stays below this
+    @max_depth_ratio: and while the object depth is within this factor of z0
+    '''
+    self.rotations = rotations
+    self.rgb = rgb
+    self.xyz_rel = xyz_rel
+    self.z0 = float(z0)
+    self.meta = meta
+    self.max_off_axis_deg = max_off_axis_deg
+    self.max_depth_ratio = max_depth_ratio
+
+
+  @staticmethod
+  def make_meta(cfg, mesh_diameter, run_name=None):
+    return {
+      'version': TEMPLATE_BANK_VERSION,
+      'input_resize': [int(x) for x in cfg['input_resize']],
+      'crop_ratio': float(cfg['crop_ratio']),
+      'mesh_diameter': float(mesh_diameter),
+      'run_name': run_name,
+    }
+
+
+  @classmethod
+  @torch.inference_mode()
+  def build(cls, rot_grid, mesh, mesh_tensors, mesh_diameter, cfg, glctx=None, z0=None, run_name=None, device=None, bs=256):
+    '''Render the templates with the crop geometry of predict_pose_refine.make_crop_data_batch
+    @rot_grid: (N,4,4) tensor, rotations of the hypotheses in the centered mesh frame
+    @z0: canonical depth, default puts the object where it usually is relative to its size
+    '''
+    if device is None:
+      device = get_default_device()
+    if z0 is None:
+      z0 = max(0.5, 4*mesh_diameter)
+    size = CANONICAL_SIZE
+    K = canonical_intrinsics(size)
+    poses = torch.as_tensor(rot_grid, dtype=torch.float, device=device).clone()
+    poses[:,:3,3] = torch.tensor([0,0,z0], dtype=torch.float, device=device)
+    render_size = cfg['input_resize']
+    tf_to_crops = compute_crop_window_tf_batch(pts=mesh.vertices, H=size, W=size, poses=poses, K=K, crop_ratio=cfg['crop_ratio'], out_size=(render_size[1], render_size[0]), method='box_3d', mesh_diameter=mesh_diameter)
+    bbox2d_crop = torch.as_tensor(np.array([0, 0, render_size[0]-1, render_size[1]-1]).reshape(2,2), device=device, dtype=torch.float)
+    bbox2d_ori = transform_pts(bbox2d_crop, tf_to_crops.inverse()).reshape(-1,4)
+
+    rgbs = []
+    xyz_rels = []
+    for b in range(0, len(poses), bs):
+      extra = {}
+      rgb_r, depth_r, _ = nvdiffrast_render(K=K, H=size, W=size, ob_in_cams=poses[b:b+bs], glctx=glctx, mesh_tensors=mesh_tensors, output_size=render_size, bbox2d=bbox2d_ori[b:b+bs], use_light=True, extra=extra)
+      rgbs.append((rgb_r*255).round().clip(0,255).to(torch.uint8).permute(0,3,1,2))
+      xyz_rel = extra['xyz_map']-poses[b:b+bs,:3,3].reshape(-1,1,1,3)
+      xyz_rel[depth_r<0.001] = float('nan')
+      xyz_rels.append(xyz_rel.half().permute(0,3,1,2))
+    logging.info(f"rendered {len(poses)} templates at z0={z0:.3f}")
+    meta = cls.make_meta(cfg, mesh_diameter, run_name=run_name)
+    return cls(poses[:,:3,:3].contiguous(), torch.cat(rgbs, dim=0).contiguous(), torch.cat(xyz_rels, dim=0).contiguous(), z0, meta)
+
+
+  def save(self, file):
+    '''Compressed npz, backgrounds cost next to nothing
+    '''
+    os.makedirs(os.path.dirname(os.path.abspath(file)), exist_ok=True)
+    tmp_file = f'{file}.{uuid.uuid4().hex}.tmp.npz'
+    np.savez_compressed(tmp_file, rotations=self.rotations.data.cpu().numpy(), rgb=self.rgb.data.cpu().numpy(), xyz_rel=self.xyz_rel.data.cpu().numpy(), z0=np.asarray(self.z0), meta=np.asarray(json.dumps(self.meta)))
+    os.replace(tmp_file, file)
+    logging.info(f"template bank saved to {file}")
+
+
+  @classmethod
+  def load(cls, file, device=None):
+    if device is None:
+      device = get_default_device()
+    with np.load(file, allow_pickle=False) as data:
+      meta = json.loads(str(data['meta']))
+      if meta.get('version')!=TEMPLATE_BANK_VERSION:
+        raise RuntimeError(f"template bank {file} has version {meta.get('version')}, expected {TEMPLATE_BANK_VERSION}")
+      bank = cls(torch.as_tensor(data['rotations'], device=device), torch.as_tensor(data['rgb'], device=device), torch.as_tensor(data['xyz_rel'], device=device), float(data['z0']), meta)
+    logging.info(f"template bank loaded from {file}, {len(bank.rotations)} templates")
+    return bank
+
+
+  def state_tensors(self):
+    return [self.rotations, self.rgb, self.xyz_rel]
+
+
+  def to(self, device):
+    self.rotations = self.rotations.to(device)
+    self.rgb = self.rgb.to(device)
+    self.xyz_rel = self.xyz_rel.to(device)
+    return self
+
+
+  def matches(self, rot_grid, cfg, mesh_diameter):
+    '''Whether the templates were made for these hypotheses and crop params
+    '''
+    if len(rot_grid)!=len(self.rotations):
+      return False
+    if self.meta['input_resize']!=[int(x) for x in cfg['input_resize']] or abs(self.meta['crop_ratio']-float(cfg['crop_ratio']))>1e-6:
+      return False
+    if abs(self.meta['mesh_diameter']-float(mesh_diameter))>1e-6:
+      return False
+    return bool(torch.allclose(rot_grid[:,:3,:3].to(self.rotations.device), self.rotations, atol=1e-5))
+
+
+  def crop_homography(self, t, K):
+    '''Canonical crop to the crop of the actual pose, induced by the plane through the object center facing the canonical camera.
+    A point Y of that plane (object centered, Y_z=0) projects to K0@(Y+[0,0,z0]) in the canonical image and to K@(Y+t) in the actual one,
+    both linear in (Y_x,Y_y,1), so crop_a = tf_a@K@A(t)@inv(K0@A(z0))@inv(tf_0)@crop_0 with A(t) = [[1,0,tx],[0,1,ty],[0,0,tz]]
+    @t: (3,) tensor
+    @K: (3,3) intrinsics of the actual camera
+    @return: (3,3) tensor
+    '''
+    device = t.device
+    out_size = (self.meta['input_resize'][1], self.meta['input_resize'][0])
+    K0 = device_constants.get(canonical_intrinsics(CANONICAL_SIZE), device)
+    K = device_constants.get(K, device).reshape(3,3)
+    poses = torch.eye(4, dtype=torch.float, device=device).reshape(1,4,4).repeat(2,1,1)
+    poses[0,2,3] = self.z0
+    poses[1,:3,3] = t
+    kwargs = dict(crop_ratio=self.meta['crop_ratio'], out_size=out_size, method='box_3d', mesh_diameter=self.meta['mesh_diameter'])
+    tf0 = compute_crop_window_tf_batch(poses=poses[:1], K=K0, **kwargs)[0]
+    tf = compute_crop_window_tf_batch(poses=poses[1:], K=K, **kwargs)[0]
+    A0 = device_constants.get(np.diag([1,1,self.z0]), device)
+    A = torch.eye(3, dtype=torch.float, device=device)
+    A[:,2] = t
+    return tf@K@A@torch.linalg.inv_ex(K0@A0)[0]@torch.linalg.inv_ex(tf0)[0]
+
+
+  def get(self, ob_in_cams, K):
+    '''
+    @ob_in_cams: (N,4,4) tensor, the rot_grid rotations in order sharing one translation, as made by generate_random_pose_hypo
+    @K: (3,3) intrinsics of the frame
+    @return: dict with rgb (N,3,H,W) float in [0,255] and xyz_map (N,3,H,W) in the camera frame, zero on background, or None when the crops should be rendered
+    '''
+    if len(ob_in_cams)!=len(self.rotations):
+      return None
+    t = ob_in_cams[0,:3,3]
+    if not (ob_in_cams[:,:3,3]==t).all() or not torch.allclose(ob_in_cams[:,:3,:3], self.rotations, atol=1e-5):
+      return None
+    off_axis = float(torch.rad2deg(torch.atan2(t[:2].norm(), t[2])))
+    depth_ratio = float(t[2])/self.z0
+    if off_axis>self.max_off_axis_deg or not 1/self.max_depth_ratio<=depth_ratio<=self.max_depth_ratio:
+      logging.info(f"object is {off_axis:.1f} deg off axis at {depth_ratio:.2f}x the template depth, rendering crops")
+      return None
+    N = len(self.rotations)
+    dsize = tuple(self.rgb.shape[-2:])
+    tf = self.crop_homography(t, K).reshape(1,3,3).expand(N,3,3)
+    rgb = kornia.geometry.transform.warp_perspective(self.rgb.float(), tf, dsize=dsize, mode='bilinear', align_corners=False)
+    xyz_rel = self.xyz_rel.float()
+    valid = (~torch.isnan(xyz_rel[:,:1])).float()
+    xyz_rel = kornia.geometry.transform.warp_perspective(torch.cat([torch.nan_to_num(xyz_rel, nan=0), valid], dim=1), tf, dsize=dsize, mode='nearest', align_corners=False)
+    xyz_map = (xyz_rel[:,:3]+t.reshape(1,3,1,1))*xyz_rel[:,3:]   # Background, also where the warp leaves the template, stays zero
+    return {'rgb': rgb, 'xyz_map': xyz_map}
+
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser(description="Render the template bank of an object offline, load it with FoundationPose.load_template_bank")
+  parser.add_argument('--mesh_file', type=str, required=True)
+  parser.add_argument('--out', type=str, required=True)
+  parser.add_argument('--min_n_views', type=int, default=40)
+  parser.add_argument('--inplane_step', type=int, default=60)
+  parser.add_argument('--z0', type=float, default=None)
+  args = parser.parse_args()
+  set_logging_format()
+
+  from estimater import FoundationPose
+  mesh = trimesh.load(args.mesh_file, force='mesh')
+  est = FoundationPose(model_pts=mesh.vertices, model_normals=mesh.vertex_normals, mesh=mesh, debug_dir=f'{code_dir}/debug/template_bank')
+  est.make_rotation_grid(min_n_views=args.min_n_views, inplane_step=args.inplane_step)
+  est.make_template_bank(z0=args.z0).save(args.out)
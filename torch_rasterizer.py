@@ -0,0 +1,157 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+import logging
+import torch
+import torch.nn.functional as F
+
+
+# Software rasterizer in plain torch, a drop-in for nvdiffrast's contexts on hosts without an NVIDIA GPU.
+# A render context provides rasterize/interpolate/texture with nvdiffrast's signatures and output layout
+# (rast_out[...,:4] = u, v, z/w, triangle_id+1, rows from the bottom of the image), see Utils.get_raster_ops.
+# Triangles with a vertex behind the camera are dropped instead of clipped, which never happens for the object crops we render
+
+_NO_HIT = torch.iinfo(torch.int64).max
+
+
+class TorchRasterizeContext:
+  def __init__(self, device='cpu', max_fragments=2**24):
+    '''
+    @max_fragments: candidate (triangle, pixel) pairs tested at once, bounds the memory of rasterize
+    '''
+    self.device = torch.device(device)
+    self.max_fragments = max_fragments
+
+
+  def screen_vertices(self, pos, tri, resolution):
+    '''@return: per triangle vertex pixel coords (N,T,3,2) with pixel centers at integers, z/w (N,T,3), w (N,T,3)
+    '''
+    H,W = resolution
+    v = pos[:,tri]   #(N,T,3,4)
+    w = v[...,3]
+    w_safe = torch.where(w.abs()>1e-12, w, torch.ones_like(w))
+    x = (v[...,0]/w_safe+1)*W/2-0.5
+    y = (v[...,1]/w_safe+1)*H/2-0.5
+    return torch.stack([x,y], dim=-1), v[...,2]/w_safe, w
+
+
+  @staticmethod
+  def screen_barycentrics(p, xy):
+    '''
+    @p: (M,2) pixel coords
+    @xy: (M,3,2) triangle vertices
+    @return: (M,3) screen space barycentrics
+    '''
+    a, b, c = xy[:,0], xy[:,1], xy[:,2]
+    area = (b[:,0]-a[:,0])*(c[:,1]-a[:,1])-(b[:,1]-a[:,1])*(c[:,0]-a[:,0])
+    b0 = ((b[:,0]-p[:,0])*(c[:,1]-p[:,1])-(b[:,1]-p[:,1])*(c[:,0]-p[:,0]))/area
+    b1 = ((c[:,0]-p[:,0])*(a[:,1]-p[:,1])-(c[:,1]-p[:,1])*(a[:,0]-p[:,0]))/area
+    return torch.stack([b0, b1, 1-b0-b1], dim=-1)
+
+
+  @torch.no_grad()
+  def rasterize(self, pos, tri, resolution):
+    '''
+    @pos: (N,V,4) clip space vertices
+    @tri: (T,3) int
+    @resolution: (H,W)
+    @return: rast_out (N,H,W,4), None in place of nvdiffrast's derivatives
+    '''
+    H,W = int(resolution[0]), int(resolution[1])
+    N = len(pos)
+    device = pos.device
+    pos = pos.float()
+    tri = tri.long()
+    xy, z, w = self.screen_vertices(pos, tri, (H,W))
+
+    area = (xy[...,1,0]-xy[...,0,0])*(xy[...,2,1]-xy[...,0,1])-(xy[...,1,1]-xy[...,0,1])*(xy[...,2,0]-xy[...,0,0])
+    xmin = xy[...,0].amin(dim=-1).ceil().clamp(min=0).long()
+    xmax = xy[...,0].amax(dim=-1).floor().clamp(max=W-1).long()
+    ymin = xy[...,1].amin(dim=-1).ceil().clamp(min=0).long()
+    ymax = xy[...,1].amax(dim=-1).floor().clamp(max=H-1).long()
+    valid = (w>0).all(dim=-1) & (area.abs()>1e-12) & (xmax>=xmin) & (ymax>=ymin)
+    valid &= (z>=-1).any(dim=-1) & (z<=1).any(dim=-1)
+
+    # Every valid (pose, triangle) expands to the pixels of its bounding box, tested in chunks of at most max_fragments
+    pose_ids, tri_ids = valid.nonzero(as_tuple=True)
+    bw = (xmax-xmin+1)[pose_ids, tri_ids]
+    counts = bw*(ymax-ymin+1)[pose_ids, tri_ids]
+    ends = counts.cumsum(dim=0)
+    zbuf = torch.full((N*H*W,), _NO_HIT, dtype=torch.int64, device=device)
+    begin = 0
+    while begin<len(counts):
+      base = int(ends[begin]-counts[begin])
+      end = int(torch.searchsorted(ends, base+self.max_fragments, right=True))
+      end = max(end, begin+1)
+      n_ids = pose_ids[begin:end]
+      t_ids = tri_ids[begin:end]
+      chunk_counts = counts[begin:end]
+      frag = torch.repeat_interleave(torch.arange(end-begin, device=device), chunk_counts)
+      local = torch.arange(int(chunk_counts.sum()), device=device)-torch.repeat_interleave(ends[begin:end]-chunk_counts-base, chunk_counts)
+      px = xmin[n_ids,t_ids][frag]+local%bw[begin:end][frag]
+      py = ymin[n_ids,t_ids][frag]+torch.div(local, bw[begin:end][frag], rounding_mode='floor')
+      n_frag = n_ids[frag]
+      t_frag = t_ids[frag]
+      bary = self.screen_barycentrics(torch.stack([px,py], dim=-1).float(), xy[n_frag,t_frag])
+      zf = (bary*z[n_frag,t_frag]).sum(dim=-1)
+      inside = (bary>=0).all(dim=-1) & (zf>=-1) & (zf<=1)
+      # Depth test and triangle id in one int64, the bits of the non negative float z+1 sort like the float
+      zbits = (zf[inside]+1).contiguous().view(torch.int32).to(torch.int64)
+      key = (zbits<<32) | t_frag[inside]
+      pixel = (n_frag[inside]*H+py[inside])*W+px[inside]
+      zbuf.scatter_reduce_(0, pixel, key, reduce='amin')
+      begin = end
+
+    rast_out = torch.zeros((N*H*W,4), dtype=torch.float, device=device)
+    hit = (zbuf!=_NO_HIT).nonzero(as_tuple=True)[0]
+    if len(hit)>0:
+      t_hit = zbuf[hit] & 0xffffffff
+      n_hit = torch.div(hit, H*W, rounding_mode='floor')
+      py = torch.div(hit%(H*W), W, rounding_mode='floor')
+      px = hit%W
+      bary = self.screen_barycentrics(torch.stack([px,py], dim=-1).float(), xy[n_hit,t_hit])
+      persp = bary/w[n_hit,t_hit]
+      persp = persp/persp.sum(dim=-1, keepdim=True)
+      rast_out[hit,0] = persp[:,0]
+      rast_out[hit,1] = persp[:,1]
+      rast_out[hit,2] = (bary*z[n_hit,t_hit]).sum(dim=-1)
+      rast_out[hit,3] = (t_hit+1).float()
+    return rast_out.reshape(N,H,W,4), None
+
+
+  def interpolate(self, attr, rast, tri):
+    '''
+    @attr: (V,C) or (N,V,C) vertex attributes
+    @return: (N,H,W,C) perspective correct interpolation, zero on background, None in place of derivatives
+    '''
+    tri_id = rast[...,3].long()-1
+    mask = tri_id>=0
+    faces = tri.long()[tri_id.clamp(min=0)]   #(N,H,W,3)
+    if attr.dim()==2:
+      a = attr[faces]
+    else:
+      a = attr[torch.arange(len(rast), device=rast.device).reshape(-1,1,1,1), faces]
+    u = rast[...,0:1]
+    v = rast[...,1:2]
+    out = a[...,0,:]*u+a[...,1,:]*v+a[...,2,:]*(1-u-v)
+    return out*mask[...,None], None
+
+
+  def texture(self, tex, uv, filter_mode='linear'):
+    '''
+    @tex: (1,Ht,Wt,C) or (N,Ht,Wt,C)
+    @uv: (N,H,W,2) in [0,1], wrapped around like nvdiffrast's default boundary mode
+    '''
+    if filter_mode not in ['linear', 'nearest']:
+      logging.info(f"WARN: filter_mode {filter_mode} is not supported by the torch rasterizer, using linear")
+    mode = 'nearest' if filter_mode=='nearest' else 'bilinear'
+    tex = tex.permute(0,3,1,2).expand(len(uv),-1,-1,-1)
+    grid = torch.remainder(uv, 1)*2-1
+    out = F.grid_sample(tex, grid, mode=mode, padding_mode='border', align_corners=False)
+    return out.permute(0,2,3,1)
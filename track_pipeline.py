@@ -0,0 +1,217 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+import os,time,queue,threading,logging
+import numpy as np
+import torch
+from Utils import draw_posed_3d_box, draw_xyz_axis, LazyModule
+from instrumentation import trace_span
+
+imageio = LazyModule('imageio')
+
+
+_STOP = object()
+
+
+class PipelineStage:
+  '''One worker thread reading from a bounded queue and writing to the next one.
+  A single worker per stage keeps the frame order
+  '''
+  def __init__(self, name, fn, in_queue, out_queue, stop_event, on_error):
+    self.name = name
+    self.fn = fn
+    self.in_queue = in_queue
+    self.out_queue = out_queue
+    self.stop_event = stop_event
+    self.on_error = on_error
+    self.count = 0
+    self.busy = 0.0
+    self.thread = threading.Thread(target=self.run, name=f'pipeline_{name}', daemon=True)
+
+
+  def run(self):
+    while not self.stop_event.is_set():
+      item = get_or_stop(self.in_queue, self.stop_event)
+      if item is _STOP:
+        break
+      try:
+        begin = time.perf_counter()
+        with trace_span(f'stage_{self.name}'):
+          item = self.fn(item)
+        self.busy += time.perf_counter()-begin
+        self.count += 1
+      except Exception as e:
+        logging.exception(f'stage {self.name} failed')
+        self.on_error(e)
+        break
+      if self.out_queue is not None:
+        put_or_stop(self.out_queue, item, self.stop_event)
+    if self.out_queue is not None:
+      put_or_stop(self.out_queue, _STOP, self.stop_event)
+
+
+  def get_stats(self):
+    return {
+      'frames': self.count,
+      'busy_s': self.busy,
+      'ms_per_frame': self.busy/max(self.count,1)*1000,
+      'max_fps': self.count/self.busy if self.busy>0 else float('inf'),
+    }
+
+
+
+def get_or_stop(q, stop_event, timeout=0.1):
+  while not stop_event.is_set():
+    try:
+      return q.get(timeout=timeout)
+    except queue.Empty:
+      pass
+  return _STOP
+
+
+def put_or_stop(q, item, stop_event, timeout=0.1):
+  '''Blocking put that gives up once the pipeline is stopped, so no thread hangs on a queue nobody consumes
+  '''
+  while not stop_event.is_set():
+    try:
+      q.put(item, timeout=timeout)
+      return True
+    except queue.Full:
+      pass
+  return False
+
+
+
+class TrackPipeline:
+  '''Register the first frame, track the rest, with decode -> preprocess -> refine -> sink running in their own threads.
+  Sustained throughput is bounded by the slowest stage instead of the sum of all stages.
+  Only the refine stage changes the estimator. The preprocess stage calls est.preprocess_depth, which must stay stateless (it only reads
+  the device of the estimator) for the two stages to share the estimator without locking.
+  On cuda, preprocess runs on its own stream so its kernels overlap the refine kernels on the default stream. Each frame hands its
+  depth over with an event that the refine stream waits on, neither thread blocks on the other's work
+  '''
+  def __init__(self, est, reader, register_iteration=5, track_iteration=2, sink=None, queue_size=4):
+    '''
+    @reader: provides K, get_color(i), get_depth(i), get_mask(i), e.g. YcbineoatReader
+    @sink: callable(item) called in frame order, item has 'i', 'color', 'depth', 'pose' (4,4) np array wrt. the original mesh and 'extra'
+    @queue_size: max frames waiting between two stages
+    '''
+    self.est = est
+    self.reader = reader
+    self.register_iteration = register_iteration
+    self.track_iteration = track_iteration
+    self.sink = sink
+    self.queue_size = queue_size
+    self.error = None
+    self.preprocess_stream = None
+
+
+  def decode(self, i):
+    item = {'i': i, 'color': self.reader.get_color(i), 'depth': self.reader.get_depth(i), 'extra': {}}
+    if i==self.first_frame:
+      item['mask'] = self.reader.get_mask(i).astype(bool)
+    return item
+
+
+  def preprocess(self, item):
+    if 'mask' in item:
+      return item
+    if self.est.device.type!='cuda':
+      item['preprocessed'] = self.est.preprocess_depth(item['depth'], self.reader.K)
+      return item
+    if self.preprocess_stream is None:
+      self.preprocess_stream = torch.cuda.Stream(self.est.device)
+    with torch.cuda.stream(self.preprocess_stream):
+      item['preprocessed'] = self.est.preprocess_depth(item['depth'], self.reader.K)
+      item['preprocessed_event'] = torch.cuda.Event()
+      item['preprocessed_event'].record(self.preprocess_stream)
+    return item
+
+
+  def refine(self, item):
+    if 'mask' in item:
+      item['pose'] = self.est.register(K=self.reader.K, rgb=item['color'], depth=item['depth'], ob_mask=item['mask'], iteration=self.register_iteration)
+      return item
+    preprocessed = item.pop('preprocessed')
+    event = item.pop('preprocessed_event', None)
+    if event is not None:
+      stream = torch.cuda.current_stream(self.est.device)
+      stream.wait_event(event)
+      for tensor in preprocessed:
+        tensor.record_stream(stream)   # Made on the preprocess stream, their memory must not be reused before this stream is done with them
+    item['pose'] = self.est.track_one(rgb=item['color'], depth=item['depth'], K=self.reader.K, iteration=self.track_iteration, extra=item['extra'], preprocessed=preprocessed)
+    return item
+
+
+  def write(self, item):
+    if self.sink is not None:
+      self.sink(item)
+    return item
+
+
+  def on_error(self, e):
+    if self.error is None:
+      self.error = e
+    self.stop_event.set()
+
+
+  def run(self, frame_ids=None):
+    '''@return: dict of per stage stats and the overall fps
+    '''
+    if frame_ids is None:
+      frame_ids = list(range(len(self.reader.color_files)))
+    self.first_frame = frame_ids[0]
+    self.error = None
+    self.stop_event = threading.Event()
+
+    queues = [queue.Queue(maxsize=self.queue_size) for _ in range(4)]
+    fns = [('decode', self.decode), ('preprocess', self.preprocess), ('refine', self.refine), ('sink', self.write)]
+    stages = []
+    for k,(name,fn) in enumerate(fns):
+      out_queue = queues[k+1] if k+1<len(queues) else None
+      stages.append(PipelineStage(name, fn, queues[k], out_queue, self.stop_event, self.on_error))
+
+    begin = time.perf_counter()
+    for stage in stages:
+      stage.thread.start()
+    for i in frame_ids:
+      if not put_or_stop(queues[0], i, self.stop_event):
+        break
+    put_or_stop(queues[0], _STOP, self.stop_event)
+    for stage in stages:
+      stage.thread.join()
+    wall = time.perf_counter()-begin
+
+    if self.error is not None:
+      raise self.error
+
+    stats = {stage.name: stage.get_stats() for stage in stages}
+    n_frames = stages[-1].count
+    stats['total'] = {'frames': n_frames, 'wall_s': wall, 'fps': n_frames/wall if wall>0 else 0}
+    for name in stats:
+      logging.info(f'{name}: {stats[name]}')
+    return stats
+
+
+
+def make_default_sink(reader, debug_dir, to_origin, bbox, debug=1):
+  '''Same outputs as the serial demo loop: ob_in_cam txt and, with debug>=2, the box/axis overlay png
+  '''
+  os.makedirs(f'{debug_dir}/ob_in_cam', exist_ok=True)
+  os.makedirs(f'{debug_dir}/track_vis', exist_ok=True)
+  def sink(item):
+    pose = item['pose']
+    id_str = reader.id_strs[item['i']]
+    np.savetxt(f'{debug_dir}/ob_in_cam/{id_str}.txt', pose.reshape(4,4))
+    if debug>=2:
+      center_pose = pose@np.linalg.inv(to_origin)
+      vis = draw_posed_3d_box(reader.K, img=item['color'], ob_in_cam=center_pose, bbox=bbox)
+      vis = draw_xyz_axis(item['color'], ob_in_cam=center_pose, scale=0.1, K=reader.K, thickness=3, transparency=0, is_input_rgb=True)
+      imageio.imwrite(f'{debug_dir}/track_vis/{id_str}.png', vis)
+  return sink